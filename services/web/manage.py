@@ -2,11 +2,26 @@
 # this file will make setting one up in the future easy.
 #
 # This is the file passed to Gunicorn.
+import psycopg2
 from flask.cli import FlaskGroup
 
 from pyparcel import app
+from pyparcel import jobqueue, write
+from pyparcel.common import DB_URI
 
 cli = FlaskGroup(app)
 
+
+@cli.command("migrate")
+def migrate():
+    """ Applies pyparcel's changes to the database's schema. Run once per deploy. """
+    with psycopg2.connect(DB_URI) as conn:
+        with conn.cursor() as cursor:
+            write.add_content_hash_columns(cursor)
+            write.add_missing_column(cursor)
+            jobqueue.create_table(cursor)
+    # Leaving the with block commits
+
+
 if __name__ == "__main__":
     cli()
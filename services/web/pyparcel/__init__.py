@@ -7,13 +7,77 @@ __email__ = "LearningWithSnapper@gmail.com"
 
 try:
     from .run import pyparcel
-    from flask import Flask, request, jsonify
+    from .cache import TTLCache
+    from .jobs import JobManager
+    from .common import DB_URI
+    from . import fetch, log, metrics, update
+    import hashlib
+    import json
+    import time
+    import psycopg2
+    import psycopg2.pool
+    import requests
+    from datetime import datetime
+    from flask import Flask, Response, request, jsonify, url_for
 
+    # The arguments of run.pyparcel that can be passed through the API, by type
+    _FLAGS = ["each", "diff", "audit", "commit", "resume", "profile_hot", "trace"]
+    _NUMBERS = [
+        "fetch_workers",
+        "parse_workers",
+        "queue_size",
+        "workers",
+        "batch_size",
+        "window_days",
+        "slice_size",
+    ]
+    _STRINGS = ["municode", "parcel", "schedule", "profile"]
+    # What GET /api/v1/pyparcel won't run within a request, as it updates more than
+    # a single parcel
+    _NOT_A_PARCEL = ["municode", "each", "diff", "audit", "schedule", "resume"]
+
+    # The most parcels /api/v1/parcels updates in one request
+    MAX_BATCH = 1000
+    # For GET /api/v1/parcels/<parid>
+    PARCEL_CACHE_SIZE = 50000
+    PARCEL_CACHE_TTL = 300  # seconds
+    DB_POOL_SIZE = 8
+
+    def _run_args(req) -> dict:
+        """ Converts query (or JSON) arguments into run.pyparcel's keyword arguments.
+        """
+        # If an argument is left blank, it is assumed that default values are wanted.
+        # Thus we only pass the function arguments that are not left blank.
+        args = {}
+        for param in _FLAGS + _NUMBERS + _STRINGS:
+            value = req.get(param)
+            if value is None:
+                continue
+            if param in _FLAGS and isinstance(value, str):
+                value = value.lower() in ("1", "true", "yes", "on")
+            elif param in _NUMBERS:
+                value = int(value)
+            args[param] = value
+        return args
 
     def _create_app():
         """ Application factory
         """
+        log.configure()
         app = Flask(__name__)
+        jobs = JobManager()
+        parcel_cache = TTLCache(maxsize=PARCEL_CACHE_SIZE, ttl=PARCEL_CACHE_TTL)
+        pool = []
+
+        def db_pool():
+            """ Connections for the endpoints that use the database within the request,
+            opened on first use.
+            """
+            if not pool:
+                pool.append(
+                    psycopg2.pool.ThreadedConnectionPool(1, DB_POOL_SIZE, DB_URI)
+                )
+            return pool[0]
 
         @app.route("/", methods=["GET"])
         def home():
@@ -21,26 +85,191 @@ try:
 
         @app.route("/api/v1/pyparcel", methods=["GET"])
         def pyparcel_api():
-            req = request.args
-
-            params = {}
-            params["municode"] = req.get("municode")
-            params["each"] = req.get("each")
-            params["diff"] = req.get("diff")
-            params["parcel"] = req.get("parcel")
-            params["commit"] = req.get("commit")
-
-            # If an argument is left blank, it is assumed that default values are wanted.
-            # Thus we only pass the function arguments that are not left blank.
-            args = {}
-            for param in params:
-                if params[param] is not None:
-                    args[param] = params[param]
-
+            """ Runs pyparcel within the request, for a single ?parcel= only.
+            POST to submit anything larger as a job.
+            """
+            try:
+                args = _run_args(request.args)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            if not args.get("parcel") or any(args.get(p) for p in _NOT_A_PARCEL):
+                error = "Only a single parcel can be updated here; POST to submit a job"
+                return jsonify({"error": error}), 400
             response = pyparcel(**args)
             # Todo: Response to xml
             return jsonify(response)
 
+        @app.route("/api/v1/pyparcel", methods=["POST"])
+        def submit_job():
+            body = request.get_json(silent=True)
+            if body is not None and not isinstance(body, dict):
+                return jsonify({"error": "Expected a JSON object of arguments"}), 400
+            try:
+                args = _run_args(body or request.values)
+            except (TypeError, ValueError) as e:  # Such as {"workers": [2]}
+                return jsonify({"error": str(e)}), 400
+            job = jobs.submit(args)
+            status_url = url_for("job_status", job_id=job.id)
+            return jsonify({"job": job.id, "status": status_url}), 202, {
+                "Location": status_url
+            }
+
+        @app.route("/api/v1/parcels", methods=["POST"])
+        def update_parcels():
+            """ Updates a batch of parcels within the request.
+
+            Expects a JSON body such as
+                {"parcels": ["0374R00210000000", ...], "commit": true}
+            Responds with a result for each parcel. See update.parcels.
+            """
+            body = request.get_json(silent=True)
+            parids = body.get("parcels") if isinstance(body, dict) else None
+            if (
+                not isinstance(parids, list)
+                or not parids
+                or not all(isinstance(parid, str) for parid in parids)
+            ):
+                return jsonify({"error": "Expected a list of parcel ids"}), 400
+            if len(set(parids)) > MAX_BATCH:
+                return jsonify({"error": f"At most {MAX_BATCH} parcels at once"}), 400
+            conn = db_pool().getconn()
+            try:
+                with conn.cursor() as cursor:
+                    # Commits or rolls back before returning
+                    results = update.parcels(
+                        conn, cursor, bool(body.get("commit")), parids
+                    )
+            except ValueError as e:  # An invalid parcel id
+                conn.rollback()
+                return jsonify({"error": str(e)}), 400
+            finally:
+                # Rolls back whatever an unexpected error left open
+                db_pool().putconn(conn)
+            return jsonify({"results": results})
+
+        @app.route("/api/v1/parcels/<parid>", methods=["GET"])
+        def read_parcel(parid):
+            """ The latest owner and tax status of a parcel, from the database.
+
+            ?max_age=<seconds> scrapes the Real Estate Portal instead
+            when the database's data was last seen longer ago than that.
+            If the scrape fails, the database's data is returned with a Warning,
+            or a 502 if there is none. Last-Modified is when the data last changed.
+            """
+            try:
+                max_age = request.args.get("max_age", type=float)
+                fetch.validate_parid(parid)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+
+            entry = parcel_cache.get(parid)
+            if entry is None:
+                entry = _read_from_db(parid)
+            data, etag, modified, seen = entry or (None, None, 0, 0)
+            stale = False
+            if max_age is not None and time.time() - seen > max_age:
+                try:
+                    live = update.live_parcel_data(parid)
+                except requests.RequestException as e:
+                    if data is None:
+                        error = "Couldn't scrape the parcel: {!r}".format(e)
+                        return jsonify({"error": error}), 502
+                    # The database's data is better than nothing
+                    stale = True
+                else:
+                    data, etag, modified, seen = _cache_entry(parid, live)
+            if data is None:
+                return jsonify({"error": "Parcel has not been updated"}), 404
+
+            response = jsonify(data)
+            response.set_etag(etag)
+            response.last_modified = modified
+            if stale:
+                response.headers["Warning"] = '110 - "Response is Stale"'
+            # Answers If-None-Match and If-Modified-Since with a 304
+            return response.make_conditional(request)
+
+        def _read_from_db(parid):
+            conn = db_pool().getconn()
+            try:
+                with conn.cursor() as cursor:
+                    data = fetch.latest_parcel_data(parid, cursor)
+                conn.rollback()
+            finally:
+                db_pool().putconn(conn)
+            if data is None:
+                return None
+            return _cache_entry(parid, data)
+
+        def _cache_entry(parid, data):
+            """ (data, ETag, when it last changed, when it was last seen) """
+            data = dict(data)
+            seen = time.time() - data.pop("age")
+            modified = datetime.fromisoformat(data["lastupdated"]).timestamp()
+            etag = hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+            entry = (data, etag, modified, seen)
+            parcel_cache.set(parid, entry)
+            return entry
+
+        @app.route("/api/v1/jobs", methods=["GET"])
+        def list_jobs():
+            return jsonify([job.as_dict() for job in jobs.list()])
+
+        @app.route("/api/v1/jobs/<job_id>", methods=["GET"])
+        def job_status(job_id):
+            job = jobs.get(job_id)
+            if job is None:
+                return jsonify({"error": "No such job"}), 404
+            return jsonify(job.as_dict())
+
+        @app.route("/api/v1/jobs/<job_id>/stream", methods=["GET"])
+        def job_stream(job_id):
+            """ Streams a job's progress as server-sent events,
+            or as newline delimited JSON if ?format=ndjson.
+            """
+            job = jobs.get(job_id)
+            if job is None:
+                return jsonify({"error": "No such job"}), 404
+            # A reconnecting EventSource says where it left off
+            after = request.headers.get("Last-Event-ID", request.args.get("after", 0))
+            try:
+                after = int(after)
+            except ValueError:
+                error = "Last-Event-ID and ?after= must be update numbers"
+                return jsonify({"error": error}), 400
+            ndjson = request.args.get("format") == "ndjson"
+
+            def generate():
+                for update in job.updates(after):
+                    if update is None:
+                        # Keeps proxies from closing a quiet connection
+                        yield "\n" if ndjson else ": keep-alive\n\n"
+                    elif ndjson:
+                        yield json.dumps(update) + "\n"
+                    else:
+                        yield "id: {}\nevent: {}\ndata: {}\n\n".format(
+                            update["seq"], update["type"], json.dumps(update)
+                        )
+
+            mimetype = "application/x-ndjson" if ndjson else "text/event-stream"
+            # X-Accel-Buffering stops nginx from holding the stream back
+            headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            return Response(generate(), mimetype=mimetype, headers=headers)
+
+        @app.route("/api/v1/jobs/<job_id>", methods=["DELETE"])
+        def cancel_job(job_id):
+            job = jobs.cancel(job_id)
+            if job is None:
+                return jsonify({"error": "No such job"}), 404
+            return jsonify(job.as_dict()), 202
+
+        @app.route("/metrics", methods=["GET"])
+        def prometheus_metrics():
+            """ This process's metrics, for Prometheus to scrape. See metrics.py. """
+            return Response(
+                metrics.REGISTRY.render(), mimetype="text/plain; version=0.0.4"
+            )
+
         return app
 
 
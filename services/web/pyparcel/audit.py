@@ -0,0 +1,356 @@
+"""
+Audits a municipality's WPRDC data against the Real Estate Portal on a random sample.
+
+update._validate_data cross-checks a parcel's WPRDC record against its portal page,
+but only the parcels that are scraped get checked. An audit scrapes a random sample of
+a municipality instead, stratified by land use (USECODE and CLASS) so that small strata,
+such as commercial or government parcels, are always represented:
+    - The sample is sized to estimate a mismatch rate of EXPECTED_RATE to within
+      MARGIN at CONFIDENCE, with the finite population correction. It's split across
+      strata in proportion to their size, with at least MIN_PER_STRATUM from each.
+    - The municipality's mismatch rate is estimated stratum by stratum, weighting
+      each stratum by its size, since widened strata are oversampled. Its interval
+      is a Wilson score interval on the sample size the strata's variances add up to
+      (see stratified_interval). Each stratum's rate has a plain Wilson interval.
+    - The sample is only widened where mismatches show up: a stratum with a mismatch
+      has its sample doubled, up to MAX_ROUNDS times. A clean municipality costs a
+      single round of portal requests.
+Nothing is written to the database.
+
+Audit municipalities with run.pyparcel(audit=True), or
+    python -m pyparcel.audit --municodes 814 111 ...
+"""
+import argparse
+import collections
+import contextvars
+import json
+import logging
+import math
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+from statistics import NormalDist
+from typing import Callable, Dict, Iterable, Iterator, Optional, Set, Tuple
+
+import psycopg2
+
+import pyparcel.fetch as fetch
+import pyparcel.log as log
+import pyparcel.metrics as metrics
+import pyparcel.update as update
+from pyparcel.common import DB_URI
+
+logger = logging.getLogger(__name__)
+
+CONFIDENCE = float(os.environ.get("PYPARCEL_AUDIT_CONFIDENCE", 0.95))
+MARGIN = float(os.environ.get("PYPARCEL_AUDIT_MARGIN", 0.05))
+# The mismatch rate samples are sized for. 0.5 is the most conservative.
+EXPECTED_RATE = float(os.environ.get("PYPARCEL_AUDIT_EXPECTED_RATE", 0.1))
+MIN_PER_STRATUM = 2
+MAX_ROUNDS = 3
+DEFAULT_FETCH_WORKERS = 4
+
+Stratum = Tuple[str, str]
+
+
+def stratum(record) -> Stratum:
+    """ A parcel's land use: its (USECODE, CLASS). """
+    return str(record.get("USECODE")), str(record.get("CLASS"))
+
+
+def sample_size(
+    population: int,
+    margin: float = MARGIN,
+    confidence: float = CONFIDENCE,
+    expected: float = EXPECTED_RATE,
+) -> int:
+    """ The parcels needed to estimate a rate of `expected` to within margin. """
+    if population <= 0:
+        return 0
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    n = z * z * expected * (1 - expected) / (margin * margin)
+    # Finite population correction
+    n = n / (1 + (n - 1) / population)
+    return min(population, math.ceil(n))
+
+
+def wilson(
+    mismatches: int, sampled: int, confidence: float = CONFIDENCE
+) -> Tuple[float, float]:
+    """ The Wilson score interval of a mismatch rate. """
+    if sampled == 0:
+        return 0.0, 1.0
+    return _wilson(mismatches / sampled, sampled, confidence)
+
+
+def _wilson(rate: float, sampled: float, confidence: float) -> Tuple[float, float]:
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    denominator = 1 + z * z / sampled
+    centre = (rate + z * z / (2 * sampled)) / denominator
+    spread = (
+        z
+        * math.sqrt(rate * (1 - rate) / sampled + z * z / (4 * sampled * sampled))
+        / denominator
+    )
+    return max(0.0, centre - spread), min(1.0, centre + spread)
+
+
+def stratified_interval(
+    strata: Iterable[Tuple[int, int, int]], confidence: float = CONFIDENCE
+) -> Tuple[float, Tuple[float, float]]:
+    """
+    The mismatch rate of a stratified sample, and its confidence interval.
+
+    Each stratum's rate is weighted by its share of the population. The estimate's
+    variance adds up the strata's, with the finite population correction, and the
+    interval is a Wilson score interval on the effective sample size that variance
+    amounts to. Strata rates are shrunk towards a half, (mismatches + 0.5) /
+    (sampled + 1), for the variance only, so a clean sample doesn't claim certainty.
+
+    Args:
+        strata: (population, sampled, mismatches) of each stratum
+    """
+    strata = [s for s in strata if s[1]]
+    population = sum(size for size, _, _ in strata)
+    if population == 0:
+        return 0.0, (0.0, 1.0)
+    estimate = 0.0
+    shrunk_estimate = 0.0
+    variance = 0.0
+    for size, sampled, mismatches in strata:
+        weight = size / population
+        estimate += weight * mismatches / sampled
+        shrunk = (mismatches + 0.5) / (sampled + 1)
+        shrunk_estimate += weight * shrunk
+        variance += (
+            weight * weight * (1 - sampled / size) * shrunk * (1 - shrunk) / sampled
+        )
+    if variance == 0:
+        # Every stratum was sampled in full
+        return estimate, (estimate, estimate)
+    # Without the finite population correction, a simple random sample of n comes
+    # out at n
+    effective = shrunk_estimate * (1 - shrunk_estimate) / variance
+    return estimate, _wilson(estimate, effective, confidence)
+
+
+def allocate(sizes: Dict[Stratum, int], total: int) -> Dict[Stratum, int]:
+    """ Splits a sample of total parcels across strata in proportion to their size. """
+    population = sum(sizes.values())
+    if population == 0:
+        return {key: 0 for key in sizes}
+    return {
+        key: min(size, max(MIN_PER_STRATUM, math.ceil(total * size / population)))
+        for key, size in sizes.items()
+    }
+
+
+def _choose(
+    sizes: Dict[Stratum, int],
+    targets: Dict[Stratum, int],
+    chosen: Dict[Stratum, Set[int]],
+    rng: random.Random,
+) -> Dict[Stratum, Set[int]]:
+    """
+    Picks the positions (within their stratum) of the parcels that bring each
+    stratum's sample up to its target, and adds them to chosen.
+    """
+    new = {}
+    for key, target in targets.items():
+        wanted = target - len(chosen[key])
+        if wanted <= 0:
+            continue
+        remaining = [i for i in range(sizes[key]) if i not in chosen[key]]
+        new[key] = set(rng.sample(remaining, min(wanted, len(remaining))))
+        chosen[key] |= new[key]
+    return new
+
+
+def _sampled(records: Iterable, positions: Dict[Stratum, Set[int]]) -> Iterator:
+    """ The records at the chosen positions, in a single pass over the records. """
+    seen = collections.Counter()
+    for record in records:
+        key = stratum(record)
+        if seen[key] in positions.get(key, ()):
+            yield record
+        seen[key] += 1
+
+
+def check(record) -> Optional[str]:
+    """
+    Scrapes a parcel and compares it to its WPRDC record.
+
+    Returns:
+        Why the parcel's WPRDC data doesn't match the portal's, or None if it does
+    """
+    record, html = update.fetch_parcel(record=record)
+    _, tax_status = update.parse_parcel(html)
+    try:
+        update._validate_data(record, tax_status)
+    except ValueError as e:
+        return str(e)
+    return None
+
+
+def _checked(check: Callable, record):
+    """ Runs check on a thread, catching what went wrong with the scrape itself. """
+    try:
+        return check(record), None
+    except Exception as e:
+        return None, e
+
+
+def municipality(
+    records: Iterable,
+    municode=None,
+    seed=None,
+    fetch_workers: int = DEFAULT_FETCH_WORKERS,
+    margin: float = MARGIN,
+    confidence: float = CONFIDENCE,
+    check: Callable = check,
+) -> dict:
+    """
+    Audits a municipality's records.
+    The records are read once per round, so they can be streamed (fetch.Records).
+
+    Args:
+        records: The municipality's WPRDC records
+        seed: Seeds the sample, so an audit can be repeated
+        check: Called with each sampled record. See check.
+
+    Returns:
+        The audit's report. Keys:
+            "municode"
+            "population": The number of parcels
+            "sampled": The number of parcels compared
+            "errors": The number of parcels whose page couldn't be scraped or parsed
+            "mismatches": The number of sampled parcels that didn't match
+            "rate": mismatches / sampled
+            "estimate": The municipality's mismatch rate, weighting each stratum
+                by its size, since widened strata are overrepresented
+            "interval": The estimate's confidence interval, [low, high].
+                See stratified_interval.
+            "confidence"
+            "rounds": The number of rounds of scraping
+            "strata": By "USECODE/CLASS", their population, sampled, mismatches
+                and interval
+            "mismatched": The parcel ids that didn't match, with why
+    """
+    rng = random.Random(seed)
+    sizes = collections.Counter(stratum(r) for r in records)
+    population = sum(sizes.values())
+    targets = allocate(sizes, sample_size(population, margin, confidence))
+    chosen: Dict[Stratum, Set[int]] = {key: set() for key in sizes}
+    sampled = collections.Counter()
+    mismatches = collections.Counter()
+    mismatched = {}
+    errors = 0
+    rounds = 0
+    with ThreadPoolExecutor(max_workers=fetch_workers) as pool:
+        while rounds <= MAX_ROUNDS:
+            positions = _choose(sizes, targets, chosen, rng)
+            if not positions:
+                break
+            rounds += 1
+            widen = set()
+            sample = list(_sampled(records, positions))
+            # In copies of this context, so the scrapes' timings count towards the run
+            results = [
+                pool.submit(contextvars.copy_context().run, _checked, check, r)
+                for r in sample
+            ]
+            results = (future.result() for future in results)
+            for record, (problem, error) in zip(sample, results):
+                key = stratum(record)
+                if error is not None:
+                    errors += 1
+                    logger.warning(
+                        "Couldn't audit parcel: {!r}".format(error),
+                        extra={"parid": record["PARID"], "municode": municode},
+                    )
+                    continue
+                sampled[key] += 1
+                metrics.AUDITED_PARCELS.inc()
+                if problem is not None:
+                    mismatches[key] += 1
+                    mismatched[record["PARID"]] = problem
+                    metrics.AUDIT_MISMATCHES.inc()
+                    widen.add(key)
+            # Only the strata with mismatches are sampled further
+            targets = {
+                key: min(sizes[key], 2 * len(chosen[key])) if key in widen else 0
+                for key in sizes
+            }
+
+    total_sampled = sum(sampled.values())
+    total_mismatches = sum(mismatches.values())
+    estimate, interval = stratified_interval(
+        ((sizes[key], sampled[key], mismatches[key]) for key in sizes), confidence
+    )
+    report = {
+        "municode": municode,
+        "population": population,
+        "sampled": total_sampled,
+        "errors": errors,
+        "mismatches": total_mismatches,
+        "rate": total_mismatches / total_sampled if total_sampled else 0.0,
+        "interval": list(interval),
+        "estimate": estimate,
+        "confidence": confidence,
+        "rounds": rounds,
+        "strata": {
+            "/".join(key): {
+                "population": sizes[key],
+                "sampled": sampled[key],
+                "mismatches": mismatches[key],
+                "interval": list(wilson(mismatches[key], sampled[key], confidence)),
+            }
+            for key in sorted(sizes)
+        },
+        "mismatched": mismatched,
+    }
+    logger.info(
+        "Audited {} of {} parcels: {} mismatched".format(
+            total_sampled, population, total_mismatches
+        ),
+        extra={
+            key: report[key]
+            for key in ("municode", "rate", "interval", "estimate", "rounds")
+        },
+    )
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Audits the WPRDC's data against the Real Estate Portal."
+    )
+    parser.add_argument("--municodes", nargs="+", type=int, required=True)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--margin", type=float, default=MARGIN)
+    parser.add_argument("--confidence", type=float, default=CONFIDENCE)
+    parser.add_argument("--fetch-workers", type=int, default=DEFAULT_FETCH_WORKERS)
+    args = parser.parse_args()
+
+    log.configure()
+    reports = []
+    with psycopg2.connect(DB_URI) as conn, conn.cursor() as cursor:
+        for municode in args.municodes:
+            muni = fetch.muniname_given_municode(municode, cursor)
+            records = fetch.municipality_records_from_Wprdc(muni)
+            reports.append(
+                municipality(
+                    records,
+                    muni.municode,
+                    seed=args.seed,
+                    fetch_workers=args.fetch_workers,
+                    margin=args.margin,
+                    confidence=args.confidence,
+                )
+            )
+    log.flush()
+    print(json.dumps(reports, indent=2))
+
+
+if __name__ == "__main__":
+    main()
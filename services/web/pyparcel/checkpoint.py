@@ -0,0 +1,121 @@
+"""
+Durable progress for long runs, so a run that dies can pick up where it stopped.
+
+Every municipality gets a small JSON file recording which of its parcel batches
+have been written, how many parcels made a batch, and whether its --each, --diff
+and --audit passes are finished.
+Each file only ever has one writer (the process updating that municipality),
+and it is replaced atomically, so a crash mid-write never corrupts it.
+"""
+import json
+import os
+import shutil
+from typing import Set
+
+from pyparcel.common import CHECKPOINTS
+
+DEFAULT_BATCH_SIZE = 500
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+
+
+def empty_state() -> dict:
+    """ The progress of a municipality nothing has been done for yet. """
+    return {
+        "batches": [],
+        "batch_size": None,
+        "each": False,
+        "diff": False,
+        "audit": False,
+        "done": False,
+    }
+
+
+class Checkpoint:
+    """
+    The progress of a single kind of run.
+
+    Runs with different arguments (for example, --each versus --diff)
+    don't share progress, so they are kept under different keys.
+    Batches are numbered, so they're only resumed with the batch size they were
+    written with.
+    """
+
+    def __init__(self, key: str, directory: str = os.path.join(HERE, CHECKPOINTS)):
+        self.path = os.path.join(directory, key)
+
+    @classmethod
+    def for_run(cls, municode, each, diff, commit, audit=False, **kwargs):
+        parts = ["all" if municode is None else str(municode)]
+        if each:
+            parts.append("each")
+        if diff:
+            parts.append("diff")
+        if audit:
+            parts.append("audit")
+        parts.append("commit" if commit else "nocommit")
+        key = "_".join(parts)
+        return cls(key, **kwargs)
+
+    def _file(self, municode) -> str:
+        return os.path.join(self.path, "{}.json".format(municode))
+
+    def _read(self, municode) -> dict:
+        try:
+            with open(self._file(municode), "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return empty_state()
+
+    def _write(self, municode, state: dict):
+        os.makedirs(self.path, exist_ok=True)
+        tmp = self._file(municode) + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._file(municode))
+
+    def _mark(self, municode, key, value=True):
+        state = self._read(municode)
+        state[key] = value
+        self._write(municode, state)
+
+    def municipality_done(self, municode) -> bool:
+        return self._read(municode)["done"]
+
+    def pass_done(self, municode, name: str) -> bool:
+        """ Whether the municipality's 'each', 'diff' or 'audit' pass is finished. """
+        return self._read(municode).get(name, False)
+
+    def batches_done(self, municode, batch_size: int) -> Set[int]:
+        """
+        Raises:
+            ValueError if the batches were written with a different batch size,
+            since their numbers would point at other parcels
+        """
+        state = self._read(municode)
+        if state["batches"] and state.get("batch_size") != batch_size:
+            raise ValueError(
+                "Municipality {} was checkpointed in batches of {} parcels, not {}. "
+                "Resume with that batch size, or start over.".format(
+                    municode, state.get("batch_size"), batch_size
+                )
+            )
+        return set(state["batches"])
+
+    def mark_batch(self, municode, batch: int, batch_size: int):
+        state = self._read(municode)
+        state["batches"].append(batch)
+        state["batch_size"] = batch_size
+        self._write(municode, state)
+
+    def mark_pass(self, municode, name: str):
+        self._mark(municode, name)
+
+    def mark_municipality(self, municode):
+        self._mark(municode, "done")
+
+    def clear(self):
+        """ Forgets all progress, when starting over or after a finished run. """
+        shutil.rmtree(self.path, ignore_errors=True)
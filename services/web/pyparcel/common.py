@@ -13,7 +13,10 @@ Home for Magic Strings and classes that are used across different files.
 # Note: Some Magic Strings are currently unused, but kept anyways for potential use
 
 import os
+import re
+import sys
 from collections import namedtuple
+from typing import Any, Dict, Iterator, Optional
 
 # Allegheny County Property Assessment tabs.
 GENERALINFO = "GeneralInfo"
@@ -27,6 +30,9 @@ MAP = "Map"
 
 DEFAULT_PROP_UNIT = -1
 
+# Allegheny County parcel ids, without hyphens. Example: 0374R00210000000
+PARID_PATTERN = re.compile(r"[0-9A-Za-z]+")
+
 # Allegheny County Property Assessment span ids
 OWNER = "BasicInfo1_lblOwner"
 ADDRESS = "BasicInfo1_lblAddress"
@@ -34,6 +40,7 @@ MUNICIPALITY = "BasicInfo1_lblMuni"
 PARCEL_ID_LoB = "BasicInfo1_lblParcelID"
 MORTGAGE = "lblMortgage"
 TAXINFO = "lblTaxInfo"
+SERVER_TIME = "Header1_lblTime"
 
 # HTML Elements
 SPAN = "span"
@@ -50,6 +57,8 @@ DB_URI = f"postgresql://{BOT_NAME}:{BOT_PASSWORD}@db:{DB_PORT}/{DB_NAME}"
 
 # Output directories
 PARCEL_ID_LISTS = "parcelidlists"
+CHECKPOINTS = "checkpoints"
+REPORTS = "reports"
 
 # Formatting
 DASHES = "-" * 88
@@ -78,21 +87,18 @@ Jordan Tax Service, Inc. at (412) 835-5243. """
 #       OwnerName and Municipality to this file.
 
 
-class _Tally:
-    # Perhaps Tally should be replaced with collections.Counter?
-    def __init__(self):
-        self.total = 0
-        self.inserted = 0
-        self.updated = 0
-        self.muni_count = 0
-        self.diff_count = 0
+class RunCancelled(Exception):
+    """ Raised inside a run when its caller asked it to stop. """
 
 
-Tally = _Tally()
+class DataMismatch(ValueError):
+    """ The WPRDC's data doesn't match the data scraped from the Real Estate Portal. """
 
 
+# The typename must match the variable name, otherwise TaxStatuses can't be pickled
+# (which the process pool in pipeline.py relies on)
 TaxStatus = namedtuple(
-    "tax_status",
+    "TaxStatus",
     fields := [
         "year",
         "paidstatus",
@@ -105,3 +111,137 @@ TaxStatus = namedtuple(
     ],
     defaults=(None,) * len(fields),
 )
+
+# A parcel's tax status at its last update (only its year and paid status),
+# and the day it was last seen (see taxcalendar.py)
+LastTaxStatus = namedtuple(
+    "LastTaxStatus", ["tax_status", "seen", "saleprice", "saleyear"]
+)
+
+
+# The columns of a WPRDC property assessment record that pyparcel reads
+RECORD_FIELDS = (
+    "PARID",
+    "MUNICODE",
+    "USECODE",
+    "USEDESC",
+    "CLASS",
+    "OWNERDESC",
+    "PROPERTYHOUSENUM",
+    "PROPERTYFRACTION",
+    "PROPERTYADDRESS",
+    "PROPERTYUNIT",
+    "PROPERTYCITY",
+    "PROPERTYSTATE",
+    "PROPERTYZIP",
+    "CHANGENOTICEADDRESS1",
+    "CHANGENOTICEADDRESS2",
+    "CHANGENOTICEADDRESS3",
+    "CHANGENOTICEADDRESS4",
+    "SALEPRICE",
+    "SALEDATE",
+    "COUNTYLAND",
+    "COUNTYBUILDING",
+    "TAXYEAR",
+    "FINISHEDLIVINGAREA",
+    "CONDITION",
+)
+
+
+class Record:
+    """
+    A WPRDC property assessment record, less the ~60 columns pyparcel doesn't read.
+    Reads like the dictionary it replaces: record["PARID"], record.get("CLASS").
+
+    Records are built as the WPRDC's JSON is loaded (see Record.hook),
+    so the full dictionaries never pile up. Records that are kept together
+    share repeated values (cities, use codes, tax years...) between them.
+    """
+
+    __slots__ = RECORD_FIELDS
+
+    def __init__(
+        self, row: Dict[str, Any], shared: Optional[dict] = None, intern: bool = True
+    ):
+        """
+        Args:
+            row: The WPRDC's record
+            shared: Values already loaded, by value. Equal values are replaced
+                with the first one seen.
+            intern: Interns strings
+        """
+        for field in RECORD_FIELDS:
+            value = row.get(field)
+            if isinstance(value, str):
+                if intern:
+                    value = sys.intern(value)
+            elif shared is not None and value is not None:
+                value = shared.setdefault(value, value)
+            setattr(self, field, value)
+
+    @classmethod
+    def hook(cls, shared: Optional[dict] = None, share: bool = True):
+        """
+        A json.load object_hook that turns records into Records as they're parsed.
+
+        Args:
+            share: Shares equal values between the records. Turned off for records
+                that are streamed rather than kept, since shared values would pile
+                up instead.
+        """
+        if shared is None and share:
+            shared = {}
+
+        def object_hook(obj: dict):
+            if "PARID" in obj:
+                return cls(obj, shared, intern=share)
+            return obj
+
+        return object_hook
+
+    def __getitem__(self, field: str):
+        try:
+            return getattr(self, field)
+        except (AttributeError, TypeError):
+            raise KeyError(field) from None
+
+    def __setitem__(self, field: str, value):
+        if field not in RECORD_FIELDS:
+            raise KeyError(field)
+        setattr(self, field, value)
+
+    def get(self, field: str, default=None):
+        return getattr(self, field, default) if field in RECORD_FIELDS else default
+
+    def __contains__(self, field) -> bool:
+        return field in RECORD_FIELDS
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(RECORD_FIELDS)
+
+    def __len__(self) -> int:
+        return len(RECORD_FIELDS)
+
+    def keys(self):
+        return RECORD_FIELDS
+
+    def items(self):
+        return ((field, getattr(self, field)) for field in RECORD_FIELDS)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, (Record, dict)):
+            return all(self[f] == other.get(f) for f in RECORD_FIELDS)
+        return NotImplemented
+
+    def __repr__(self):
+        return "{}<{}>".format(type(self).__name__, self.PARID)
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
@@ -1,6 +1,18 @@
-from pyparcel.common import BOT_ID
+import hashlib
+import json
+
+from pyparcel.common import BOT_ID, RECORD_FIELDS
 from pyparcel.common import SPACE
 
+# Keys of a propertyexternaldata insert map that aren't part of the parcel's data
+_NOT_CONTENTS = {
+    "property_propertyid",
+    "notes",
+    "taxstatus_taxstatusid",
+    "contenthash",
+    "pagefingerprint",
+}
+
 
 def cecase_imap(prop_id, unit_id):
     imap = {}
@@ -49,6 +61,43 @@ def propertyexternaldata_imap(prop_id, name, r, taxstatus_id):
     return imap
 
 
+def content_hash(contents: dict) -> str:
+    """ Identifies a row's contents, so an identical row isn't written twice. """
+    text = json.dumps(contents, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def taxstatus_hash(tax_status) -> str:
+    return content_hash(tax_status._asdict())
+
+
+def propertyexternaldata_hash(imap: dict, tax_status_hash: str) -> str:
+    """
+    Identifies the contents of a propertyexternaldata insert map:
+    its data, and the contents (rather than the id) of its tax status.
+    """
+    contents = {k: v for k, v in imap.items() if k not in _NOT_CONTENTS}
+    contents["taxstatus"] = tax_status_hash
+    return content_hash(contents)
+
+
+def record_fingerprint(record) -> str:
+    """ Identifies the parts of a parcel's WPRDC record that its update reads. """
+    contents = {field: record.get(field) for field in RECORD_FIELDS}
+    contents = json.dumps(contents, sort_keys=True, default=str)
+    return hashlib.sha256(contents.encode("utf-8")).hexdigest()
+
+
+def page_fingerprint(record, normalized_html: str) -> str:
+    """
+    Identifies everything a parcel's update reads: its WPRDC record
+    and its Real Estate Portal page (see parse.normalize_html).
+    The record's fingerprint comes first, so it can be compared on its own.
+    """
+    page = hashlib.sha256(normalized_html.encode("utf-8")).hexdigest()
+    return "{}:{}".format(record_fingerprint(record), page)
+
+
 def property_insertmap(r: dict) -> dict:
     """
     Arguments:
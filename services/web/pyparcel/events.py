@@ -1,15 +1,65 @@
+import contextvars
+import logging
 import warnings
+from contextlib import contextmanager
 from dataclasses import dataclass
-from typing import Any, Optional
-
-from colorama import Fore, Style
-from colorama import init
+from typing import Any, Callable, Dict, List, Optional
 
+import pyparcel.metrics as metrics
 import pyparcel.parse as parse
 import pyparcel.scrape as scrape
+import pyparcel.timing as timing
 from pyparcel.common import BOT_ID
 
-init()
+logger = logging.getLogger(__name__)
+
+# Functions called with a summary (see summarize) of every Event written
+# to the database. Kept per context, like metrics.Scope, so a job only hears
+# about its own run's events.
+_listeners = contextvars.ContextVar("pyparcel_event_listeners", default=())
+# Where events are held while their parcel's writes could still be rolled back
+_held = contextvars.ContextVar("pyparcel_held_events", default=None)
+
+
+def add_listener(listener: Callable[[Dict[str, str]], None]):
+    _listeners.set(_listeners.get() + (listener,))
+
+
+def remove_listener(listener: Callable[[Dict[str, str]], None]):
+    # Bound methods are equal, but not identical, each time they're looked up
+    remaining = (other for other in _listeners.get() if other != listener)
+    _listeners.set(tuple(remaining))
+
+
+def summarize(event: "Event") -> Dict[str, str]:
+    """ What listeners are told about an event. Plain data, so it can be pickled. """
+    return {
+        "parid": event.parid,
+        "event": type(event).__name__,
+        "description": event.eventdescription,
+    }
+
+
+def publish(summaries: List[Dict[str, str]]):
+    """ Tells the listeners about events, such as ones written in another process. """
+    for summary in summaries:
+        for listener in _listeners.get():
+            listener(summary)
+
+
+@contextmanager
+def hold():
+    """
+    Collects the summaries of events written in the body of the with statement
+    instead of publishing them, for the caller to publish once the writes
+    are committed (or released), or to drop if they're rolled back.
+    """
+    held = []
+    token = _held.set(held)
+    try:
+        yield held
+    finally:
+        _held.reset(token)
 
 
 # Todo: Weigh benefits of making a dataclass
@@ -60,23 +110,17 @@ def query_propertyexternaldata_for_changes_and_write_events(
     except IndexError:
         if not new_parcel:
             # TODO: Add flag
-            print(
-                Fore.YELLOW,
-                "Error: Parcel {} appeared in public.propertyexternaldata for the "
-                "first time even though the parcel ID is flagged as appearing in "
-                "public.property before.\n".format(
-                    parid
-                ),
-                Style.RESET_ALL,
-                sep="",
+            logger.error(
+                "Parcel appeared in public.propertyexternaldata for the first time "
+                "even though the parcel ID is flagged as appearing in "
+                "public.property before.",
+                extra={"parid": parid},
             )
             return
         # If it IS a new parcel id
-        print(
-            Fore.YELLOW,
+        logger.info(
             "First time parcel has appeared in propertyexternaldata",
-            Style.RESET_ALL,
-            sep="",
+            extra={"parid": parid},
         )
         NewParcelid(details).write_to_db()
         return
@@ -127,13 +171,25 @@ class Event:
         self.cecase_id = details.cecase_id
         self.db_cursor = details.db_cursor
 
+    @timing.timed(timing.EVENT)
     def write_to_db(self):
         """ Writes an event to the database. """
         self._write_event_dunder_dict()
         self.event_id = self._write_event_to_db()  # uses self.ce_caseid
-        print(Fore.RED, self.eventdescription, Style.RESET_ALL, sep="")
-        if self.notes:
-            print(Fore.RED, self.notes, Style.RESET_ALL, sep="")
+        logger.info(
+            self.eventdescription,
+            extra={
+                "parid": self.parid,
+                "event": type(self).__name__,
+                "notes": self.notes,
+            },
+        )
+        metrics.EVENTS.inc(category=type(self).__name__)
+        held = _held.get()
+        if held is not None:
+            held.append(summarize(self))
+        else:
+            publish([summarize(self)])
 
     def _write_event_dunder_dict(self):
         assert self.category_id
@@ -0,0 +1,183 @@
+"""
+What happens to a parcel that fails partway through a run.
+
+One bad parcel shouldn't end a run that's hours in, so pipeline.py catches the
+exceptions of each parcel and sorts them into categories:
+    TRANSIENT: The portal or the WPRDC timed out, refused the connection, throttled
+        the run or answered with a server error. The parcel goes on a RetryQueue and
+        is fetched again after an exponential backoff, up to MAX_ATTEMPTS times.
+    FETCH: Fetching failed for some other reason, such as a parcel the WPRDC
+        doesn't have.
+    PARSE: The page didn't have what the parser looks for, such as the
+        lblTaxInfo span.
+    VALIDATION: The page didn't agree with the WPRDC (common.DataMismatch).
+    DATABASE: Writing the parcel failed. Its writes are rolled back.
+Parcels that aren't retried, or run out of attempts, are quarantined: logged, counted
+in metrics.PARCELS_FAILED and kept in the run's Quarantine, which its summary lists.
+A lost database connection (or parse process) isn't any one parcel's fault,
+so it still ends the run.
+
+Configured with the environment variables
+    PYPARCEL_RETRY_ATTEMPTS: Defaults to 4
+    PYPARCEL_RETRY_BACKOFF: The seconds before the first retry. Defaults to 2
+"""
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Optional, Tuple
+
+import psycopg2
+import requests
+
+import pyparcel.metrics as metrics
+from pyparcel.common import DataMismatch
+
+logger = logging.getLogger(__name__)
+
+TRANSIENT = "transient"
+FETCH = "fetch"
+PARSE = "parse"
+VALIDATION = "validation"
+DATABASE = "database"
+
+# The stages of pipeline.py
+FETCH_STAGE = "fetch"
+PARSE_STAGE = "parse"
+WRITE_STAGE = "write"
+
+MAX_ATTEMPTS = int(os.environ.get("PYPARCEL_RETRY_ATTEMPTS", 4))
+BACKOFF_BASE = float(os.environ.get("PYPARCEL_RETRY_BACKOFF", 2))  # seconds
+BACKOFF_MAX = 60  # seconds
+
+Failure = namedtuple("Failure", ["parid", "category", "stage", "error", "attempts"])
+
+
+def _transient(exc: BaseException) -> bool:
+    if isinstance(exc, requests.HTTPError):
+        status = exc.response.status_code if exc.response is not None else None
+        return status == 429 or (status is not None and status >= 500)
+    return isinstance(
+        exc, (requests.ConnectionError, requests.Timeout, ConnectionError, TimeoutError)
+    )
+
+
+def fatal(exc: BaseException) -> bool:
+    """ Whether an exception ends the run, since no parcel can be written after it. """
+    return isinstance(
+        exc, (psycopg2.OperationalError, psycopg2.InterfaceError, BrokenProcessPool)
+    )
+
+
+def permanent(exc: BaseException) -> bool:
+    """ Whether retrying can't help, since the sources would disagree again. """
+    return isinstance(exc, DataMismatch)
+
+
+def categorize(exc: BaseException, stage: str) -> str:
+    """ The category of an exception raised while a parcel was in the given stage. """
+    if _transient(exc):
+        return TRANSIENT
+    if isinstance(exc, DataMismatch):
+        return VALIDATION
+    if isinstance(exc, psycopg2.Error):
+        return DATABASE
+    return {FETCH_STAGE: FETCH, PARSE_STAGE: PARSE}.get(stage, DATABASE)
+
+
+def backoff(attempts: int) -> float:
+    """ Seconds to wait before retrying a parcel that has failed `attempts` times. """
+    return min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX)
+
+
+class RetryQueue:
+    """
+    Parcels waiting to be fetched again, ordered by when they're due.
+    Shared by the fetch threads, so it's thread safe.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._lock = threading.Lock()
+        # Breaks ties between parcels due at the same time, as records don't compare
+        self._order = itertools.count()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._heap)
+
+    def push(self, record, attempts: int):
+        """ Schedules a parcel that has failed `attempts` times to be tried again. """
+        due = time.monotonic() + backoff(attempts)
+        with self._lock:
+            heapq.heappush(self._heap, (due, next(self._order), record, attempts))
+        metrics.RETRIES.inc(kind="parcel")
+
+    def pop(self) -> Optional[Tuple[object, int]]:
+        """ The record and attempts of a parcel that's due, or None if none are. """
+        with self._lock:
+            if not self._heap or self._heap[0][0] > time.monotonic():
+                return None
+            _, _, record, attempts = heapq.heappop(self._heap)
+            return record, attempts
+
+    def wait(self) -> Optional[float]:
+        """ Seconds until the next parcel is due, or None if none are waiting. """
+        with self._lock:
+            if not self._heap:
+                return None
+            return max(0.0, self._heap[0][0] - time.monotonic())
+
+
+class Quarantine:
+    """
+    The parcels that failed for good, in the order they failed.
+    Each run has its own, which it passes to pipeline.run.
+    """
+
+    def __init__(self):
+        self._failures: List[Failure] = []
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._failures)
+
+    def quarantine(
+        self, parid: str, exc: BaseException, stage: str, attempts: int = 1
+    ) -> Failure:
+        failure = Failure(parid, categorize(exc, stage), stage, repr(exc), attempts)
+        self.add(failure)
+        return failure
+
+    def add(self, failure: Failure):
+        with self._lock:
+            self._failures.append(failure)
+        metrics.PARCELS_FAILED.inc(category=failure.category)
+        logger.warning(
+            "Parcel quarantined: {}".format(failure.error),
+            extra=failure._asdict(),
+        )
+
+    def failures(self) -> List[Failure]:
+        with self._lock:
+            return list(self._failures)
+
+    def extend(self, failures: List[Failure]):
+        """ Adds failures quarantined in another process, which already logged them. """
+        with self._lock:
+            self._failures.extend(Failure(*f) for f in failures)
+
+
+def summarize(failures: List[Failure]) -> dict:
+    """ The failures by category, for a run's summary. """
+    by_category = {}
+    for failure in failures:
+        by_category.setdefault(failure.category, []).append(
+            {k: v for k, v in failure._asdict().items() if k != "category"}
+        )
+    return by_category
@@ -1,9 +1,14 @@
-"""Contains logic for fetching data from the database and from the WPRDC API.
+"""Contains logic for fetching data from the database and from the WPRDC API
+(or a local snapshot of it).
 """
 
+import itertools
 import json
+import logging
 import os
-from typing import List
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
 
 import requests
 
@@ -12,16 +17,59 @@ import requests
 #   If not refactored, this file should somehow be designated a higher level than the others
 import pyparcel.create as create
 import pyparcel.parse as parse
+import pyparcel.snapshot as snapshot
 import pyparcel.write as write
-from pyparcel.common import PARCEL_ID_LISTS, DEFAULT_PROP_UNIT, MEDIUM_DASHES, DASHES
+from pyparcel.common import PARCEL_ID_LISTS, DEFAULT_PROP_UNIT
+from pyparcel.common import LastTaxStatus, PARID_PATTERN, Record, TaxStatus
 
+logger = logging.getLogger(__name__)
 
-def munis(cursor):
-    select_sql = "SELECT municode FROM municipality;"
+# Overridable so runs can query a stand-in WPRDC (see standin.py)
+WPRDC_URL = os.environ.get(
+    "PYPARCEL_WPRDC_URL", "https://data.wprdc.org/api/3/action/datastore_search_sql"
+)
+# A local snapshot of the WPRDC's data (see snapshot.py). When set, records are read
+# from it instead of the WPRDC.
+SNAPSHOT = os.environ.get("PYPARCEL_SNAPSHOT")
+_snapshots: Dict[str, snapshot.Snapshot] = {}
+
+# Rows fetched from the database per round trip by server side cursors
+ITERSIZE = 2000
+# Characters read from a saved WPRDC response at a time
+CHUNK_SIZE = 1 << 16
+_cursor_names = itertools.count()
+
+
+def _server_side(cursor, sql, args=None) -> Iterator[tuple]:
+    """
+    Streams a query's rows through a named (server side) cursor on cursor's
+    connection, ITERSIZE rows at a time, instead of fetching them all at once.
+    The cursor only lasts as long as the transaction it's declared in.
+    """
+    connection = cursor.connection
+    name = "pyparcel_{}_{}".format(os.getpid(), next(_cursor_names))
+    with connection.cursor(name=name) as server_side:
+        server_side.itersize = ITERSIZE
+        server_side.execute(sql, args)
+        for row in server_side:
+            yield row
+
+
+def munis(cursor) -> List[int]:
+    # There are only about 130, and a cursor held across the municipalities' commits
+    # would have to commit whatever the run had written before it
+    select_sql = "SELECT municode FROM municipality ORDER BY municode;"
     cursor.execute(select_sql)
-    munis = cursor.fetchall()
-    for row in munis:
-        yield row[0]
+    return [row[0] for row in cursor.fetchall()]
+
+
+def muni_sizes(cursor) -> Dict[str, int]:
+    """ The number of parcels in the database for every municipality with parcels. """
+    select_sql = """
+        SELECT municipality_municode, count(*) FROM property
+        GROUP BY municipality_municode;"""
+    cursor.execute(select_sql)
+    return {row[0]: row[1] for row in cursor.fetchall()}
 
 
 def muniname_given_municode(municode, cursor):
@@ -86,53 +134,268 @@ def cecase_id(
         return case_id
 
 
-def all_parids_in_muni(municdode, cursor) -> List[str]:
-    select_sql = "SELECT parid FROM property WHERE municipality_municode = %s;"
-    cursor.execute(select_sql, [municdode])
-    all_parcels = cursor.fetchall()
-    # Each parcel returned in all_parcels is a tuple rather than the string we want,
-    # so we unpack it.
-    return [p[0] for p in all_parcels]
+# The columns of propertyexternaldata that describe a parcel, less its owner
+PARCEL_DATA_FIELDS = (
+    "address_street",
+    "address_citystatezip",
+    "usecode",
+    "livingarea",
+    "condition",
+    "saleprice",
+    "saleyear",
+    "assessedlandvalue",
+    "assessedbuildingvalue",
+)
+
+
+def latest_parcel_data(parid, cursor) -> Optional[dict]:
+    """
+    Fetches the most recent owner and tax status recorded for a parcel.
+
+    Returns:
+        None if the parcel has never been updated, otherwise a JSON serializable dict.
+        Its "age" is the number of seconds since the data was last seen,
+        and "lastupdated" is when it last changed.
+    """
+    select_sql = """
+        SELECT
+            ped.ownername, ped.address_street, ped.address_citystatezip,
+            ped.usecode, ped.livingarea, ped.condition,
+            ped.saleprice, ped.saleyear,
+            ped.assessedlandvalue, ped.assessedbuildingvalue,
+            ts.year, ts.paidstatus, ts.tax, ts.penalty, ts.interest,
+            ts.total, ts.datepaid,
+            ped.lastupdated,
+            EXTRACT(EPOCH FROM now() - COALESCE(ped.lastseen, ped.lastupdated))
+        FROM public.property p
+        JOIN public.propertyexternaldata ped ON ped.property_propertyid = p.propertyid
+        LEFT JOIN public.taxstatus ts ON ts.taxstatusid = ped.taxstatus_taxstatusid
+        WHERE p.parid = %s
+        ORDER BY ped.lastupdated DESC
+        LIMIT 1;"""
+    cursor.execute(select_sql, [parid])
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    row = [_jsonable(value) for value in row]
+    return {
+        "parid": parid,
+        "owner": row[0],
+        **dict(zip(PARCEL_DATA_FIELDS, row[1:10])),
+        "taxstatus": dict(zip(TaxStatus._fields, row[10:17])),
+        "lastupdated": row[17],
+        "age": row[18],
+    }
+
+
+def page_fingerprints(parids: Iterable[str], cursor) -> Dict[str, tuple]:
+    """
+    Fetches the page fingerprints of parcels' latest propertyexternaldata rows.
+
+    Returns:
+        (extdataid, fingerprint) by parcel id, for parcels with a fingerprint
+    """
+    select_sql = """
+        SELECT DISTINCT ON (p.parid) p.parid, ped.extdataid, ped.pagefingerprint
+        FROM public.property p
+        JOIN public.propertyexternaldata ped ON ped.property_propertyid = p.propertyid
+        WHERE p.parid = ANY(%s)
+        ORDER BY p.parid, ped.lastupdated DESC;"""
+    cursor.execute(select_sql, [list(parids)])
+    return {
+        parid: (extdataid, fingerprint)
+        for parid, extdataid, fingerprint in cursor.fetchall()
+        if fingerprint is not None
+    }
+
+
+def last_tax_statuses(parids: Iterable[str], cursor) -> Dict[str, LastTaxStatus]:
+    """
+    Fetches the tax statuses of parcels' latest updates, for taxcalendar.due.
+    Only the year and paid status are read, since they're all the calendar goes by.
+
+    Returns:
+        A LastTaxStatus by parcel id, for parcels that have been updated
+    """
+    select_sql = """
+        SELECT DISTINCT ON (p.parid)
+            p.parid,
+            ts.year, ts.paidstatus,
+            COALESCE(ped.lastseen, ped.lastupdated), ped.saleprice, ped.saleyear
+        FROM public.property p
+        JOIN public.propertyexternaldata ped ON ped.property_propertyid = p.propertyid
+        LEFT JOIN public.taxstatus ts ON ts.taxstatusid = ped.taxstatus_taxstatusid
+        WHERE p.parid = ANY(%s)
+        ORDER BY p.parid, ped.lastupdated DESC;"""
+    cursor.execute(select_sql, [list(parids)])
+    statuses = {}
+    for row in cursor.fetchall():
+        seen = row[3].date() if isinstance(row[3], datetime) else row[3]
+        statuses[row[0]] = LastTaxStatus(
+            TaxStatus(*[None if v is None else str(v) for v in row[1:3]]),
+            seen,
+            _jsonable(row[4]),
+            row[5],
+        )
+    return statuses
+
+
+def _jsonable(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+def all_parids_in_muni(municdode, cursor) -> Iterator[str]:
+    """
+    Streams the parcel ids of a municipality's parcels in the database.
+    They're in byte order, which is how Python sorts them too,
+    so they can be merged with the WPRDC's (see update.missing_parids).
+    """
+    select_sql = """
+        SELECT parid FROM property
+        WHERE municipality_municode = %s
+        ORDER BY parid COLLATE "C";"""
+    # Each row is a tuple rather than the string we want, so we unpack it.
+    for row in _server_side(cursor, select_sql, [municdode]):
+        yield row[0]
+
+
+def records_in_file(file_name: str) -> Iterator[Record]:
+    """
+    Streams the records of a saved WPRDC response, parsing them one at a time,
+    so a municipality's records are never all in memory at once.
+    """
+    decoder = json.JSONDecoder(object_hook=Record.hook(share=False))
+    with open(file_name, "r", encoding="utf-8") as f:
+        text = ""
+        # Skips to the start of the records
+        while True:
+            key = text.find('"records"')
+            start = text.find("[", key) if key != -1 else -1
+            if start != -1:
+                break
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            text += chunk
+        position = start + 1
+        while True:
+            while position < len(text) and text[position] in " \t\r\n,":
+                position += 1
+            if position < len(text):
+                if text[position] == "]":
+                    return
+                try:
+                    record, position = decoder.raw_decode(text, position)
+                except json.JSONDecodeError:
+                    pass
+                else:
+                    yield record
+                    continue
+            # The next record runs past what's been read so far
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                raise ValueError("{} ends in the middle of a record".format(file_name))
+            text, position = text[position:] + chunk, 0
+
+
+class Records:
+    """
+    A municipality's records, streamed from their source each time they're iterated.
+    Its length is counted the first time it's asked for.
+    """
+
+    def __init__(self, stream: Callable[[], Iterator[Record]], count=None):
+        self._stream = stream
+        self._count = count
+
+    def __iter__(self) -> Iterator[Record]:
+        return self._stream()
+
+    def __len__(self) -> int:
+        if self._count is None:
+            self._count = sum(1 for _ in self)
+        return self._count
+
+    def __bool__(self) -> bool:
+        """ Whether there are any records, reading only the first. """
+        if self._count is not None:
+            return self._count > 0
+        records = iter(self)
+        first = next(records, None)
+        if hasattr(records, "close"):
+            records.close()
+        return first is not None
 
 
 def valid_json(file_name):
-    with open(file_name, "r") as file:
-        f = json.load(file)
-        if not (f["success"] and len(f["result"]["records"]) > 0):
-            # Check and see if it's a test municipality
-            _, tail = os.path.split(file_name)
-            if tail.startswith("COG Land"):
-                return False
-            else:
-                os.rename(file_name, file_name + "_corrupt")
-                # Note: This doesn't actually work, since we get a WinError 32
-                raise ValueError("{} not valid".format(file.name))
-        return True
-
-
-def municipality_records_from_Wprdc(muni: parse.Municipality) -> dict:
+    records = records_in_file(file_name)
+    first = next(records, None)
+    records.close()
+    if first is None:
+        # Check and see if it's a test municipality
+        _, tail = os.path.split(file_name)
+        if tail.startswith("COG Land"):
+            return False
+        else:
+            os.rename(file_name, file_name + "_corrupt")
+            # Note: This doesn't actually work, since we get a WinError 32
+            raise ValueError("{} not valid".format(file_name))
+    return True
+
+
+def municipality_records_from_Wprdc(muni: parse.Municipality) -> Records:
     """
     Args: A tuple containing a municipality's municode and name
     Returns:
+        The municipality's records, as compact Records, in parcel id order.
+        They're streamed from the saved response (or the snapshot) when iterated.
 
     Notes:
         The current implementation writes a file to the local storage.
         This implementation should be deprecated.
         Instead, it will write the WPRDC record to the CoG database.
     """
-    print("Updating {} ({})".format(muni.name, muni.municode))
-    print(MEDIUM_DASHES)
+    logger.info(
+        "Updating {}".format(muni.name),
+        extra={"municode": muni.municode, "municipality": muni.name},
+    )
+    local = _snapshot()
+    if local is not None:
+        return Records(
+            lambda: local.municipality(muni.municode), local.size(muni.municode)
+        )
     filename = _fetch_muni_data_and_write_to_file(muni)
     if not valid_json(filename):
-        print(DASHES)
         # Todo: I have not tested this change yet.
         #  Previously this returned None. Make sure this doesn't break stuff.
-        return {}
+        return Records(lambda: iter(()), 0)
+    return Records(lambda: records_in_file(filename))
 
-    with open(filename, "r") as f:
-        file = json.load(f)
-        records = file["result"]["records"]
-    return records
+
+def _snapshot() -> Optional[snapshot.Snapshot]:
+    """ The configured snapshot, opened once per process. """
+    if SNAPSHOT is None:
+        return None
+    if SNAPSHOT not in _snapshots:
+        _snapshots[SNAPSHOT] = snapshot.Snapshot(SNAPSHOT)
+    return _snapshots[SNAPSHOT]
+
+
+def _wprdc_url(where: str) -> str:
+    """ Builds a call to the WPRDC's property assessment datastore. """
+    return """{}?sql=
+    SELECT * FROM "518b583f-7cc8-4f60-94d0-174cc98310dc" {}""".format(WPRDC_URL, where)
+
+
+def validate_parid(parid: str) -> str:
+    # Parcel ids are interpolated into the WPRDC's sql
+    if not PARID_PATTERN.fullmatch(parid):
+        raise ValueError("{!r} is not a valid parcel id".format(parid))
+    return parid
 
 
 def _fetch_muni_data_and_write_to_file(muni: parse.Municipality):
@@ -141,31 +404,56 @@ def _fetch_muni_data_and_write_to_file(muni: parse.Municipality):
     rel_path = os.path.join(PARCEL_ID_LISTS, muni.name + "_parcelids.json")
     abs_path = os.path.join(script_dir, rel_path)
 
-    with open(abs_path, "w") as f:
+    with open(abs_path, "wb") as f:
         # Todo: Checkpoint to see if this broke while refactoring
-        wprdc_url = """https://data.wprdc.org/api/3/action/datastore_search_sql?sql=
-        SELECT * FROM "518b583f-7cc8-4f60-94d0-174cc98310dc"
-        WHERE "MUNICODE" = '{}'""".format(
-            muni.municode
+        wprdc_url = _wprdc_url(
+            """WHERE "MUNICODE" = '{}' ORDER BY "PARID" """.format(muni.municode)
         )
-        req = requests.get(wprdc_url)
-        try:
-            f.write(req.text)
-        except IOError as e:
-            # Todo: log_error
-            raise e
-        print("Written {}".format(abs_path))
+        # Written as it's downloaded, rather than held in memory
+        with requests.get(wprdc_url, stream=True) as req:
+            try:
+                for chunk in req.iter_content(chunk_size=CHUNK_SIZE):
+                    f.write(chunk)
+            except IOError as e:
+                # Todo: log_error
+                raise e
+        logger.debug("Written {}".format(abs_path))
     return abs_path
 
 
-def record_using_parid(parid: str) -> dict:
-    # At the moment, pyparcel can make two different calls the WPRDC API. If we ever
-    # make a 3rd, split logic for constructing the call into a separate function.
-    wprdc_url = """https://data.wprdc.org/api/3/action/datastore_search_sql?sql=
-    SELECT * FROM "518b583f-7cc8-4f60-94d0-174cc98310dc" WHERE "PARID" = '{}'""".format(
-        parid
-    )
+def record_using_parid(parid: str) -> Record:
+    local = _snapshot()
+    if local is not None:
+        record = local.get(validate_parid(parid))
+        if record is None:
+            # As indexing the WPRDC's empty list of records would
+            raise IndexError("{} is not in the snapshot".format(parid))
+        return record
+    wprdc_url = _wprdc_url("""WHERE "PARID" = '{}'""".format(validate_parid(parid)))
     req = requests.get(wprdc_url)
-    response = json.loads(req.text)
-    records = response["records"]
+    response = json.loads(req.text, object_hook=Record.hook())
+    records = response["result"]["records"]
     return records[0]
+
+
+def records_using_parids(parids: Iterable[str], chunk_size=200) -> Dict[str, Record]:
+    """
+    Fetches many parcels' records with a handful of calls to the WPRDC.
+
+    Returns:
+        The records of the parcels the WPRDC knows about, by parcel id
+    """
+    parids = [validate_parid(parid) for parid in parids]
+    local = _snapshot()
+    if local is not None:
+        found = ((parid, local.get(parid)) for parid in parids)
+        return {parid: record for parid, record in found if record is not None}
+    records = {}
+    hook = Record.hook()
+    for i in range(0, len(parids), chunk_size):
+        chunk = ", ".join("'{}'".format(parid) for parid in parids[i : i + chunk_size])
+        req = requests.get(_wprdc_url("""WHERE "PARID" IN ({})""".format(chunk)))
+        response = json.loads(req.text, object_hook=hook)
+        for record in response["result"]["records"]:
+            records[record["PARID"]] = record
+    return records
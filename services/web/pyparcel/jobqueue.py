@@ -0,0 +1,495 @@
+"""
+A work queue kept in Postgres, so parcel updates can be spread across machines.
+
+Work items are rows of pyparcel_job.
+A worker claims an item with SELECT ... FOR UPDATE SKIP LOCKED,
+so any number of workers can poll the table without claiming the same item twice.
+A claimed item is leased to its worker. The worker's heartbeat extends the lease;
+if the worker dies, the lease runs out and another worker picks the item up.
+Failed items are retried with exponential backoff until they run out of attempts,
+at which point they are dead-lettered (status 'dead') for a human to look at.
+Failures retrying can't fix, such as a parcel whose page disagrees with the WPRDC,
+are dead-lettered straight away.
+A municipality item keeps its progress in its row, saved with each heartbeat,
+so a retry resumes from its last batch whichever machine claims it.
+
+The table is created by `python manage.py migrate`. Start workers with
+    python -m pyparcel.jobqueue --processes 4 [--commit]
+"""
+import argparse
+import copy
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import traceback
+from collections import namedtuple
+from multiprocessing import Process
+from typing import Iterable, List, Optional
+
+import psycopg2
+from psycopg2.extras import Json
+
+import pyparcel.checkpoint as checkpoint
+import pyparcel.failures as failures
+import pyparcel.fetch as fetch
+import pyparcel.log as log
+import pyparcel.metrics as metrics
+import pyparcel.run as run
+import pyparcel.update as update
+from pyparcel.common import DB_URI
+
+logger = logging.getLogger(__name__)
+
+PARCEL = "parcel"
+MUNICIPALITY = "municipality"
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+DEAD = "dead"
+
+DEFAULT_LEASE = 300  # seconds
+DEFAULT_MAX_ATTEMPTS = 5
+BACKOFF_BASE = 30  # seconds
+BACKOFF_MAX = 3600  # seconds
+
+Job = namedtuple(
+    "Job",
+    ["jobid", "kind", "target", "options", "attempts", "maxattempts", "progress"],
+    defaults=[None],
+)
+
+CREATE_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS public.pyparcel_job(
+        jobid serial PRIMARY KEY,
+        kind text NOT NULL CHECK (kind IN ('parcel', 'municipality')),
+        target text NOT NULL,
+        options jsonb NOT NULL DEFAULT '{}',
+        status text NOT NULL DEFAULT 'pending'
+            CHECK (status IN ('pending', 'running', 'done', 'dead')),
+        attempts integer NOT NULL DEFAULT 0,
+        maxattempts integer NOT NULL DEFAULT 5,
+        availableat timestamp with time zone NOT NULL DEFAULT now(),
+        leaseduntil timestamp with time zone,
+        worker text,
+        heartbeat timestamp with time zone,
+        lasterror text,
+        progress jsonb,
+        creationts timestamp with time zone NOT NULL DEFAULT now(),
+        lastupdatedts timestamp with time zone NOT NULL DEFAULT now()
+    );
+    -- Tables created before progress was kept in the row
+    ALTER TABLE public.pyparcel_job ADD COLUMN IF NOT EXISTS progress jsonb;
+    CREATE INDEX IF NOT EXISTS pyparcel_job_claim_idx
+        ON public.pyparcel_job (status, availableat);
+    -- A target can only be queued once at a time
+    CREATE UNIQUE INDEX IF NOT EXISTS pyparcel_job_active_idx
+        ON public.pyparcel_job (kind, target)
+        WHERE status IN ('pending', 'running');
+"""
+
+
+def create_table(cursor):
+    cursor.execute(CREATE_TABLE_SQL)
+
+
+def enqueue(
+    cursor,
+    kind: str,
+    targets: Iterable[str],
+    options: Optional[dict] = None,
+    max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+) -> int:
+    """
+    Adds work items to the queue. Targets that are already queued are skipped.
+
+    Args:
+        kind: PARCEL (targets are parcel ids) or MUNICIPALITY (targets are municodes)
+        targets: What to update
+        options:
+            For municipalities, which passes to run.
+            Example: {"each": True, "diff": True}
+        max_attempts: How many times an item is tried before it is dead-lettered
+
+    Returns:
+        The number of items added
+    """
+    if kind not in (PARCEL, MUNICIPALITY):
+        raise ValueError("kind must be either 'parcel' or 'municipality'")
+    insert_sql = """
+        INSERT INTO public.pyparcel_job(kind, target, options, maxattempts)
+        VALUES(%(kind)s, %(target)s, %(options)s, %(maxattempts)s)
+        ON CONFLICT (kind, target) WHERE status IN ('pending', 'running')
+        DO NOTHING;
+    """
+    added = 0
+    for target in targets:
+        cursor.execute(
+            insert_sql,
+            {
+                "kind": kind,
+                "target": str(target),
+                "options": json.dumps(options or {}),
+                "maxattempts": max_attempts,
+            },
+        )
+        added += cursor.rowcount
+    return added
+
+
+def claim(cursor, worker: str, lease: int = DEFAULT_LEASE) -> Optional[Job]:
+    """
+    Leases the next available item to the worker.
+    Items whose lease ran out (because their worker died) are available again.
+
+    Returns:
+        The claimed Job, or None if there is nothing to do
+    """
+    update_sql = """
+        UPDATE public.pyparcel_job
+        SET status = 'running', attempts = attempts + 1, worker = %(worker)s,
+            leaseduntil = now() + %(lease)s * interval '1 second',
+            heartbeat = now(), lastupdatedts = now()
+        WHERE jobid = (
+            SELECT jobid FROM public.pyparcel_job
+            WHERE (status = 'pending' AND availableat <= now())
+               OR (status = 'running' AND leaseduntil < now())
+            ORDER BY availableat, jobid
+            FOR UPDATE SKIP LOCKED
+            LIMIT 1
+        )
+        RETURNING jobid, kind, target, options, attempts, maxattempts, progress;
+    """
+    cursor.execute(update_sql, {"worker": worker, "lease": lease})
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return Job(*row)
+
+
+def heartbeat(
+    cursor,
+    job: Job,
+    worker: str,
+    lease: int = DEFAULT_LEASE,
+    progress: Optional[dict] = None,
+) -> bool:
+    """
+    Extends the lease on a job.
+
+    Args:
+        progress: The job's progress so far, if it keeps any
+
+    Returns:
+        False if the job is no longer leased to this worker
+    """
+    update_sql = """
+        UPDATE public.pyparcel_job
+        SET heartbeat = now(), leaseduntil = now() + %(lease)s * interval '1 second',
+            progress = COALESCE(%(progress)s, progress)
+        WHERE jobid = %(jobid)s AND worker = %(worker)s AND status = 'running';
+    """
+    cursor.execute(
+        update_sql,
+        {
+            "jobid": job.jobid,
+            "worker": worker,
+            "lease": lease,
+            "progress": None if progress is None else Json(progress),
+        },
+    )
+    return cursor.rowcount == 1
+
+
+def complete(cursor, job: Job, worker: str) -> bool:
+    """
+    Marks a job done.
+
+    Returns:
+        False if the job is no longer leased to this worker, so it was left alone
+    """
+    update_sql = """
+        UPDATE public.pyparcel_job
+        SET status = 'done', leaseduntil = NULL, progress = NULL,
+            lastupdatedts = now()
+        WHERE jobid = %(jobid)s AND worker = %(worker)s AND status = 'running';
+    """
+    cursor.execute(update_sql, {"jobid": job.jobid, "worker": worker})
+    return cursor.rowcount == 1
+
+
+def backoff(attempts: int) -> int:
+    """ Seconds to wait before retrying an item that has failed `attempts` times. """
+    return min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX)
+
+
+def fail(
+    cursor,
+    job: Job,
+    worker: str,
+    error: str,
+    permanent: bool = False,
+    progress: Optional[dict] = None,
+) -> bool:
+    """
+    Schedules the job to be retried, or dead-letters it if it's out of attempts.
+
+    Args:
+        permanent: Whether retrying can't help, so the job is dead-lettered now
+        progress: The job's progress when it failed, for the retry to resume from
+
+    Returns:
+        False if the job is no longer leased to this worker, so it was left alone
+    """
+    update_sql = """
+        UPDATE public.pyparcel_job
+        SET status = %(status)s, lasterror = %(error)s, leaseduntil = NULL,
+            availableat = now() + %(delay)s * interval '1 second',
+            progress = COALESCE(%(progress)s, progress),
+            lastupdatedts = now()
+        WHERE jobid = %(jobid)s AND worker = %(worker)s AND status = 'running';
+    """
+    status = DEAD if permanent or job.attempts >= job.maxattempts else PENDING
+    cursor.execute(
+        update_sql,
+        {
+            "jobid": job.jobid,
+            "worker": worker,
+            "status": status,
+            "error": error,
+            "delay": backoff(job.attempts),
+            "progress": None if progress is None else Json(progress),
+        },
+    )
+    if cursor.rowcount != 1:
+        return False
+    if status == PENDING:
+        metrics.RETRIES.inc(kind=job.kind)
+    return True
+
+
+def dead_letters(cursor) -> List[tuple]:
+    select_sql = """
+        SELECT jobid, kind, target, attempts, lasterror, lastupdatedts
+        FROM public.pyparcel_job
+        WHERE status = 'dead'
+        ORDER BY lastupdatedts DESC;
+    """
+    cursor.execute(select_sql)
+    return cursor.fetchall()
+
+
+class Progress(checkpoint.Checkpoint):
+    """
+    The checkpoint of a municipality job, kept in the job's row instead of a file,
+    since a retry may be claimed by a worker on another machine.
+
+    Marks are kept in memory, and saved by the job's heartbeat and when it fails.
+    A worker that dies redoes at most the batches since its last heartbeat.
+    """
+
+    def __init__(self, state: Optional[dict] = None):
+        self._state = copy.deepcopy(state or {})
+        self._lock = threading.Lock()
+
+    def _read(self, municode) -> dict:
+        with self._lock:
+            state = self._state.get(str(municode))
+            return copy.deepcopy(state) if state else checkpoint.empty_state()
+
+    def _write(self, municode, state: dict):
+        with self._lock:
+            self._state[str(municode)] = copy.deepcopy(state)
+
+    def state(self) -> dict:
+        """ A copy of the progress, safe to save while the job goes on. """
+        with self._lock:
+            return copy.deepcopy(self._state)
+
+    def clear(self):
+        with self._lock:
+            self._state = {}
+
+
+class _Heartbeat(threading.Thread):
+    """ Extends a job's lease, and saves its progress, until stopped. """
+
+    def __init__(
+        self, conn, job: Job, worker: str, lease: int, progress: Optional[Progress]
+    ):
+        super().__init__(name="pyparcel-heartbeat", daemon=True)
+        self.conn = conn
+        self.job = job
+        self.worker = worker
+        self.lease = lease
+        self.progress = progress
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.lease / 3):
+            state = None if self.progress is None else self.progress.state()
+            with self.conn.cursor() as cursor:
+                if not heartbeat(cursor, self.job, self.worker, self.lease, state):
+                    logger.warning(
+                        "Worker {} lost the lease on job {}".format(
+                            self.worker, self.job.jobid
+                        ),
+                        extra={"worker": self.worker, "job": self.job.jobid},
+                    )
+                    return
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def _do(job: Job, conn, commit: bool, progress: Optional[Progress] = None):
+    """ Runs a single work item on the work connection. """
+    with conn.cursor() as cursor:
+        if job.kind == PARCEL:
+            update.parcel(conn, cursor, commit, parid=job.target)
+        else:
+            muni = fetch.muniname_given_municode(job.target, cursor)
+            run._update_municipality(
+                conn,
+                cursor,
+                muni,
+                commit,
+                each=job.options.get("each", True),
+                diff=job.options.get("diff", False),
+                fetch_workers=job.options.get("fetch_workers", 1),
+                parse_workers=0,
+                queue_size=job.options.get("queue_size", 64),
+                checkpoint=progress if progress is not None else Progress(),
+                batch_size=job.options.get(
+                    "batch_size", checkpoint.DEFAULT_BATCH_SIZE
+                ),
+            )
+    if commit:
+        conn.commit()
+    else:
+        conn.rollback()
+
+
+def work(
+    worker: Optional[str] = None,
+    commit: bool = False,
+    lease: int = DEFAULT_LEASE,
+    poll_interval: float = 5,
+    max_jobs: Optional[int] = None,
+    stop_when_empty: bool = False,
+) -> int:
+    """
+    Claims and runs work items until told to stop.
+
+    Args:
+        worker: A name unique to this worker. Defaults to <hostname>:<pid>
+        commit: Whether the updates should be committed to the database
+        lease: Seconds a claimed item is leased for between heartbeats
+        poll_interval: Seconds to wait when the queue is empty
+        max_jobs: Stop after this many items
+        stop_when_empty: Stop instead of waiting when the queue is empty
+
+    Returns:
+        The number of items this worker ran, successful or not
+    """
+    worker = worker or "{}:{}".format(socket.gethostname(), os.getpid())
+    ran = 0
+    # Queue bookkeeping is committed immediately and independently of the work,
+    # which may be rolled back.
+    with psycopg2.connect(DB_URI) as queue_conn, psycopg2.connect(DB_URI) as work_conn:
+        queue_conn.autocommit = True
+        while max_jobs is None or ran < max_jobs:
+            with queue_conn.cursor() as cursor:
+                job = claim(cursor, worker, lease)
+            if job is None:
+                if stop_when_empty:
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            if job.attempts > job.maxattempts:
+                # The worker holding its last attempt died
+                with queue_conn.cursor() as cursor:
+                    fail(cursor, job, worker, "Lease expired on the final attempt")
+                continue
+
+            logger.info(
+                "Worker {} claimed {} {} (attempt {} of {})".format(
+                    worker, job.kind, job.target, job.attempts, job.maxattempts
+                ),
+                extra={"worker": worker, "job": job.jobid},
+            )
+            progress = Progress(job.progress) if job.kind == MUNICIPALITY else None
+            beat = _Heartbeat(queue_conn, job, worker, lease, progress)
+            beat.start()
+            try:
+                _do(job, work_conn, commit, progress)
+            except Exception as e:
+                work_conn.rollback()
+                error = traceback.format_exc(limit=4)
+                permanent = failures.permanent(e)
+                logger.error(
+                    "Job {} failed{}".format(
+                        job.jobid, " permanently" if permanent else ""
+                    ),
+                    extra={"worker": worker, "job": job.jobid, "error": error},
+                )
+                with queue_conn.cursor() as cursor:
+                    kept = fail(
+                        cursor,
+                        job,
+                        worker,
+                        error,
+                        permanent=permanent,
+                        progress=None if progress is None else progress.state(),
+                    )
+            else:
+                with queue_conn.cursor() as cursor:
+                    kept = complete(cursor, job, worker)
+            finally:
+                beat.stop()
+                ran += 1
+            if not kept:
+                # Another worker claimed it after the lease ran out, and owns it now
+                logger.warning(
+                    "Worker {} lost the lease on job {} before finishing it".format(
+                        worker, job.jobid
+                    ),
+                    extra={"worker": worker, "job": job.jobid},
+                )
+    return ran
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs pyparcel queue workers.")
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--commit", action="store_true")
+    parser.add_argument("--lease", type=int, default=DEFAULT_LEASE)
+    parser.add_argument("--poll-interval", type=float, default=5)
+    parser.add_argument(
+        "--stop-when-empty", action="store_true", help="Exit once the queue is empty"
+    )
+    args = parser.parse_args()
+    log.configure()
+    kwargs = {
+        "commit": args.commit,
+        "lease": args.lease,
+        "poll_interval": args.poll_interval,
+        "stop_when_empty": args.stop_when_empty,
+    }
+    if args.processes == 1:
+        work(**kwargs)
+        return
+    processes = [Process(target=work, kwargs=kwargs) for _ in range(args.processes)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+
+
+if __name__ == "__main__":
+    main()
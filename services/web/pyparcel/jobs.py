@@ -0,0 +1,205 @@
+"""
+Runs run.pyparcel in the background on behalf of the API.
+
+A municipality can take hours to update, far longer than a gunicorn worker
+or nginx will wait on a request. The API instead submits a Job and returns its id.
+The job runs on a background thread, where its counters are updated live,
+and it can be cancelled between parcels.
+Its progress (parcels, municipalities, and events) can be followed as a stream.
+"""
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import pyparcel.events as events
+import pyparcel.run as run
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+FINISHED = (SUCCEEDED, FAILED, CANCELLED)
+
+# How many finished jobs are remembered
+KEEP_FINISHED = 100
+# How many updates a job keeps for followers of its stream
+KEEP_UPDATES = 10000
+
+
+def _isoformat(timestamp: Optional[float]) -> Optional[str]:
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
+
+
+class Job:
+    def __init__(self, params: dict):
+        self.id = uuid.uuid4().hex
+        self.params = params
+        self.status = QUEUED
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.counters = {}
+        # The number of parcels in the municipalities started so far
+        self.expected = 0
+        self.result = None
+        self.cancel_event = threading.Event()
+        # Guards the attributes above and wakes up anyone following the job's updates
+        self._changed = threading.Condition()
+        self._updates = deque(maxlen=KEEP_UPDATES)
+        self._seq = 0
+
+    def publish(self, update: dict):
+        """ Adds an update to the job's stream. """
+        with self._changed:
+            self._seq += 1
+            self._updates.append({"seq": self._seq, "time": time.time(), **update})
+            self._changed.notify_all()
+
+    def _rates(self) -> dict:
+        processed = self.counters.get("processed", 0)
+        elapsed = time.time() - self.started
+        throughput = processed / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if throughput > 0 and self.expected > processed:
+            eta = (self.expected - processed) / throughput
+        return {"throughput": throughput, "eta": eta}
+
+    def on_progress(self, update: dict):
+        """ The progress callback handed to run.pyparcel. """
+        with self._changed:
+            self.counters = update["counts"]
+            if update["type"] == "municipality":
+                self.expected += update["parcels"]
+            rates = self._rates()
+        self.publish({**update, **rates})
+
+    def on_event(self, event: dict):
+        """ Listens for the events its run writes to the database. See events.publish.
+        """
+        self.publish({"type": "event", **event})
+
+    def updates(self, after: int = 0, keepalive: float = 15):
+        """
+        Yields the job's updates from after the `after`th, as they're published,
+        until the job finishes. Updates older than the last KEEP_UPDATES are lost.
+
+        Yields None if nothing was published for `keepalive` seconds,
+        so the caller can keep its connection alive.
+        """
+        while True:
+            with self._changed:
+                pending = [u for u in self._updates if u["seq"] > after]
+                if not pending and self.status not in FINISHED:
+                    self._changed.wait(keepalive)
+                    pending = [u for u in self._updates if u["seq"] > after]
+                finished = self.status in FINISHED
+            if not pending:
+                if finished:
+                    return
+                yield None
+            for update in pending:
+                after = update["seq"]
+                yield update
+
+    def run(self):
+        if self.cancel_event.is_set():
+            self._finish(CANCELLED)
+            return
+        self.status = RUNNING
+        self.started = time.time()
+        events.add_listener(self.on_event)
+        try:
+            self.result = run.pyparcel(
+                **self.params, progress=self.on_progress, cancel=self.cancel_event
+            )
+        finally:
+            events.remove_listener(self.on_event)
+            self._finish(self._final_status())
+
+    def _finish(self, status: str):
+        self.finished = time.time()
+        # Published before the status changes, so followers see it before stopping
+        self.publish({"type": "finished", "status": status, "result": self.result})
+        with self._changed:
+            self.status = status
+            self._changed.notify_all()
+
+    def _final_status(self) -> str:
+        if self.result is None:  # run.pyparcel itself raised
+            return FAILED
+        if self.result.get("cancelled"):
+            return CANCELLED
+        if self.result.get("success"):
+            return SUCCEEDED
+        return FAILED
+
+    def as_dict(self) -> dict:
+        with self._changed:
+            counters = dict(self.counters)
+        return {
+            "id": self.id,
+            "status": self.status,
+            "params": self.params,
+            "created": _isoformat(self.created),
+            "started": _isoformat(self.started),
+            "finished": _isoformat(self.finished),
+            "counters": counters,
+            "result": self.result,
+        }
+
+
+class JobManager:
+    """
+    Jobs run one at a time by default.
+    Concurrent jobs keep their own counts, timings and events, since each runs in
+    its own context (see metrics.Scope), but a process only profiles or traces one
+    run at a time: concurrent jobs that profile or trace mix into each other's.
+    Jobs with the same arguments also share a checkpoint (see checkpoint.py),
+    and each job starts its own parse processes.
+    """
+
+    def __init__(self, max_workers: int = 1):
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="pyparcel-job"
+        )
+        self._jobs: Dict[str, Job] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, params: dict) -> Job:
+        job = Job(params)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._prune()
+        self._executor.submit(job.run)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self) -> List[Job]:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        """
+        Asks a job to stop. A queued job never starts;
+        a running job stops after the parcel it is working on.
+        """
+        job = self.get(job_id)
+        if job is not None:
+            job.cancel_event.set()
+        return job
+
+    def _prune(self):
+        finished = [j for j in self._jobs.values() if j.status in FINISHED]
+        for job in finished[: max(0, len(finished) - KEEP_FINISHED)]:
+            del self._jobs[job.id]
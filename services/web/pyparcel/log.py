@@ -0,0 +1,234 @@
+"""
+Logging for pyparcel, as JSON lines on stdout.
+
+Modules log through the standard library: logging.getLogger(__name__).
+configure() sets the "pyparcel" logger up for production:
+    - Each record is a single JSON object. Anything passed as `extra` becomes a key.
+    - Records are buffered and written in batches instead of one write per line,
+      flushed when the buffer fills, every few seconds, or on an error.
+    - Lines logged once per parcel (with extra={"sample": True}) are sampled,
+      since a municipality produces tens of thousands of them.
+A Throughput thread logs a summary of a run's progress at a fixed interval,
+which takes the place of the per-parcel counts.
+
+Configured with the environment variables
+    PYPARCEL_LOG_LEVEL: Defaults to INFO
+    PYPARCEL_LOG_SAMPLE: The fraction of per-parcel lines kept. Defaults to 0.01
+    PYPARCEL_LOG_BUFFER: The number of records buffered. Defaults to 200
+"""
+import itertools
+import json
+import logging
+import logging.handlers
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Callable, Optional
+
+LOGGER = "pyparcel"
+
+DEFAULT_LEVEL = os.environ.get("PYPARCEL_LOG_LEVEL", "INFO")
+DEFAULT_SAMPLE = float(os.environ.get("PYPARCEL_LOG_SAMPLE", 0.01))
+DEFAULT_BUFFER = int(os.environ.get("PYPARCEL_LOG_BUFFER", 200))
+FLUSH_INTERVAL = 5  # seconds
+THROUGHPUT_INTERVAL = 30  # seconds
+
+# The attributes every LogRecord has. Any others were passed as `extra`.
+_STANDARD = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        line = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD and key != "sample":
+                line[key] = value
+        if record.exc_info:
+            line["exception"] = self.formatException(record.exc_info)
+        return json.dumps(line, default=str)
+
+
+class SampleFilter(logging.Filter):
+    """ Keeps one in every 1 / rate records logged with extra={"sample": True}. """
+
+    def __init__(self, rate: float = DEFAULT_SAMPLE):
+        super().__init__()
+        self.every = max(1, round(1 / rate)) if rate > 0 else None
+        self._count = itertools.count()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, "sample", False):
+            return True
+        if self.every is None:
+            return False
+        return next(self._count) % self.every == 0
+
+
+class BufferedHandler(logging.handlers.MemoryHandler):
+    """
+    A MemoryHandler that also flushes once its oldest record is FLUSH_INTERVAL
+    seconds old, so a quiet run's lines aren't held back indefinitely.
+    A timer thread checks, since a quiet run may not log again for a while.
+    """
+
+    def __init__(
+        self,
+        capacity: int,
+        target: logging.Handler,
+        interval: float = FLUSH_INTERVAL,
+    ):
+        super().__init__(capacity, flushLevel=logging.ERROR, target=target)
+        self.interval = interval
+        self._oldest = None
+        self._timer = None
+        self._stop_flush = threading.Event()
+
+    def emit(self, record):
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+        # Started on first use, and again in a forked process, which has no threads
+        if self._timer is None or not self._timer.is_alive():
+            self._timer = threading.Thread(
+                target=self._flush_when_old, name="pyparcel-log-flush", daemon=True
+            )
+            self._timer.start()
+        super().emit(record)
+
+    def _old(self) -> bool:
+        return (
+            self._oldest is not None
+            and time.monotonic() - self._oldest >= self.interval
+        )
+
+    def _flush_when_old(self):
+        while not self._stop_flush.wait(self.interval / 5):
+            with self.lock:
+                if self._old():
+                    self.flush()
+
+    def shouldFlush(self, record) -> bool:
+        return super().shouldFlush(record) or self._old()
+
+    def flush(self):
+        with self.lock:
+            super().flush()
+            self._oldest = None
+
+    def close(self):
+        # Called again by logging.shutdown at exit
+        self._stop_flush.set()
+        timer = self._timer
+        if timer is not None and timer is not threading.current_thread():
+            timer.join()
+        super().close()
+
+
+class _Stdout(logging.StreamHandler):
+    """ Writes to whatever sys.stdout is when a record is written, as print does. """
+
+    def __init__(self):
+        super().__init__()
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+
+def configure(
+    level: str = DEFAULT_LEVEL,
+    sample: float = DEFAULT_SAMPLE,
+    buffer: int = DEFAULT_BUFFER,
+    stream=None,
+) -> logging.Logger:
+    """
+    Sets up the "pyparcel" logger. Does nothing if it already has a handler,
+    so it's safe to call from every entry point.
+    """
+    logger = logging.getLogger(LOGGER)
+    if logger.handlers:
+        return logger
+    target = logging.StreamHandler(stream) if stream else _Stdout()
+    target.setFormatter(JsonFormatter())
+    handler = BufferedHandler(buffer, target)
+    handler.addFilter(SampleFilter(sample))
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    # Records don't also go to the root logger's handlers
+    logger.propagate = False
+    return logger
+
+
+def flush():
+    for handler in logging.getLogger(LOGGER).handlers:
+        handler.flush()
+
+
+def reset():
+    """
+    Drops records a forked process inherited from its parent's buffer,
+    so they aren't written twice.
+    """
+    for handler in logging.getLogger(LOGGER).handlers:
+        if isinstance(handler, BufferedHandler):
+            with handler.lock:
+                handler.buffer = []
+                handler._oldest = None
+
+
+class Throughput(threading.Thread):
+    """
+    Logs a run's counts, and the rate parcels are being processed at,
+    every `interval` seconds until stopped.
+    """
+
+    def __init__(
+        self,
+        counts: Callable[[], dict],
+        interval: float = THROUGHPUT_INTERVAL,
+        logger: Optional[logging.Logger] = None,
+    ):
+        super().__init__(name="pyparcel-throughput", daemon=True)
+        self.counts = counts
+        self.interval = interval
+        self.logger = logger or logging.getLogger(LOGGER)
+        self.stopped = threading.Event()
+        self._start = time.monotonic()
+        self._last = (self._start, 0)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.summarize("Throughput")
+
+    def summarize(self, message: str):
+        counts = self.counts()
+        now = time.monotonic()
+        last_time, last_processed = self._last
+        self._last = (now, counts["processed"])
+        elapsed = now - self._start
+        self.logger.info(
+            message,
+            extra={
+                **counts,
+                "elapsed": round(elapsed, 1),
+                "rate": round(
+                    (counts["processed"] - last_processed) / max(now - last_time, 1e-9),
+                    2,
+                ),
+                "average rate": round(counts["processed"] / max(elapsed, 1e-9), 2),
+            },
+        )
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
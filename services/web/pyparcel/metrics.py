@@ -0,0 +1,344 @@
+"""
+Counters and histograms describing what pyparcel has done, for graphing over time.
+
+Metrics live in a process-wide registry and are safe to update from any thread.
+Runs share the registry (the API can run several jobs at once), so a run counts
+its own work in a Scope as well. Whatever is added to a metric is also added to
+every Scope active in the current context (see contextvars). Threads started
+on a run's behalf are started in a copy of its context, so they count towards it.
+
+Other processes have registries of their own. Snapshots are plain dictionaries,
+so a worker process returns what its Scope counted and its parent merges it in
+(see run._fan_out). Timings taken in another process are returned alongside
+the work and observed by the parent (see pipeline._parse).
+
+The registry is rendered in Prometheus' text format by the API's /metrics endpoint.
+"""
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Sequence, Tuple
+
+# Seconds. Spans a fast page parse through a slow portal response.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# A metric's values, keyed by the values of its labels
+Values = Dict[Tuple[str, ...], List[float]]
+
+_scopes = contextvars.ContextVar("pyparcel_metrics_scopes", default=())
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                "{} takes the labels {}".format(self.name, list(self.labelnames))
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _empty(self) -> List[float]:
+        raise NotImplementedError
+
+    def _add(self, key: Tuple[str, ...], values: Sequence[float]):
+        with self._lock:
+            _accumulate(self._values, key, values, self._empty)
+        for scope in _scopes.get():
+            scope._add(self, key, values)
+
+    def snapshot(self) -> Values:
+        with self._lock:
+            return {key: list(values) for key, values in self._values.items()}
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def _labels(self, key: Tuple[str, ...], **extra) -> str:
+        pairs = list(zip(self.labelnames, key)) + list(extra.items())
+        if not pairs:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(k, _escape(v)) for k, v in pairs) + "}"
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _empty(self):
+        return [0.0]
+
+    def inc(self, amount: float = 1, **labels):
+        self._add(self._key(labels), [amount])
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), [0.0])[0]
+
+    def render(self):
+        lines = []
+        for key, (value,) in sorted(self.snapshot().items()):
+            lines.append("{}{} {}".format(self.name, self._labels(key), _number(value)))
+        return lines
+
+
+class Histogram(_Metric):
+    """
+    Stores a count per bucket (the last bucket is +Inf), followed by the sum.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _empty(self):
+        return [0.0] * (len(self.buckets) + 2)
+
+    def observe(self, value: float, **labels):
+        values = self._empty()
+        bucket = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                bucket = i
+                break
+        values[bucket] = 1
+        values[-1] = value
+        self._add(self._key(labels), values)
+
+    @contextmanager
+    def time(self, **labels):
+        """ Observes how long the body of the with statement took. """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> float:
+        with self._lock:
+            return sum(self._values.get(self._key(labels), [0.0])[:-1])
+
+    def render(self):
+        lines = []
+        for key, values in sorted(self.snapshot().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values[:-1]):
+                cumulative += count
+                labels = self._labels(key, le=_number(bound))
+                lines.append(
+                    "{}_bucket{} {}".format(self.name, labels, _number(cumulative))
+                )
+            labels = self._labels(key)
+            lines.append("{}_sum{} {}".format(self.name, labels, _number(values[-1])))
+            lines.append("{}_count{} {}".format(self.name, labels, _number(cumulative)))
+        return lines
+
+
+def _accumulate(into: Values, key, values: Sequence[float], empty):
+    current = into.setdefault(key, empty())
+    for i, value in enumerate(values):
+        current[i] += value
+
+
+class Scope:
+    """
+    Counts what's added to every metric while active, such as by a single run:
+
+        with metrics.Scope() as scope:
+            ...
+        metrics.counts(scope.snapshot())
+    """
+
+    def __init__(self):
+        self._values: Dict[str, Values] = {}
+        self._lock = threading.Lock()
+        self._token = None
+
+    def start(self):
+        self._token = _scopes.set(_scopes.get() + (self,))
+
+    def stop(self):
+        _scopes.reset(self._token)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _add(self, metric: _Metric, key: Tuple[str, ...], values: Sequence[float]):
+        with self._lock:
+            _accumulate(
+                self._values.setdefault(metric.name, {}), key, values, metric._empty
+            )
+
+    def snapshot(self) -> Dict[str, Values]:
+        """ What was counted, in the form of Registry.snapshot. """
+        with self._lock:
+            return {
+                name: {key: list(v) for key, v in values.items()}
+                for name, values in self._values.items()
+            }
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value) -> str:
+    if isinstance(value, str):
+        return value
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError("{} is already registered".format(metric.name))
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def snapshot(self) -> Dict[str, Values]:
+        return {name: metric.snapshot() for name, metric in self._metrics.items()}
+
+    def difference(self, before: Dict[str, Values]) -> Dict[str, Values]:
+        """ What was added to the registry since `before` was snapshotted. """
+        difference = {}
+        for name, values in self.snapshot().items():
+            earlier = before.get(name, {})
+            difference[name] = {}
+            for key, current in values.items():
+                previous = earlier.get(key, [0.0] * len(current))
+                difference[name][key] = [c - p for c, p in zip(current, previous)]
+        return difference
+
+    def merge(self, snapshot: Dict[str, Values]):
+        """ Adds what another process counted (a difference or a Scope's snapshot).
+        Active scopes count it too.
+        """
+        for name, values in snapshot.items():
+            metric = self._metrics[name]
+            for key, added in values.items():
+                metric._add(key, added)
+
+    def reset(self):
+        """ Zeroes every metric. For tests; Prometheus expects counters not to go down.
+        """
+        for metric in self._metrics.values():
+            metric.reset()
+
+    def render(self) -> str:
+        """ The registry in Prometheus' text exposition format. """
+        lines = []
+        for metric in self._metrics.values():
+            lines.append("# HELP {} {}".format(metric.name, metric.documentation))
+            lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+PARCELS_PROCESSED = REGISTRY.counter(
+    "pyparcel_parcels_processed_total", "Parcels written to the database."
+)
+PARCELS_INSERTED = REGISTRY.counter(
+    "pyparcel_parcels_inserted_total", "Parcels that were new to the database."
+)
+PARCELS_UPDATED = REGISTRY.counter(
+    "pyparcel_parcels_updated_total", "Parcels whose data changed, creating events."
+)
+PARCELS_UNCHANGED = REGISTRY.counter(
+    "pyparcel_parcels_unchanged_total",
+    "Parcels whose data was the same as last time, so nothing new was written.",
+)
+PARCELS_SKIPPED = REGISTRY.counter(
+    "pyparcel_parcels_skipped_total",
+    "Parcels not scraped, since their tax status couldn't have changed.",
+)
+MUNICIPALITIES = REGISTRY.counter(
+    "pyparcel_municipalities_total", "Municipalities updated."
+)
+DIFF_PARCELS = REGISTRY.counter(
+    "pyparcel_diff_parcels_total",
+    "Parcels in the database that were missing from the WPRDC's data.",
+)
+PARCELS_FAILED = REGISTRY.counter(
+    "pyparcel_parcels_failed_total",
+    "Parcels quarantined, since they failed for good. See failures.py.",
+    ["category"],
+)
+AUDITED_PARCELS = REGISTRY.counter(
+    "pyparcel_audited_parcels_total",
+    "Sampled parcels whose WPRDC data was compared to the Real Estate Portal's.",
+)
+AUDIT_MISMATCHES = REGISTRY.counter(
+    "pyparcel_audit_mismatches_total",
+    "Audited parcels whose WPRDC data didn't match the Real Estate Portal's.",
+)
+EVENTS = REGISTRY.counter(
+    "pyparcel_events_total", "Events written to the database.", ["category"]
+)
+RETRIES = REGISTRY.counter(
+    "pyparcel_retries_total", "Failed work items scheduled to be tried again.", ["kind"]
+)
+SCRAPE_SECONDS = REGISTRY.histogram(
+    "pyparcel_scrape_seconds",
+    "Time taken to scrape a parcel's Real Estate Portal page.",
+)
+PARSE_SECONDS = REGISTRY.histogram(
+    "pyparcel_parse_seconds", "Time taken to parse a parcel's Real Estate Portal page."
+)
+DB_SECONDS = REGISTRY.histogram(
+    "pyparcel_db_seconds", "Time taken to write a parcel to the database."
+)
+
+
+def counts(snapshot: Dict[str, Values]) -> Dict[str, int]:
+    """
+    The headline numbers of a snapshot, such as what a run's Scope counted.
+    Keys:
+        "processed", "inserted", "updated", "unchanged", "skipped", "municipalities",
+        "diffs", "audited", "mismatches", "failed"
+    """
+
+    def total(metric):
+        return int(sum(v[0] for v in snapshot.get(metric.name, {}).values()))
+
+    return {
+        "processed": total(PARCELS_PROCESSED),
+        "inserted": total(PARCELS_INSERTED),
+        "updated": total(PARCELS_UPDATED),
+        "unchanged": total(PARCELS_UNCHANGED),
+        "skipped": total(PARCELS_SKIPPED),
+        "municipalities": total(MUNICIPALITIES),
+        "diffs": total(DIFF_PARCELS),
+        "audited": total(AUDITED_PARCELS),
+        "mismatches": total(AUDIT_MISMATCHES),
+        "failed": total(PARCELS_FAILED),
+    }
@@ -3,9 +3,20 @@ from typing import List, NamedTuple
 
 import bs4
 
-from pyparcel.common import OWNER, MUNICIPALITY, TAXINFO, SPAN
+from pyparcel.common import OWNER, MUNICIPALITY, SERVER_TIME, TAXINFO, SPAN
 from pyparcel.common import TaxStatus
 
+# The parts of a Real Estate Portal page that change on every request:
+# ASP.NET's hidden fields (__VIEWSTATE is split over a varying number of them),
+# and the time the page was served
+_VOLATILE = [
+    (re.compile(r'<input[^>]*name="__\w+"[^>]*>\s*'), ""),
+    (
+        re.compile(r'(<span id="{}">).*?(</span>)'.format(SERVER_TIME), re.DOTALL),
+        r"\1\2",
+    ),
+]
+
 
 def soupify_html(raw_html):
     return bs4.BeautifulSoup(raw_html, "html.parser")
@@ -81,6 +92,13 @@ def validate_county_municode_against_portal(html) -> List[str]:
     return parse_municipality_from_soup(soup)
 
 
+def normalize_html(raw_html: str) -> str:
+    """ Blanks out the parts of a page that change even when its data doesn't. """
+    for pattern, replacement in _VOLATILE:
+        raw_html = pattern.sub(replacement, raw_html)
+    return raw_html
+
+
 def clean_text(text):
     text = strip_whitespace(text)
     text = strip_dollarsign(text)
@@ -156,7 +174,9 @@ class OwnerName:
         """ Factory method for creating OwnerNames from a soup.
         """
         o = OwnerName()
-        o.raw = parse_owners_from_soup(soup)
+        # NavigableStrings hold a reference to the entire soup,
+        # so they are converted to plain strings
+        o.raw = [str(name) for name in parse_owners_from_soup(soup)]
         o.clean = (
             o.clean_raw_name()
         )  # Method side effect: May change flag o.multientity
@@ -0,0 +1,418 @@
+"""
+A staged pipeline for updating many parcels at once.
+
+update.parcel does everything for a single parcel on a single thread:
+it waits on the network, then holds the GIL while BeautifulSoup parses the page,
+then waits on the database. The pipeline splits those stages apart:
+
+    records --> fetch (threads) --> parse (processes) --> write (one connection)
+
+The queues between the stages are bounded.
+When a later stage falls behind, the earlier stages block instead of piling up html.
+
+A parcel whose record and page are the same as at its last update (see
+update.page_fingerprint) skips the parse stage, and the writer only marks it seen.
+A parcel whose WPRDC record is the same as at its last update, and whose tax status
+can't have changed since (see taxcalendar.py), isn't scraped at all.
+
+A parcel that fails doesn't stop the others (see failures.py). The fetch threads
+retry transient failures with a backoff, and any other failure is quarantined.
+"""
+import contextlib
+import contextvars
+import queue
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import date
+from typing import Callable, Iterable, Optional, Union
+
+import pyparcel.events as events
+import pyparcel.failures as failures
+import pyparcel.fetch as fetch
+import pyparcel.metrics as metrics
+import pyparcel.profiling as profiling
+import pyparcel.timing as timing
+import pyparcel.taxcalendar as taxcalendar
+import pyparcel.trace as trace
+import pyparcel.update as update
+from pyparcel.common import RunCancelled
+
+DEFAULT_FETCH_WORKERS = 4
+DEFAULT_QUEUE_SIZE = 64
+
+# Marks the end of a stage's output
+_DONE = object()
+
+
+class _Skipped:
+    """ A parcel that wasn't scraped, since it wasn't due (see _skippable). """
+
+    def __init__(self, parid: str, extdataid: int):
+        self.parid = parid
+        self.extdataid = extdataid
+
+
+class _Failed:
+    """ A parcel that failed before it reached the writer, which quarantines it. """
+
+    def __init__(self, parid: str, exc: BaseException, stage: str, attempts: int):
+        self.parid = parid
+        self.exc = exc
+        self.stage = stage
+        self.attempts = attempts
+
+
+class _StageError:
+    """ Carries an exception raised in one stage to the writer, which re-raises it. """
+
+    def __init__(self, exc: BaseException):
+        self.exc = exc
+
+
+def _put(q: queue.Queue, item, stop: threading.Event):
+    """ Blocking put that gives up once the pipeline is stopped. """
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+
+def _get(q: queue.Queue, stop: threading.Event):
+    """
+    Blocking get that gives up once the pipeline is stopped
+    and what was sent before then, such as the error that stopped it, is read.
+    """
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    try:
+        return q.get_nowait()
+    except queue.Empty:
+        return _DONE
+
+
+def _parse(html: str):
+    """
+    Runs in a parse process, whose metrics are never read,
+    so the time taken is sent back with the result.
+    So are the stage timings, since only the writer knows which parcel they belong to,
+    and the profile of the parse, if one is being taken.
+    """
+    start = time.perf_counter()
+    with timing.capture() as stages, profiling.capture() as profile:
+        result = update.parse_parcel(html)
+    return result, time.perf_counter() - start, stages, profile
+
+
+def _next(records, lock, retries: failures.RetryQueue, stop):
+    """
+    The next parcel to fetch and the number of times it has failed: a retry that's
+    due, or else the next record. Once the records run out, waits for the retries.
+    """
+    while not stop.is_set():
+        retry = retries.pop()
+        if retry is not None:
+            return retry
+        with lock:
+            record = next(records, _DONE)
+        if record is not _DONE:
+            return record, 0
+        wait = retries.wait()
+        if wait is None:
+            break
+        stop.wait(min(wait, 0.1))
+    return _DONE, 0
+
+
+def _skippable(record, known, last, today) -> Optional[int]:
+    """
+    The extdataid of a parcel that doesn't need scraping, since its WPRDC record is
+    the same as at its last update and its tax status can't have changed since
+    (see taxcalendar.due). Otherwise None.
+    """
+    if isinstance(record, str):
+        # Without the record, there's no telling whether it changed
+        return None
+    if taxcalendar.due(last.get(record["PARID"]), today, record):
+        return None
+    return update.record_unchanged(record, known)
+
+
+def _fetch_stage(records, lock, parse_q, stop, known, last, today, retries):
+    try:
+        while not stop.is_set():
+            record, attempts = _next(records, lock, retries, stop)
+            if record is _DONE:
+                break
+            parid = record if isinstance(record, str) else record["PARID"]
+            skip = None if attempts else _skippable(record, known, last, today)
+            if skip is not None:
+                _put(parse_q, _Skipped(parid, skip), stop)
+                continue
+            try:
+                if isinstance(record, str):
+                    fetched, html = update.fetch_parcel(parid=record)
+                else:
+                    fetched, html = update.fetch_parcel(record=record)
+                fingerprint = update.page_fingerprint(fetched, html)
+                seen = update.unchanged(fetched, fingerprint, known)
+            except Exception as e:
+                attempts += 1
+                category = failures.categorize(e, failures.FETCH_STAGE)
+                if category == failures.TRANSIENT and attempts < failures.MAX_ATTEMPTS:
+                    retries.push(record, attempts)
+                else:
+                    _put(
+                        parse_q, _Failed(parid, e, failures.FETCH_STAGE, attempts), stop
+                    )
+                continue
+            if seen is not None:
+                # Nothing to parse
+                html = None
+            # Stamped, so the time it waits to be parsed can be traced
+            _put(parse_q, (fetched, html, fingerprint, seen, time.time()), stop)
+    except Exception as e:
+        _put(parse_q, _StageError(e), stop)
+    finally:
+        _put(parse_q, _DONE, stop)
+
+
+def _parse_stage(parse_q, write_q, pool, fetch_workers, stop):
+    finished = 0
+    try:
+        while finished < fetch_workers and not stop.is_set():
+            item = _get(parse_q, stop)
+            if item is _DONE:
+                finished += 1
+                continue
+            if isinstance(item, (_StageError, _Skipped, _Failed)):
+                _put(write_q, item, stop)
+                continue
+            record, html, fingerprint, seen, fetched_at = item
+            if seen is not None:
+                _put(write_q, (record, None, fingerprint, seen, fetched_at), stop)
+                continue
+            if pool is None:
+                future = Future()
+                try:
+                    future.set_result(_parse(html))
+                except Exception as e:
+                    future.set_exception(e)
+            else:
+                # Raises if the pool is broken, such as when a parse process died
+                future = pool.submit(_parse, html)
+            # The write queue holds futures, so its bound also caps the number of
+            # pages being parsed at once.
+            _put(write_q, (record, future, fingerprint, None, fetched_at), stop)
+    except Exception as e:
+        _put(write_q, _StageError(e), stop)
+        # Nothing reads the parse queue anymore, so the fetch threads would block
+        stop.set()
+    finally:
+        _put(write_q, _DONE, stop)
+
+
+def _parsed(parid, future, fetched_at, pool):
+    """ Waits for a parcel's parse, and records how it went. """
+    (owner_name, tax_status), elapsed, stages, profile = future.result()
+    if pool is not None:
+        metrics.PARSE_SECONDS.observe(elapsed)
+    for stage, seconds, start, pid, thread in stages:
+        timing.record(stage, seconds, parid, start, pid, thread)
+        if stage == timing.PARSE:
+            parsed_at = start + seconds
+            trace.waited("waiting for parse", fetched_at, start, parid)
+            trace.waited("waiting for write", parsed_at, time.time(), parid)
+    profiling.add_captured(profile)
+    return owner_name, tax_status
+
+
+def _write(conn, cursor, commit, item, pool, quarantine) -> str:
+    """
+    Writes a fetched or skipped parcel,
+    or quarantines it if it can't be parsed or written.
+    Returns its parcel id.
+    """
+    if isinstance(item, _Skipped):
+        parid = item.parid
+        stage = failures.WRITE_STAGE
+    else:
+        record, future, fingerprint, seen, fetched_at = item
+        parid = record["PARID"]
+        stage = failures.PARSE_STAGE
+    if not commit:
+        # Parcels are committed one at a time, or else share a transaction
+        cursor.execute("SAVEPOINT parcel;")
+    try:
+        # Listeners only hear about the parcel's events once they're kept
+        with events.hold() as held:
+            if isinstance(item, _Skipped):
+                update.skipped(conn, cursor, commit, parid, item.extdataid)
+            elif seen is not None:
+                stage = failures.WRITE_STAGE
+                update.write_unchanged(conn, cursor, commit, record, seen)
+            else:
+                owner_name, tax_status = _parsed(parid, future, fetched_at, pool)
+                stage = failures.WRITE_STAGE
+                update.write_parcel(
+                    conn,
+                    cursor,
+                    commit,
+                    record,
+                    owner_name,
+                    tax_status,
+                    page_fingerprint=fingerprint,
+                )
+    except Exception as e:
+        if failures.fatal(e):
+            raise
+        if commit:
+            conn.rollback()
+        else:
+            cursor.execute("ROLLBACK TO SAVEPOINT parcel;")
+        quarantine.quarantine(parid, e, stage)
+    else:
+        if not commit:
+            cursor.execute("RELEASE SAVEPOINT parcel;")
+        events.publish(held)
+    return parid
+
+
+@contextlib.contextmanager
+def parse_pool(parse_workers: Optional[int] = None):
+    """
+    Processes to parse in, shared by every batch of a run (see run's pool).
+    None if parse_workers is 0, since the html is then parsed on a thread.
+    """
+    if parse_workers == 0:
+        yield None
+        return
+    with ProcessPoolExecutor(max_workers=parse_workers) as pool:
+        yield pool
+
+
+def run(
+    conn,
+    cursor,
+    commit: bool,
+    records: Iterable[Union[dict, str]],
+    fetch_workers: int = DEFAULT_FETCH_WORKERS,
+    parse_workers: Optional[int] = None,
+    queue_size: int = DEFAULT_QUEUE_SIZE,
+    cancel: Optional[threading.Event] = None,
+    report: Optional[Callable] = None,
+    quarantine: Optional[failures.Quarantine] = None,
+    pool: Optional[ProcessPoolExecutor] = None,
+):
+    """
+    Updates every parcel in records, the same way update.parcel would.
+
+    Args:
+        conn: The database connection
+        cursor: The cursor of the database connection
+        commit:
+            True if data should be committed to the database,
+            false if you're running tests
+        records:
+            WPRDC records of the parcels to update, a batch at a time.
+            Parcel ids can be given instead; their records are fetched from the WPRDC.
+        fetch_workers: Number of threads scraping the Real Estate Portal.
+        parse_workers:
+            Number of processes parsing the scraped html.
+            Defaults to the number of CPUs.
+            When 0, the html is parsed on a thread in this process.
+        queue_size: The maximum number of parcels waiting between two stages.
+        cancel: When set, the pipeline stops after the parcel being written.
+        report: Called with ("parcel", parid=...) after each parcel is written.
+        quarantine: Where parcels that fail for good are kept, such as the run's.
+            They're logged and counted in metrics either way.
+        pool:
+            The processes to parse in, such as the run's parse_pool, which is left
+            running. parse_workers is ignored when it's given.
+            Otherwise, a pool of parse_workers processes is started for this call.
+
+    Raises:
+        An exception that isn't any one parcel's (see failures.fatal), or that was
+        raised outside of a parcel. The remaining stages are stopped.
+        RunCancelled if cancel was set.
+    """
+    if fetch_workers < 1:
+        raise ValueError("fetch_workers must be at least 1")
+    # A batch, so its fingerprints can be fetched up front, before the stages
+    # start sharing the records
+    records = list(records)
+    parids = [r if isinstance(r, str) else r["PARID"] for r in records]
+    known = fetch.page_fingerprints(parids, cursor)
+    last = fetch.last_tax_statuses(parids, cursor) if taxcalendar.ENABLED else {}
+    records = iter(records)
+    if quarantine is None:
+        quarantine = failures.Quarantine()
+    lock = threading.Lock()
+    retries = failures.RetryQueue()
+    stop = threading.Event()
+    parse_q = queue.Queue(maxsize=queue_size)
+    write_q = queue.Queue(maxsize=queue_size)
+
+    owned = None
+    if pool is None and parse_workers != 0:
+        pool = owned = ProcessPoolExecutor(max_workers=parse_workers)
+    # Each thread runs in a copy of this context, so its metrics and timings
+    # count towards the caller's run (see metrics.Scope)
+    threads = [
+        threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(
+                _fetch_stage,
+                records,
+                lock,
+                parse_q,
+                stop,
+                known,
+                last,
+                date.today(),
+                retries,
+            ),
+            name=f"pyparcel-fetch-{i}",
+            daemon=True,
+        )
+        for i in range(fetch_workers)
+    ]
+    threads.append(
+        threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(_parse_stage, parse_q, write_q, pool, fetch_workers, stop),
+            name="pyparcel-parse",
+            daemon=True,
+        )
+    )
+    for t in threads:
+        t.start()
+
+    try:
+        # The writer is the calling thread, so the connection is only ever used here.
+        while True:
+            item = _get(write_q, stop)
+            if item is _DONE:
+                break
+            if isinstance(item, _StageError):
+                raise item.exc
+            if isinstance(item, _Failed):
+                parid = item.parid
+                quarantine.quarantine(parid, item.exc, item.stage, item.attempts)
+            else:
+                parid = _write(conn, cursor, commit, item, pool, quarantine)
+            if report is not None:
+                report("parcel", parid=parid)
+            if cancel is not None and cancel.is_set():
+                raise RunCancelled()
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+        if owned is not None:
+            owned.shutdown(wait=True)
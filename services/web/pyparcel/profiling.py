@@ -0,0 +1,232 @@
+"""
+Profiles runs, so hot spots can be found without reproducing a run by hand.
+
+Profiling is done per municipality (see run.pyparcel's profile argument),
+and covers the sections of a parcel update decorated with profiling.profiled:
+fetching, parsing, and writing. With hot=True, only parsing and writing are profiled.
+
+Two profilers are available:
+    cprofile:
+        Deterministic. Each municipality is saved as <municode>.pstats,
+        which can be read with the pstats module or snakeviz.
+        Pages parsed in the pipeline's parse processes are profiled there
+        and sent back to the writer with the parsed page (see pipeline._parse).
+    sampling:
+        Samples the stacks of threads inside a profiled section every few
+        milliseconds. Lower overhead, and saved as <municode>.collapsed,
+        the collapsed stack format read by flamegraph.pl and speedscope.
+        Only threads of this process are sampled, so runs being sampled parse
+        on a thread unless parse_workers is given.
+"""
+import collections
+import cProfile
+import functools
+import os
+import pstats
+import sys
+import threading
+from contextlib import contextmanager
+from typing import Optional
+
+CPROFILE = "cprofile"
+SAMPLING = "sampling"
+MODES = (CPROFILE, SAMPLING)
+
+# Sections
+FETCH = "fetch"
+PARSE = "parse"
+WRITE = "write"
+HOT = (PARSE, WRITE)
+
+SAMPLE_INTERVAL = 0.005  # seconds
+
+# The profiler of the municipality being profiled, if any
+_active = None
+_local = threading.local()
+
+
+class _Captured:
+    """ Profile statistics sent from another process, readable by pstats.Stats. """
+
+    def __init__(self, stats: dict):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class Profiler:
+    def __init__(self, mode: str, hot: bool = False):
+        if mode not in MODES:
+            raise ValueError("profile must be one of {}".format(", ".join(MODES)))
+        self.mode = mode
+        self.hot = hot
+        self._lock = threading.Lock()
+        # cprofile: A profile for each thread that entered a section
+        self._profiles = {}
+        self._captured = []
+        # sampling: The section each thread is in, and the number of times
+        # each stack was seen
+        self._sections = {}
+        self._stacks = collections.Counter()
+        self._stopped = threading.Event()
+        self._sampler = None
+
+    def start(self):
+        global _active
+        _active = self
+        if self.mode == SAMPLING:
+            self._sampler = threading.Thread(
+                target=self._sample, name="pyparcel-sampler", daemon=True
+            )
+            self._sampler.start()
+
+    def stop(self):
+        global _active
+        if _active is self:
+            _active = None
+        self._stopped.set()
+        if self._sampler is not None:
+            self._sampler.join()
+
+    def covers(self, name: str) -> bool:
+        return not self.hot or name in HOT
+
+    @contextmanager
+    def _profiling(self, name: str):
+        if self.mode == SAMPLING:
+            thread = threading.get_ident()
+            self._sections[thread] = name
+            try:
+                yield
+            finally:
+                self._sections.pop(thread, None)
+            return
+
+        thread = threading.get_ident()
+        with self._lock:
+            profile = self._profiles.setdefault(thread, cProfile.Profile())
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+
+    def _sample(self):
+        while not self._stopped.wait(SAMPLE_INTERVAL):
+            frames = sys._current_frames()
+            for thread, name in list(self._sections.items()):
+                frame = frames.get(thread)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        "{}:{}".format(
+                            os.path.basename(code.co_filename), code.co_name
+                        )
+                    )
+                    frame = frame.f_back
+                self._stacks[";".join([name] + stack[::-1])] += 1
+
+    def add_captured(self, stats: Optional[dict]):
+        """ Adds statistics profiled in another process. """
+        if stats:
+            with self._lock:
+                self._captured.append(_Captured(stats))
+
+    def dump(self, path: str) -> Optional[str]:
+        """
+        Saves what was profiled, adding the file extension to path.
+
+        Returns:
+            The path of the saved file, or None if nothing was profiled
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if self.mode == SAMPLING:
+            if not self._stacks:
+                return None
+            path += ".collapsed"
+            with open(path, "w") as f:
+                for stack, count in self._stacks.most_common():
+                    f.write("{} {}\n".format(stack, count))
+            return path
+
+        profiles = list(self._profiles.values()) + self._captured
+        if not profiles:
+            return None
+        path += ".pstats"
+        pstats.Stats(*profiles).dump_stats(path)
+        return path
+
+
+def profiled(name: str):
+    """ Marks a function as a section of a parcel update that can be profiled. """
+
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            profiler = _active
+            if profiler is None or getattr(_local, "inside", False):
+                return f(*args, **kwargs)
+            if not profiler.covers(name):
+                return f(*args, **kwargs)
+            capturing = getattr(_local, "captured", None)
+            _local.inside = True
+            try:
+                if capturing is not None and profiler.mode == CPROFILE:
+                    profile = cProfile.Profile()
+                    profile.enable()
+                    try:
+                        return f(*args, **kwargs)
+                    finally:
+                        profile.disable()
+                        profile.create_stats()
+                        capturing.update(profile.stats)
+                with profiler._profiling(name):
+                    return f(*args, **kwargs)
+            finally:
+                _local.inside = False
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def capture():
+    """
+    Collects the current thread's cProfile statistics into a dictionary
+    instead of the active profiler, so they can be sent back from another process.
+    """
+    captured = {}
+    previous = getattr(_local, "captured", None)
+    _local.captured = captured
+    try:
+        yield captured
+    finally:
+        _local.captured = previous
+
+
+def add_captured(stats: Optional[dict]):
+    if _active is not None:
+        _active.add_captured(stats)
+
+
+@contextmanager
+def profile(mode: Optional[str], hot: bool, path: str):
+    """
+    Profiles the body of the with statement and saves it to path (see Profiler.dump).
+    Does nothing when mode is None.
+    """
+    if mode is None:
+        yield
+        return
+    profiler = Profiler(mode, hot)
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        profiler.dump(path)
@@ -1,29 +1,458 @@
 #!/usr/bin/env python3
+import collections
+import itertools
 import json
-import sys
+import logging
+import multiprocessing
+import os
+import queue
+import threading
 import time
-import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from datetime import timedelta
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Callable, Iterable, Iterator
 
 import psycopg2
 
+import pyparcel.audit as audit_
+import pyparcel.checkpoint as checkpoint
+import pyparcel.events as events
+import pyparcel.failures as failures
 import pyparcel.fetch as fetch
+import pyparcel.log as log
+import pyparcel.metrics as metrics
+import pyparcel.pipeline as pipeline
+import pyparcel.profiling as profiling
+import pyparcel.schedule as schedule_
+import pyparcel.timing as timing
+import pyparcel.trace as trace_
 import pyparcel.update as update
-from pyparcel.common import DASHES, DB_URI, Tally
+import pyparcel.write as write
+from pyparcel.common import DB_URI, REPORTS, RunCancelled
 
+HERE = os.path.abspath(os.path.dirname(__file__))
 
-def _summarize(error) -> dict:
+logger = logging.getLogger(__name__)
+
+
+def _summarize(error, counts, cancelled=False, failed=(), audits=()) -> dict:
     summary = {}
-    if error:
+    if error or cancelled:
         summary["success"] = False
     else:
         summary["success"] = True
-    summary["people updated"] = Tally.total
-    summary["municipalities updated"] = Tally.muni_count
+    summary["cancelled"] = cancelled
+    summary["people updated"] = counts["processed"]
+    summary["municipalities updated"] = counts["municipalities"]
+    if audits:
+        # Every municipality's strata, so the run's estimate weights them by size,
+        # since the samples aren't proportional to either
+        strata = [
+            (stratum["population"], stratum["sampled"], stratum["mismatches"])
+            for a in audits
+            for stratum in a["strata"].values()
+        ]
+        estimate, interval = audit_.stratified_interval(strata)
+        summary["audit"] = {
+            "parcels": counts["audited"],
+            "mismatches": counts["mismatches"],
+            "estimate": estimate,
+            "interval": list(interval),
+            "municipalities": {
+                str(a["municode"]): {
+                    key: a[key]
+                    for key in (
+                        "population",
+                        "sampled",
+                        "mismatches",
+                        "estimate",
+                        "interval",
+                    )
+                }
+                for a in audits
+            },
+        }
+    summary["parcels failed"] = len(failed)
+    summary["failed"] = failures.summarize(failed)
     return summary
 
 
+def _run_name(start: float) -> str:
+    """ Names the files a run saves to the reports directory. """
+    return "{}_{}".format(
+        time.strftime("%Y%m%dT%H%M%S", time.localtime(start)), os.getpid()
+    )
+
+
+def _save_report(summary: dict, recorder: timing.Recorder, start: float) -> str:
+    """
+    Saves the run's summary and timing report side by side in the reports directory.
+
+    Returns:
+        The path of the timing report
+    """
+    directory = os.path.join(HERE, REPORTS)
+    os.makedirs(directory, exist_ok=True)
+    name = _run_name(start)
+    report_path = os.path.join(directory, name + "_timings.json")
+    report = {"elapsed": time.time() - start, **recorder.report()}
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+    with open(os.path.join(directory, name + "_summary.json"), "w") as f:
+        json.dump({**summary, "timings": report_path}, f, indent=2)
+    return report_path
+
+
+def _profiled(profile: Optional[tuple], name: str):
+    """
+    Profiles the body of a with statement into the run's profile directory.
+
+    Args:
+        profile: The run's (mode, hot, directory), or None if it isn't profiled
+        name: The name of the saved profile, without its extension
+    """
+    if profile is None:
+        return profiling.profile(None, False, name)
+    mode, hot, directory = profile
+    return profiling.profile(mode, hot, os.path.join(directory, name))
+
+
+def _update_municipality(
+    conn,
+    cursor,
+    muni,
+    commit,
+    each,
+    diff,
+    fetch_workers,
+    parse_workers,
+    queue_size,
+    checkpoint,
+    batch_size,
+    audit=False,
+    cancel=None,
+    report=None,
+    quarantine=None,
+    audits=None,
+    parse_pool=None,
+):
+    """
+    Runs --each, --diff and/or --audit over a single municipality.
+    Audit reports are appended to audits, if given.
+    Parses in parse_pool, the run's pipeline.parse_pool, if given.
+
+    Progress is recorded in the checkpoint after each batch of parcels and each pass.
+    Work the checkpoint already records is skipped.
+    A batch that was in flight when a run died is done over from its first parcel,
+    which is safe: update.parcel doesn't insert a parcel twice,
+    and a parcel that hasn't changed since its last update doesn't produce events.
+    """
+    records = fetch.municipality_records_from_Wprdc(muni)
+
+    # Skip muni if the records are invalid
+    # (for example, for the test muni COG Land).
+    # Only the first record is read, rather than counting them all.
+    if not records:
+        logger.warning(
+            "Skipping {}: JSON does not contain records".format(muni.name),
+            extra={"municode": muni.municode},
+        )
+        checkpoint.mark_municipality(muni.municode)
+        return
+    if report is not None:
+        report(
+            "municipality",
+            municode=muni.municode,
+            name=muni.name,
+            parcels=len(records),
+        )
+
+    if each and not checkpoint.pass_done(muni.municode, "each"):
+        batches_done = checkpoint.batches_done(muni.municode, batch_size)
+        if batches_done:
+            logger.info(
+                "Resuming {}: skipping {} batches of {} parcels".format(
+                    muni.name, len(batches_done), batch_size
+                ),
+                extra={"municode": muni.municode},
+            )
+        for batch, chunk in enumerate(_batches(records, batch_size)):
+            if batch in batches_done:
+                continue
+            pipeline.run(
+                conn,
+                cursor,
+                commit,
+                chunk,
+                fetch_workers=fetch_workers,
+                parse_workers=parse_workers,
+                queue_size=queue_size,
+                cancel=cancel,
+                report=report,
+                quarantine=quarantine,
+                pool=parse_pool,
+            )
+            checkpoint.mark_batch(muni.municode, batch, batch_size)
+        checkpoint.mark_pass(muni.municode, "each")
+
+    if diff and not checkpoint.pass_done(muni.municode, "diff"):
+        _check_cancelled(cancel)
+        update.create_events_for_parcels_in_db_but_not_in_records(
+            records, muni.municode, conn, cursor, commit
+        )
+        checkpoint.mark_pass(muni.municode, "diff")
+
+    if audit and not checkpoint.pass_done(muni.municode, "audit"):
+        _check_cancelled(cancel)
+        audit_report = audit_.municipality(
+            records, muni.municode, fetch_workers=fetch_workers
+        )
+        if audits is not None:
+            audits.append(audit_report)
+        checkpoint.mark_pass(muni.municode, "audit")
+
+    checkpoint.mark_municipality(muni.municode)
+    metrics.MUNICIPALITIES.inc()
+
+
+def _batches(records: Iterable, batch_size: int) -> Iterator[list]:
+    """ Splits a stream of records into lists of batch_size, reading one at a time. """
+    records = iter(records)
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def _unfinished(municodes: Iterable, run_checkpoint) -> Iterator:
+    """ Skips the municipalities the checkpoint records as done. """
+    skipped = 0
+    for municode in municodes:
+        if run_checkpoint.municipality_done(municode):
+            skipped += 1
+            continue
+        if skipped:
+            logger.info("Resuming: skipped {} municipalities".format(skipped))
+            skipped = 0
+        yield municode
+    if skipped:
+        logger.info("Resuming: skipped {} municipalities".format(skipped))
+
+
+def _rolling_records(cursor, municode, window_days, slice_size) -> list:
+    """
+    The WPRDC records of today's slice of the rolling schedule, in its order.
+    They're fetched a few hundred at a time, rather than one request per parcel
+    in the pipeline's fetch stage, which also lets the tax calendar skip parcels.
+    Parcels the WPRDC has no record of are recorded as missing,
+    so tomorrow's slice moves past them.
+    """
+    parids = schedule_.rolling_slice(cursor, municode, window_days, slice_size)
+    found = fetch.records_using_parids(parids)
+    missing = [parid for parid in parids if parid not in found]
+    if missing:
+        logger.warning(
+            "The WPRDC has no records for {} parcels in today's slice".format(
+                len(missing)
+            ),
+            extra={"parids": missing},
+        )
+        write.wprdc_missing(missing, cursor)
+    logger.info("Updating today's slice of {} parcels.".format(len(found)))
+    return [found[parid] for parid in parids if parid in found]
+
+
+def _check_cancelled(cancel):
+    if cancel is not None and cancel.is_set():
+        raise RunCancelled()
+
+
+def _counts(scope: metrics.Scope) -> dict:
+    """ The counts of a run's scope. """
+    return metrics.counts(scope.snapshot())
+
+
+def _reporter(progress, scope):
+    """ Wraps the progress callback so every update carries the run's counts. """
+    if progress is None:
+        return None
+
+    def report(kind, **data):
+        progress({"type": kind, **data, "counts": _counts(scope)})
+
+    return report
+
+
+# Each process in the pool started by _fan_out has its own connection,
+# and shares the pool's cancel event and the queue its events go back to the
+# parent on
+_worker_conn = None
+_worker_cancel = None
+_worker_events = None
+
+
+def _init_worker(cancel, worker_events):
+    global _worker_conn, _worker_cancel, _worker_events
+    _worker_conn = psycopg2.connect(DB_URI)
+    _worker_cancel = cancel
+    _worker_events = worker_events
+    timing.reset()
+    trace_.reset()
+    log.reset()
+
+
+def _update_municipality_in_worker(
+    municode, commit, options, profile=None, trace_dir=None
+):
+    """
+    Returns:
+        The worker's process id, the municipality,
+        the metrics the municipality counted (a metrics.Scope's snapshot),
+        the municipality's stage timings, the parcels it quarantined
+        and its audit reports.
+    """
+    quarantine = failures.Quarantine()
+    audits = []
+    tracer = None
+    if trace_dir is not None:
+        tracer = trace_.Tracer(os.path.join(trace_dir, "{}.jsonl".format(os.getpid())))
+        tracer.start()
+    events.add_listener(_worker_events.put)
+    try:
+        with metrics.Scope() as scope, timing.Recorder() as recorder:
+            with _worker_conn.cursor() as cursor, pipeline.parse_pool(
+                options["parse_workers"]
+            ) as parse_pool:
+                muni = fetch.muniname_given_municode(municode, cursor)
+                with _profiled(profile, str(municode)):
+                    _update_municipality(
+                        _worker_conn,
+                        cursor,
+                        muni,
+                        commit,
+                        **options,
+                        cancel=_worker_cancel,
+                        quarantine=quarantine,
+                        audits=audits,
+                        parse_pool=parse_pool,
+                    )
+    finally:
+        events.remove_listener(_worker_events.put)
+    if commit:
+        _worker_conn.commit()
+    else:
+        _worker_conn.rollback()
+    if tracer is not None:
+        tracer.stop()
+    # Workers exit without flushing what they've buffered
+    log.flush()
+    return (
+        os.getpid(),
+        muni,
+        scope.snapshot(),
+        recorder.state(),
+        quarantine.failures(),
+        audits,
+    )
+
+
+def _publish_worker_events(worker_events):
+    """ Passes the events the workers have written so far on to this run's listeners.
+    """
+    summaries = []
+    while True:
+        try:
+            summaries.append(worker_events.get_nowait())
+        except queue.Empty:
+            break
+    events.publish(summaries)
+
+
+def _fan_out(
+    municodes,
+    workers,
+    commit,
+    options,
+    cursor,
+    cancel=None,
+    report=None,
+    profile=None,
+    trace_dir=None,
+    quarantine=None,
+    audits=None,
+):
+    """
+    Updates municipalities in worker processes, each with its own database connection.
+
+    Municipalities are submitted largest first. Since idle workers pick up the next
+    submitted municipality, the largest municipalities don't end up running last.
+    """
+    sizes = fetch.muni_sizes(cursor)
+    municodes = sorted(municodes, key=lambda m: sizes.get(m, 0), reverse=True)
+    if options["parse_workers"] is None:
+        # The municipalities already spread parsing across processes.
+        # Don't start a second pool per worker.
+        options = {**options, "parse_workers": 0}
+
+    logger.info(
+        "Updating {} municipalities with {} workers.".format(len(municodes), workers)
+    )
+    done_by_worker = collections.Counter()
+    worker_cancel = multiprocessing.Event()
+    worker_events = multiprocessing.Queue()
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(worker_cancel, worker_events),
+    ) as pool:
+        pending = {
+            pool.submit(
+                _update_municipality_in_worker, m, commit, options, profile, trace_dir
+            )
+            for m in municodes
+        }
+        try:
+            while pending:
+                done, pending = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+                if cancel is not None and cancel.is_set():
+                    worker_cancel.set()
+                _publish_worker_events(worker_events)
+                for future in done:
+                    pid, muni, added, timings, failed, audited = future.result()
+                    metrics.REGISTRY.merge(added)
+                    timing.merge(timings)
+                    if quarantine is not None:
+                        quarantine.extend(failed)
+                    if audits is not None:
+                        audits.extend(audited)
+                    done_by_worker[pid] += 1
+                    logger.info(
+                        "Worker {} updated {}".format(pid, muni.name),
+                        extra={
+                            "worker": pid,
+                            "municode": muni.municode,
+                            "parcels": metrics.counts(added)["processed"],
+                            "worker municipalities": done_by_worker[pid],
+                            "done": sum(done_by_worker.values()),
+                            "municipalities": len(municodes),
+                        },
+                    )
+                    if report is not None:
+                        report(
+                            "municipality done",
+                            municode=muni.municode,
+                            name=muni.name,
+                        )
+        except BaseException:
+            worker_cancel.set()
+            for future in pending:
+                future.cancel()
+            raise
+    # The workers have exited, so whatever they put on the queue has arrived
+    _publish_worker_events(worker_events)
+
+
 # Make sure to update the module http_server if the function signature is changed
 def _read_config(config: str) -> Dict[str, Any]:
     """
@@ -49,8 +478,23 @@ def pyparcel(
     config: str = "test",
     each: bool = False,
     diff: bool = False,
+    audit: bool = False,
     parcel: Optional[str] = None,
     commit: bool = False,
+    fetch_workers: int = pipeline.DEFAULT_FETCH_WORKERS,
+    parse_workers: Optional[int] = None,
+    queue_size: int = pipeline.DEFAULT_QUEUE_SIZE,
+    workers: int = 1,
+    resume: bool = False,
+    batch_size: int = checkpoint.DEFAULT_BATCH_SIZE,
+    schedule: Optional[str] = None,
+    window_days: int = schedule_.DEFAULT_WINDOW_DAYS,
+    slice_size: Optional[int] = None,
+    progress: Optional[Callable[[dict], None]] = None,
+    cancel: Optional[threading.Event] = None,
+    profile: Optional[str] = None,
+    profile_hot: bool = False,
+    trace: bool = False,
 ) -> dict:
     """
 
@@ -72,6 +516,13 @@ def pyparcel(
             Writes a NotInRealEstatePortal or DifferentMunicode event to the CoG database based on findings.
             Cannot be true if --parcels is true.
             Defaults false.
+        audit:
+            Compare a random sample of each municipality's parcels, stratified by
+            land use, against the Allegheny County Real Estate Portal, and log the
+            mismatch rate with its confidence interval. Writes nothing.
+            See audit.py.
+            Cannot be true if --parcels is true.
+            Defaults false.
         parcel:
             Parcel to update.
             Cannot be true if --diff or --each is true
@@ -81,102 +532,273 @@ def pyparcel(
         commit:
             Whether the data should be committed to the database.
             Defaults false for testing purposes.
+        fetch_workers:
+            Number of threads scraping the Real Estate Portal when --each is true.
+            Defaults to 4.
+        parse_workers:
+            Number of processes parsing the scraped html when --each is true.
+            0 parses on a thread in this process.
+            Defaults to the number of CPUs.
+        queue_size:
+            How many parcels may wait between two stages of the pipeline.
+            Defaults to 64.
+        workers:
+            Number of processes updating municipalities at the same time.
+            Each process has its own database connection,
+            and parses on its own thread unless parse_workers is given.
+            Defaults to 1.
+        resume:
+            Skip the municipalities and batches of parcels that the last run
+            with the same arguments finished before it stopped.
+            When false, that run's progress is forgotten.
+            Defaults false.
+        batch_size:
+            Number of parcels between each checkpoint of a municipality's progress.
+            Defaults to 500.
+        schedule:
+            When 'rolling', update today's slice of the parcels in --municode
+            (or the whole county) instead of every parcel. See schedule.py.
+            Cannot be given alongside --parcel or --each.
+            Defaults to None.
+        window_days:
+            With schedule='rolling', every parcel is updated at least this often.
+            Defaults to 30.
+        slice_size:
+            With schedule='rolling', the number of parcels updated per run.
+            Defaults to enough to cover every parcel within the window, with headroom.
+        progress:
+            Called with a dictionary after every parcel and municipality.
+            The dictionary's "type" says which, and its "counts" are the run's
+            metrics.counts.
+        cancel:
+            An event that stops the run when set.
+            A stopped run can be picked up again with --resume.
+        profile:
+            'cprofile' or 'sampling'. Profiles the run and saves a profile per
+            municipality to reports/profiles/. See profiling.py.
+            Defaults to None.
+        profile_hot:
+            Only profile parsing and writing parcels, not fetching them.
+            Defaults false.
+        trace:
+            Record every stage of every parcel on a timeline,
+            saved to reports/ as a Chrome trace. See trace.py.
+            Defaults false.
+
 
     Returns:
         Dictionary containing whether the operation was completed
         and the number of people / municipalities updated.
         Keys:
             "success": bool
+            "cancelled": bool
             "people updated": int
             "municipalities updated": int
+            "parcels failed": int, the parcels quarantined. See failures.py.
+            "failed": dict, the quarantined parcels by category, each with its
+                parcel id, stage, error and attempts
+            "audit": dict, the parcels audited, how many mismatched, the run's
+                estimated mismatch rate with its confidence interval, and each
+                municipality's (only if any were audited). See audit.municipality.
+            "timings": str, the path of the run's timing report. See timing.py.
+            "profiles": str, the directory of the run's profiles (only if profiled)
+            "trace": str, the path of the run's trace (only if traced)
+        The summary is also saved next to the timing report.
     """
     start = time.time()
     error = None
+    cancelled = False
+    # The registry is shared by every run in the process, so the run counts its own
+    scope = metrics.Scope()
+    scope.start()
+    quarantine = failures.Quarantine()
+    audits = []
+    report = _reporter(progress, scope)
+    # Direct callers get the same logging as the API
+    log.configure()
+    throughput = log.Throughput(lambda: _counts(scope))
+    throughput.start()
+    recorder = timing.Recorder()
+    recorder.start()
+    profile_settings = None
+    trace_dir = None
+    if trace:
+        trace_dir = os.path.join(HERE, REPORTS, "traces", _run_name(start))
+        tracer = trace_.Tracer(os.path.join(trace_dir, "{}.jsonl".format(os.getpid())))
+        tracer.start()
     try:
         # Simple validation. If an argument hasn't been provided, don't do anything.
-        if any in [parcel, each, diff]:
-            pass
-        else:
+        if not any([parcel, each, diff, audit, schedule]):
             raise RuntimeError("Please provide the runtime argument 'parcel' or "
-                               "either/both of 'each' or 'diff'.")
+                               "any of 'each', 'diff' or 'audit'.")
+        if schedule not in (None, schedule_.ROLLING):
+            raise ValueError("--schedule must be 'rolling'")
+        if schedule and (parcel or each):
+            raise ValueError("--schedule cannot be passed alongside --parcel or --each")
 
         if config == "test":
-            print("Connected to the testing server.")
+            logger.info("Connected to the testing server.")
         elif config == "production":
-            print("Connected to the production server.")
+            logger.info("Connected to the production server.")
 
         if commit:
-            print("Data will be committed to the database")
+            logger.info("Data will be committed to the database")
             # raise RuntimeError("Lorem Ipsum: Code is not production ready")
         else:
-            print("Data will NOT be committed.")
-        # print("Port = {}".format(secrets["port"]))
-        print(DASHES)
+            logger.info("Data will NOT be committed.")
 
-        with psycopg2.connect(DB_URI) as conn:
-            with conn.cursor() as cursor:
+        if parcel and (each or diff or audit):
+            raise ValueError(
+                "--parcel cannot be passed alongside --each, --diff or --audit"
+            )
+        if workers < 1:
+            raise ValueError("--workers must be at least 1")
+        if profile is not None:
+            if profile not in profiling.MODES:
+                raise ValueError("--profile must be 'cprofile' or 'sampling'")
+            profile_dir = os.path.join(HERE, REPORTS, "profiles", _run_name(start))
+            profile_settings = (profile, profile_hot, profile_dir)
+            if profile == profiling.SAMPLING and parse_workers is None:
+                # Parse processes can't be sampled
+                parse_workers = 0
+        run_checkpoint = checkpoint.Checkpoint.for_run(
+            municode, each, diff, commit, audit
+        )
+        if not resume:
+            run_checkpoint.clear()
+        options = {
+            "each": each,
+            "diff": diff,
+            "audit": audit,
+            "fetch_workers": fetch_workers,
+            "parse_workers": parse_workers,
+            "queue_size": queue_size,
+            "checkpoint": run_checkpoint,
+            "batch_size": batch_size,
+        }
 
+        # Started once, rather than for every batch of parcels.
+        # Its processes are only started once something is parsed.
+        with psycopg2.connect(DB_URI) as conn, pipeline.parse_pool(
+            parse_workers
+        ) as parse_pool:
+            with conn.cursor() as cursor:
                 if parcel:
-                    if each or diff:
-                        raise ValueError(
-                            "--parcel cannot be passed alongside --each or --diff"
+                    with _profiled(profile_settings, parcel):
+                        update.parcel(conn, cursor, commit, parid=parcel)
+
+                if schedule == schedule_.ROLLING:
+                    records = _rolling_records(cursor, municode, window_days, slice_size)
+                    with _profiled(profile_settings, schedule_.ROLLING):
+                        pipeline.run(
+                            conn,
+                            cursor,
+                            commit,
+                            records,
+                            fetch_workers=fetch_workers,
+                            parse_workers=parse_workers,
+                            queue_size=queue_size,
+                            cancel=cancel,
+                            report=report,
+                            quarantine=quarantine,
+                            pool=parse_pool,
                         )
-                    update.parcel(conn, cursor, commit, parid=parcel)
 
                 # Give the option to iterate over ALL municipalities
-                if municode is None:
-                    municodes = [muni for muni in fetch.munis(cursor)]
+                if not (each or diff or audit):
+                    municodes = iter(())
+                elif municode is None:
+                    municodes = iter(fetch.munis(cursor))
                 else:
-                    municodes = [municode]
+                    municodes = iter([municode])
+                if resume:
+                    municodes = _unfinished(municodes, run_checkpoint)
+
+                if workers > 1:
+                    # Workers are handed the largest municipalities first,
+                    # so this needs every municode anyway
+                    municodes = list(municodes)
+                if workers > 1 and len(municodes) > 1:
+                    # Each worker opens its own connection
+                    _fan_out(
+                        municodes,
+                        workers,
+                        commit,
+                        options,
+                        cursor,
+                        cancel,
+                        report,
+                        profile_settings,
+                        trace_dir,
+                        quarantine,
+                        audits,
+                    )
+                    municodes = []
 
                 for _municode in municodes:
+                    _check_cancelled(cancel)
                     muni = fetch.muniname_given_municode(_municode, cursor)
-                    records = fetch.municipality_records_from_Wprdc(muni)
-
-                    # Skip muni if the records are invalid
-                    # (for example, for the test muni COG Land),
-                    if not records:
-                        print(
-                            "Skipping {}: JSON does not contain records".format(
-                                muni.name
-                            )
+                    with _profiled(profile_settings, str(_municode)):
+                        _update_municipality(
+                            conn,
+                            cursor,
+                            muni,
+                            commit,
+                            **options,
+                            cancel=cancel,
+                            report=report,
+                            quarantine=quarantine,
+                            audits=audits,
+                            parse_pool=parse_pool,
                         )
-                        print(DASHES)
-                        continue
-
-                    if each:
-                        for record in records:
-                            update.parcel(conn, cursor, commit, record=record)
-                        print(DASHES)
-
-                    if diff:
-                        update.create_events_for_parcels_in_db_but_not_in_records(
-                            records, muni.municode, conn, cursor, commit
+                    logger.info(
+                        "Updated {} municipalities.".format(
+                            _counts(scope)["municipalities"]
                         )
-                        print(DASHES)
+                    )
+
+                # The run finished, so the next one starts from scratch
+                run_checkpoint.clear()
 
-                    Tally.muni_count += 1
-                    print("Updated {} municipalities.".format(Tally.muni_count))
-                    print(DASHES)
+    except RunCancelled:
+        # Checkpoints are kept, so the run can be resumed
+        logger.warning("The run was cancelled.")
+        cancelled = True
 
     except Exception:
         # Catches exceptions to be passed to the summery
-        traceback.print_exc(limit=2, file=sys.stdout)
+        logger.exception("The run failed.")
         error = True
 
     finally:
         try:
-            print("Current muni {}:".format(muni.name))
+            logger.info("Current muni {}:".format(muni.name))
         except NameError:
             pass
         end = time.time()
-        summery = _summarize(error)
-        print(
+        recorder.stop()
+        throughput.stop()
+        scope.stop()
+        summery = _summarize(
+            error, _counts(scope), cancelled, quarantine.failures(), audits
+        )
+        if profile_settings is not None:
+            summery["profiles"] = profile_settings[2]
+        if trace_dir is not None:
+            tracer.stop()
+            summery["trace"] = trace_.merge(
+                trace_dir, os.path.join(HERE, REPORTS, _run_name(start) + "_trace.json")
+            )
+        summery["timings"] = _save_report(summery, recorder, start)
+        throughput.summarize("Run finished")
+        logger.info(
             "Total time: {}".format(
                 # Strips milliseconds from elapsed time
                 str(timedelta(seconds=(end - start))).split(".")[0]
-            )
+            ),
+            extra=summery,
         )
+        log.flush()
 
         return summery
 
@@ -0,0 +1,140 @@
+"""
+Decides which parcels are worth refreshing today.
+
+Refreshing every parcel on every run spends most of our portal budget on parcels
+that haven't changed. The rolling schedule instead refreshes a fixed size slice
+of the county each day. Parcels are ranked by how stale their data is,
+weighted up for parcels that are likely to have changed:
+parcels with recent events, unpaid taxes, or a recent sale.
+
+Any parcel that hasn't been refreshed within the window outranks every other parcel,
+so the whole county is still covered once per window.
+A parcel the WPRDC has no record of can't be refreshed. Looking it up counts instead
+(see write.wprdc_missing), so it's looked up again once per window
+rather than topping every slice.
+The default slice leaves headroom above (number of parcels / window) for hot parcels.
+"""
+import heapq
+import math
+from collections import namedtuple
+from datetime import date
+from typing import List, Optional
+
+ROLLING = "rolling"
+
+# Rows read from the database at a time
+ITERSIZE = 10000
+
+DEFAULT_WINDOW_DAYS = 30
+# How much larger than the bare minimum the daily slice is
+HEADROOM = 1.25
+# How far back events and sales count as recent
+RECENT_DAYS = 90
+RECENT_SALE_YEARS = 1
+
+EVENT_WEIGHT = 0.5  # Per recent event
+UNPAID_WEIGHT = 1.0
+SALE_WEIGHT = 2.0
+
+# Scores above this belong to parcels that are overdue or have never been refreshed
+OVERDUE = 1000.0
+
+ParcelHistory = namedtuple(
+    "ParcelHistory",
+    ["parid", "age_days", "recent_events", "paidstatus", "saleyear"],
+)
+
+
+def histories(cursor, municode=None):
+    """
+    Yields a ParcelHistory for every parcel in the municipality, or the whole county.
+    The rows are read through a server-side cursor, ITERSIZE at a time,
+    rather than all at once.
+    """
+    select_sql = """
+        SELECT
+            p.parid,
+            -- GREATEST ignores nulls, so this is null for parcels never looked up
+            EXTRACT(EPOCH FROM now() - GREATEST(latest.lastseen, p.lastmissing))
+                / 86400,
+            (
+                SELECT count(*) FROM event e
+                JOIN cecase c ON e.cecase_caseid = c.caseid
+                WHERE c.property_propertyid = p.propertyid
+                AND e.creationts > now() - %(recent_days)s * interval '1 day'
+            ),
+            latest.paidstatus,
+            latest.saleyear
+        FROM property p
+        LEFT JOIN LATERAL (
+            SELECT
+                -- Unchanged parcels only have lastseen bumped
+                COALESCE(ped.lastseen, ped.lastupdated) AS lastseen,
+                ped.saleyear, ts.paidstatus
+            FROM propertyexternaldata ped
+            LEFT JOIN taxstatus ts ON ts.taxstatusid = ped.taxstatus_taxstatusid
+            WHERE ped.property_propertyid = p.propertyid
+            ORDER BY ped.lastupdated DESC
+            LIMIT 1
+        ) latest ON true
+        WHERE %(municode)s IS NULL OR p.municipality_municode = %(municode)s;
+    """
+    with cursor.connection.cursor("pyparcel_histories") as server_cursor:
+        server_cursor.itersize = ITERSIZE
+        server_cursor.execute(
+            select_sql, {"recent_days": RECENT_DAYS, "municode": municode}
+        )
+        for row in server_cursor:
+            yield ParcelHistory(*row)
+
+
+def priority(
+    history: ParcelHistory,
+    window_days: int = DEFAULT_WINDOW_DAYS,
+    today: Optional[date] = None,
+) -> float:
+    """
+    How badly a parcel needs refreshing. Higher is more urgent.
+
+    A parcel's staleness (the fraction of the window since it was last refreshed)
+    is multiplied by its heat, so a hot parcel reaches the top of the list
+    several times per window while a quiet one reaches it about once.
+    """
+    if history.age_days is None:
+        return math.inf
+    age_days = float(history.age_days)
+    if age_days >= window_days:
+        return OVERDUE + age_days
+
+    today = today or date.today()
+    heat = 1.0 + EVENT_WEIGHT * (history.recent_events or 0)
+    if history.paidstatus is not None and history.paidstatus != "PAID":
+        heat += UNPAID_WEIGHT
+    try:
+        if today.year - int(history.saleyear) <= RECENT_SALE_YEARS:
+            heat += SALE_WEIGHT
+    except (TypeError, ValueError):  # No sale year on record
+        pass
+    return age_days / window_days * heat
+
+
+def default_slice_size(parcel_count: int, window_days: int = DEFAULT_WINDOW_DAYS):
+    return math.ceil(parcel_count / window_days * HEADROOM)
+
+
+def rolling_slice(
+    cursor,
+    municode=None,
+    window_days: int = DEFAULT_WINDOW_DAYS,
+    slice_size: Optional[int] = None,
+) -> List[str]:
+    """
+    Returns:
+        The parcel ids to refresh today, most urgent first
+    """
+    ranked = []
+    for history in histories(cursor, municode):
+        ranked.append((priority(history, window_days), history.parid))
+    if slice_size is None:
+        slice_size = default_slice_size(len(ranked), window_days)
+    return [parid for _, parid in heapq.nlargest(slice_size, ranked)]
@@ -1,7 +1,14 @@
+import os
+
 import requests
 
 from pyparcel.common import TAX
 
+# Overridable so runs can scrape a stand-in portal (see standin.py)
+COUNTY_REAL_ESTATE_URL = os.environ.get(
+    "PYPARCEL_COUNTY_URL", "http://www2.county.allegheny.pa.us/RealEstate/"
+)
+
 
 def county_property_assessment(
     parcel_id: str, full_response=False
@@ -14,7 +21,6 @@ def county_property_assessment(
             When false, this function returns the scraped text a parcel's Allegheny County Real Estate Portal.
             If full_response is truthy, it instead returns the full requests.Reponse object.
     """
-    COUNTY_REAL_ESTATE_URL = "http://www2.county.allegheny.pa.us/RealEstate/"
     URL_ENDING = ".aspx?"
     search_parameters = {
         "ParcelID": parcel_id,
@@ -27,6 +33,8 @@ def county_property_assessment(
         timeout=5,
     )
     if not full_response:
+        # Error pages (such as a 429 when throttled) aren't parsed as a parcel's page
+        response.raise_for_status()
         return response.text
     return response
 
@@ -0,0 +1,288 @@
+"""
+A local, memory-mapped snapshot of the WPRDC's property assessments.
+
+With a snapshot configured (fetch.SNAPSHOT, or the environment variable
+PYPARCEL_SNAPSHOT), fetch.py reads records from it instead of calling the WPRDC:
+parcel id lookups are a binary search and a municipality is a contiguous run of rows,
+so nothing is parsed but the rows asked for, and opening a snapshot only reads its
+header. The file is mapped read-only, so every process reading a snapshot
+(such as run.pyparcel's workers) shares the same pages of the OS's page cache.
+
+The format is columnar and only needs the standard library:
+    MAGIC
+    The header's length (8 bytes, little endian), then the header as JSON:
+        fields, count, byteorder, and where each section starts
+    For each field in common.RECORD_FIELDS, in row order:
+        count + 1 offsets (unsigned 64 bit integers) into the column's values
+        the values, each a one byte type tag followed by its text
+    The parid index: the row numbers (unsigned 64 bit integers), sorted by parcel id
+Rows are sorted by municipality and then parcel id. The header holds the rows of each
+municipality as [first, last + 1].
+
+Build one with
+    python -m pyparcel.snapshot <path> --municodes 814 111 ...
+or from WPRDC responses saved by earlier runs
+    python -m pyparcel.snapshot <path> --json pyparcel/parcelidlists/*.json
+"""
+import argparse
+import json
+import logging
+import mmap
+import os
+import sys
+from array import array
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import requests
+
+import pyparcel.log as log
+from pyparcel.common import RECORD_FIELDS, Record
+
+MAGIC = b"PYPARCEL SNAPSHOT 1\n"
+_OFFSET = "Q"  # The array typecode of offsets and row numbers
+
+logger = logging.getLogger(__name__)
+
+# Type tags
+_NONE = b"n"
+_STR = b"s"
+_FLOAT = b"f"
+_INT = b"i"
+_JSON = b"j"
+
+
+def _encode(value) -> bytes:
+    if value is None:
+        return _NONE
+    if isinstance(value, str):
+        return _STR + value.encode("utf-8")
+    if isinstance(value, bool):
+        return _JSON + json.dumps(value).encode("utf-8")
+    if isinstance(value, float):
+        return _FLOAT + repr(value).encode("ascii")
+    if isinstance(value, int):
+        return _INT + str(value).encode("ascii")
+    return _JSON + json.dumps(value).encode("utf-8")
+
+
+def _decode(data: bytes):
+    tag, text = data[:1], data[1:]
+    if tag == _STR:
+        return text.decode("utf-8")
+    if tag == _NONE:
+        return None
+    if tag == _FLOAT:
+        return float(text)
+    if tag == _INT:
+        return int(text)
+    return json.loads(text)
+
+
+def _pad(f):
+    """ Aligns the next section to 8 bytes, so it can be cast without copying. """
+    f.write(b"\0" * (-f.tell() % 8))
+
+
+def _municode(record) -> str:
+    return str(record["MUNICODE"])
+
+
+def write(path: str, records: Iterable[dict]) -> str:
+    """
+    Writes records (dictionaries or Records) to a snapshot at path.
+    The snapshot replaces any file already at path atomically, so processes reading
+    the old snapshot keep their mapping of it.
+
+    Returns:
+        path
+    """
+    rows = sorted(records, key=lambda r: (_municode(r), r["PARID"]))
+    count = len(rows)
+    municipalities: Dict[str, List[int]] = {}
+    for i, row in enumerate(rows):
+        municipalities.setdefault(_municode(row), [i, i])[1] = i + 1
+    parid_index = array(_OFFSET, sorted(range(count), key=lambda i: rows[i]["PARID"]))
+
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        # The header's positions are only known once everything is written,
+        # so space is reserved for it and it's written last
+        columns = {}
+        body = []
+        for field in RECORD_FIELDS:
+            offsets = array(_OFFSET, [0])
+            values = bytearray()
+            for row in rows:
+                values += _encode(row.get(field))
+                offsets.append(len(values))
+            body.append((field, offsets, values))
+        header = {
+            "fields": list(RECORD_FIELDS),
+            "count": count,
+            "byteorder": sys.byteorder,
+            "municipalities": municipalities,
+            "columns": {},
+            "parid_index": 0,
+        }
+        # Positions are at most 20 digits, so this is enough room for the header
+        reserved = len(json.dumps(header)) + 64 * (len(RECORD_FIELDS) + 1)
+        f.write(MAGIC)
+        f.write(b"\0" * (8 + reserved))
+        for field, offsets, values in body:
+            _pad(f)
+            offsets_at = f.tell()
+            offsets.tofile(f)
+            values_at = f.tell()
+            f.write(values)
+            columns[field] = [offsets_at, values_at]
+        _pad(f)
+        header["columns"] = columns
+        header["parid_index"] = f.tell()
+        parid_index.tofile(f)
+
+        encoded = json.dumps(header).encode("utf-8")
+        assert len(encoded) <= reserved
+        f.seek(len(MAGIC))
+        f.write(len(encoded).to_bytes(8, "little"))
+        f.write(encoded)
+    os.replace(tmp, path)
+    return path
+
+
+class Snapshot:
+    """
+    A snapshot opened for reading:
+
+        with Snapshot(path) as snapshot:
+            record = snapshot.get("0374R00210000000")
+            for record in snapshot.municipality(814):
+                ...
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[: len(MAGIC)] != MAGIC:
+            self._map.close()
+            raise ValueError("{} is not a pyparcel snapshot".format(path))
+        start = len(MAGIC) + 8
+        length = int.from_bytes(self._map[len(MAGIC) : start], "little")
+        header = json.loads(self._map[start : start + length])
+        if header["byteorder"] != sys.byteorder:
+            self._map.close()
+            raise ValueError("{} was written on a different platform".format(path))
+        self.count: int = header["count"]
+        self.municipalities: Dict[str, List[int]] = header["municipalities"]
+        self._view = memoryview(self._map)
+        width = array(_OFFSET).itemsize
+        self._columns = {}
+        for field, (offsets_at, values_at) in header["columns"].items():
+            offsets = self._view[offsets_at : offsets_at + (self.count + 1) * width]
+            self._columns[field] = (offsets.cast(_OFFSET), values_at)
+        index_at = header["parid_index"]
+        self._parid_index = self._view[
+            index_at : index_at + self.count * width
+        ].cast(_OFFSET)
+
+    def close(self):
+        self._parid_index.release()
+        for offsets, _ in self._columns.values():
+            offsets.release()
+        self._columns.clear()
+        self._view.release()
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def value(self, field: str, row: int):
+        offsets, values_at = self._columns[field]
+        start, end = values_at + offsets[row], values_at + offsets[row + 1]
+        return _decode(self._map[start:end])
+
+    def record(self, row: int) -> Record:
+        return Record({field: self.value(field, row) for field in self._columns})
+
+    def _find(self, parid: str) -> Optional[int]:
+        """ The row of parid, by binary search over the parid index. """
+        index = self._parid_index
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.value("PARID", index[middle]) < parid:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self.value("PARID", index[low]) == parid:
+            return index[low]
+        return None
+
+    def get(self, parid: str) -> Optional[Record]:
+        row = self._find(parid)
+        return None if row is None else self.record(row)
+
+    def __contains__(self, parid: str) -> bool:
+        return self._find(parid) is not None
+
+    def _rows(self, municode) -> range:
+        first, end = self.municipalities.get(str(municode), (0, 0))
+        return range(first, end)
+
+    def size(self, municode) -> int:
+        """ The number of parcels in a municipality. """
+        return len(self._rows(municode))
+
+    def municipality(self, municode) -> Iterator[Record]:
+        """ A municipality's records, in parcel id order. """
+        for row in self._rows(municode):
+            yield self.record(row)
+
+    def parids(self, municode=None) -> Iterator[str]:
+        """ The parcel ids of a municipality, or of every parcel, without the rest. """
+        rows = range(self.count) if municode is None else self._rows(municode)
+        for row in rows:
+            yield self.value("PARID", row)
+
+
+def main():
+    # fetch.py reads snapshots, so it can't be imported at the top of this file
+    import pyparcel.fetch as fetch
+
+    parser = argparse.ArgumentParser(description="Builds a snapshot of WPRDC data.")
+    parser.add_argument("path")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument(
+        "--municodes", nargs="+", type=int, help="Fetches these municipalities"
+    )
+    source.add_argument("--json", nargs="+", help="Saved WPRDC responses")
+    args = parser.parse_args()
+
+    log.configure()
+    records = []
+    hook = Record.hook()
+    if args.json:
+        for filename in args.json:
+            with open(filename, "r") as f:
+                records.extend(json.load(f, object_hook=hook)["result"]["records"])
+    else:
+        for municode in args.municodes:
+            response = requests.get(
+                fetch._wprdc_url("""WHERE "MUNICODE" = '{}'""".format(municode))
+            )
+            records.extend(
+                json.loads(response.text, object_hook=hook)["result"]["records"]
+            )
+    write(args.path, records)
+    logger.info("Wrote {} records to {}".format(len(records), args.path))
+    log.flush()
+
+
+if __name__ == "__main__":
+    main()
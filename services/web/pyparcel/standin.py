@@ -0,0 +1,393 @@
+"""
+Local stand-ins for the county's Real Estate Portal and the WPRDC's datastore,
+for load testing and benchmarking runs end to end without touching the real services.
+
+Both serve a corpus (see Corpus): the portal serves Tax pages at
+<url>/Tax.aspx?ParcelID=<parid>, and the WPRDC answers datastore_search_sql calls
+filtered by "PARID" or "MUNICODE", the only queries fetch.py makes.
+Each stand-in can be made to behave like a struggling service (see Behavior):
+responses can be delayed, fail, or be throttled.
+
+Runs use the stand-ins when scrape.COUNTY_REAL_ESTATE_URL and fetch.WPRDC_URL point
+at them, either by serve() for the duration of a with statement, or by the
+environment variables PYPARCEL_COUNTY_URL and PYPARCEL_WPRDC_URL, which
+    python -m pyparcel.standin --corpus <directory>
+prints on start up.
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, List, Optional
+from urllib.parse import parse_qs, urlsplit
+
+import pyparcel.fetch as fetch
+import pyparcel.log as log
+import pyparcel.scrape as scrape
+from pyparcel.common import PARID_PATTERN, TAX
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+MOCKS = os.path.join(HERE, "..", "tests", "mocks")
+
+COUNTY_PATH = "/RealEstate/"
+WPRDC_PATH = "/api/3/action/datastore_search_sql"
+
+logger = logging.getLogger(__name__)
+
+
+# --------------------------------------------------------------------------------------
+# Corpus
+# --------------------------------------------------------------------------------------
+class Corpus:
+    """
+    The records and Tax pages served by the stand-ins.
+
+    A parcel without a page of its own is served the default page, if there is one,
+    so a corpus of many records can share a single page.
+    """
+
+    def __init__(
+        self,
+        records: Iterable[dict],
+        pages: Optional[Dict[str, str]] = None,
+        default_page: Optional[str] = None,
+    ):
+        self.records: List[dict] = list(records)
+        self.pages = pages or {}
+        self.default_page = default_page
+
+    def page(self, parid: str) -> Optional[str]:
+        return self.pages.get(parid, self.default_page)
+
+    def select(self, sql: str) -> List[dict]:
+        """ The records matching the WHERE clause of one of fetch.py's queries. """
+        match = re.search(r"\"(\w+)\"\s*=\s*'([^']*)'", sql)
+        if match:
+            column, values = match.group(1), {match.group(2)}
+        else:
+            match = re.search(r"\"(\w+)\"\s+IN\s*\(([^)]*)\)", sql, re.IGNORECASE)
+            if not match:
+                return list(self.records)
+            column = match.group(1)
+            values = set(re.findall(r"'([^']*)'", match.group(2)))
+        selected = [r for r in self.records if str(r.get(column)) in values]
+        if re.search(r"ORDER BY\s+\"PARID\"", sql, re.IGNORECASE):
+            selected.sort(key=lambda r: r["PARID"])
+        return selected
+
+    @classmethod
+    def from_directory(cls, directory: str = MOCKS) -> "Corpus":
+        """
+        Loads every .json file in directory as records: a single record, a list of
+        records, or a saved WPRDC response. Each .html file named after a parcel id
+        is that parcel's page. Any other .html file is the default page.
+        """
+        records = []
+        pages = {}
+        default_page = None
+        for name in sorted(os.listdir(directory)):
+            stem, extension = os.path.splitext(name)
+            filename = os.path.join(directory, name)
+            if extension == ".json":
+                with open(filename, "r") as f:
+                    data = json.load(f)
+                if isinstance(data, dict) and "result" in data:
+                    data = data["result"]["records"]
+                records.extend(data if isinstance(data, list) else [data])
+            elif extension == ".html":
+                with open(filename, "r", newline="") as f:
+                    html = f.read()
+                if PARID_PATTERN.fullmatch(stem) and stem == stem.upper():
+                    pages[stem] = html
+                else:
+                    default_page = html
+        return cls(records, pages, default_page)
+
+
+# --------------------------------------------------------------------------------------
+# Behavior
+# --------------------------------------------------------------------------------------
+def parse_latency(spec: str) -> Callable[[random.Random], float]:
+    """
+    Parses a latency distribution, in seconds.
+
+    Args:
+        spec: One of
+            "fixed:<seconds>"
+            "uniform:<low>,<high>"
+            "normal:<mean>,<standard deviation>" (never below zero)
+            "lognormal:<median>,<sigma>" (a long tail, like most web services)
+            "exponential:<mean>"
+    Returns:
+        A function drawing a latency from the distribution with the given random
+        number generator
+    """
+    name, _, arguments = spec.partition(":")
+    try:
+        values = [float(v) for v in arguments.split(",")] if arguments else []
+        if name == "fixed":
+            (seconds,) = values
+            return lambda rng: seconds
+        if name == "uniform":
+            low, high = values
+            return lambda rng: rng.uniform(low, high)
+        if name == "normal":
+            mean, deviation = values
+            return lambda rng: max(0.0, rng.gauss(mean, deviation))
+        if name == "lognormal":
+            median, sigma = values
+            return lambda rng: rng.lognormvariate(math.log(median), sigma)
+        if name == "exponential":
+            (mean,) = values
+            return lambda rng: rng.expovariate(1 / mean)
+    except ValueError:
+        pass
+    raise ValueError("{!r} is not a valid latency distribution".format(spec))
+
+
+class Behavior:
+    """
+    How a stand-in responds.
+
+    Args:
+        latency: The distribution responses are delayed by (see parse_latency)
+        error_rate: The fraction of requests answered with a 500
+        rate: The requests per second accepted. Requests beyond it, after a burst,
+            are answered with a 429 and a Retry-After header. Unlimited when None.
+        burst: The requests accepted at once before rate applies
+        seed: Seeds the latencies and errors, for repeatable runs
+    """
+
+    def __init__(
+        self,
+        latency: str = "fixed:0",
+        error_rate: float = 0.0,
+        rate: Optional[float] = None,
+        burst: int = 1,
+        seed: Optional[int] = None,
+    ):
+        self.latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.rate = rate
+        self.burst = burst
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._refilled = time.monotonic()
+
+    def delay(self) -> float:
+        with self._lock:
+            return self.latency(self._random)
+
+    def fails(self) -> bool:
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def throttled(self) -> Optional[float]:
+        """
+        Returns:
+            The seconds until a request would be accepted,
+            or None if this one is (a token bucket)
+        """
+        if self.rate is None:
+            return None
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._refilled) * self.rate
+            )
+            self._refilled = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return None
+            return (1 - self._tokens) / self.rate
+
+
+# --------------------------------------------------------------------------------------
+# Servers
+# --------------------------------------------------------------------------------------
+class _Handler(BaseHTTPRequestHandler):
+    # Set by _server
+    corpus: Corpus
+    behavior: Behavior
+    respond: Callable[..., tuple]
+
+    def do_GET(self):
+        wait = self.behavior.throttled()
+        if wait is not None:
+            self._send(429, "text/plain", "Too many requests", retry_after=wait)
+            return
+        time.sleep(self.behavior.delay())
+        if self.behavior.fails():
+            self._send(500, "text/plain", "Internal server error")
+            return
+        url = urlsplit(self.path)
+        self._send(*self.respond(self, url.path, parse_qs(url.query)))
+
+    def _send(self, status, content_type, body, retry_after=None):
+        body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type + "; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        if retry_after is not None:
+            self.send_header("Retry-After", str(math.ceil(retry_after)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args, extra={"server": type(self).__name__})
+
+
+def _county(handler: _Handler, path: str, query: dict) -> tuple:
+    if path != COUNTY_PATH + TAX + ".aspx":
+        return 404, "text/plain", "Not found"
+    parid = query.get("ParcelID", [""])[0]
+    page = handler.corpus.page(parid)
+    if page is None:
+        return 404, "text/plain", "Not found"
+    return 200, "text/html", page
+
+
+def _wprdc(handler: _Handler, path: str, query: dict) -> tuple:
+    if path != WPRDC_PATH:
+        return 404, "application/json", json.dumps({"success": False})
+    records = handler.corpus.select(query.get("sql", [""])[0])
+    response = {"success": True, "result": {"records": records, "fields": []}}
+    return 200, "application/json", json.dumps(response)
+
+
+def _server(name, respond, corpus, behavior, host, port) -> ThreadingHTTPServer:
+    handler = type(
+        name,
+        (_Handler,),
+        {"corpus": corpus, "behavior": behavior, "respond": staticmethod(respond)},
+    )
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+class StandIns:
+    """ The stand-in portal and WPRDC, each served on a thread of its own. """
+
+    def __init__(
+        self,
+        corpus: Corpus,
+        county: Optional[Behavior] = None,
+        wprdc: Optional[Behavior] = None,
+        host: str = "127.0.0.1",
+        county_port: int = 0,
+        wprdc_port: int = 0,
+    ):
+        self.county = _server(
+            "County", _county, corpus, county or Behavior(), host, county_port
+        )
+        self.wprdc = _server(
+            "Wprdc", _wprdc, corpus, wprdc or Behavior(), host, wprdc_port
+        )
+        self._threads = []
+
+    @property
+    def county_url(self) -> str:
+        host, port = self.county.server_address[:2]
+        return "http://{}:{}{}".format(host, port, COUNTY_PATH)
+
+    @property
+    def wprdc_url(self) -> str:
+        host, port = self.wprdc.server_address[:2]
+        return "http://{}:{}{}".format(host, port, WPRDC_PATH)
+
+    def start(self):
+        for server in (self.county, self.wprdc):
+            thread = threading.Thread(
+                target=server.serve_forever, name="pyparcel-standin", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        for server in (self.county, self.wprdc):
+            server.shutdown()
+            server.server_close()
+        for thread in self._threads:
+            thread.join()
+
+
+@contextmanager
+def serve(corpus: Corpus, county: Optional[Behavior] = None, wprdc=None):
+    """
+    Starts the stand-ins and points scrape.py and fetch.py at them
+    for the body of the with statement.
+    """
+    stand_ins = StandIns(corpus, county, wprdc)
+    stand_ins.start()
+    urls = (scrape.COUNTY_REAL_ESTATE_URL, fetch.WPRDC_URL)
+    scrape.COUNTY_REAL_ESTATE_URL = stand_ins.county_url
+    fetch.WPRDC_URL = stand_ins.wprdc_url
+    try:
+        yield stand_ins
+    finally:
+        scrape.COUNTY_REAL_ESTATE_URL, fetch.WPRDC_URL = urls
+        stand_ins.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serves stand-ins for the Real Estate Portal and the WPRDC."
+    )
+    parser.add_argument("--corpus", default=MOCKS, help="See Corpus.from_directory")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--county-port", type=int, default=8001)
+    parser.add_argument("--wprdc-port", type=int, default=8002)
+    for service in ("county", "wprdc"):
+        parser.add_argument("--{}-latency".format(service), default="fixed:0")
+        parser.add_argument("--{}-error-rate".format(service), type=float, default=0)
+        parser.add_argument("--{}-rate".format(service), type=float)
+        parser.add_argument("--{}-burst".format(service), type=int, default=1)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    def behavior(service):
+        return Behavior(
+            latency=getattr(args, service + "_latency"),
+            error_rate=getattr(args, service + "_error_rate"),
+            rate=getattr(args, service + "_rate"),
+            burst=getattr(args, service + "_burst"),
+            seed=args.seed,
+        )
+
+    log.configure()
+    corpus = Corpus.from_directory(args.corpus)
+    stand_ins = StandIns(
+        corpus,
+        behavior("county"),
+        behavior("wprdc"),
+        args.host,
+        args.county_port,
+        args.wprdc_port,
+    )
+    stand_ins.start()
+    logger.info(
+        "Serving {} records".format(len(corpus.records)),
+        extra={
+            "PYPARCEL_COUNTY_URL": stand_ins.county_url,
+            "PYPARCEL_WPRDC_URL": stand_ins.wprdc_url,
+        },
+    )
+    log.flush()
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        stand_ins.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+"""
+Synthetic municipalities, for testing runs at scale without touching the real services.
+
+Seeds (real pages and records, tests/mocks by default) are turned into templates with
+utils.replace_parid, utils.replace_name and utils.replace_taxstatus, which write
+placeholders into the page once. Each synthetic parcel is then a copy of a seed
+record and a string substitution into a seed page, with its own parcel id, owner,
+and tax history, so a 100,000 parcel municipality takes seconds, not hours of soup.
+
+A municipality can be written to disk as a corpus for standin.Corpus.from_directory:
+    python -m pyparcel.synthetic --parcels 10000 --out <directory>
+or served by the stand-ins directly, generating each page when it's requested:
+    python -m pyparcel.synthetic --parcels 100000 --serve
+"""
+import argparse
+import json
+import logging
+import os
+import pickle
+import random
+import time
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+import pyparcel.log as log
+import pyparcel.parse as parse
+import pyparcel.standin as standin
+import pyparcel.utils as utils
+from pyparcel.common import TaxStatus
+
+logger = logging.getLogger(__name__)
+
+# The seeds in tests/mocks. The paid soup's tax table can't be rewritten by
+# utils.replace_taxstatus, so it isn't one.
+SEED_PAGES = ["real_estate_portal.html", "unpaid.pickle", "balancedue.pickle"]
+SEED_RECORDS = ["record.json", "person1_record.json"]
+
+DEFAULT_MUNICODE = 999
+TAX_YEARS = 4
+CURRENT_TAX_YEAR = 2020
+
+# Placeholders written into the seed pages. Tax years are numbers, since
+# utils.replace_taxstatus reads the most recent one into the record.
+PARID = "SYNTHETICPARID"
+OWNER = "SYNTHETICOWNER"
+_TAX_FIELDS = ("paidstatus", "tax", "penalty", "interest", "total", "date_paid")
+
+# (USECODE, CLASS), weighted roughly like a residential municipality
+LAND_USES = [
+    ("010", "R"),
+    ("010", "R"),
+    ("010", "R"),
+    ("020", "R"),
+    ("100", "R"),
+    ("200", "C"),
+    ("300", "I"),
+    ("400", "G"),
+]
+LAST_NAMES = "SMITH JOHNSON WILLIAMS BROWN JONES MILLER DAVIS WILSON TAYLOR".split()
+FIRST_NAMES = "MARY JOHN PATRICIA ROBERT JENNIFER MICHAEL LINDA WILLIAM SUSAN".split()
+STREETS = ["NORTH AVE", "MAIN ST", "ELM ST", "OAK AVE", "HILL RD", "RIVER RD"]
+
+
+def _year_placeholder(i: int) -> str:
+    return str(77770000 + i)
+
+
+def _placeholder(i: int, field: str) -> str:
+    return "SYNTHETICTAX{}{}".format(i, field.upper().replace("_", ""))
+
+
+class Parcel(NamedTuple):
+    parid: str
+    lot_and_block: str  # The parcel id, with hyphens, as the portal shows it
+    owner: str
+    taxes: List[TaxStatus]
+    record: dict
+
+
+class Template:
+    """ A seed page with placeholders for a parcel's id, owner, and tax history. """
+
+    def __init__(self, html: str):
+        taxes = [
+            TaxStatus(_year_placeholder(i), *[_placeholder(i, f) for f in _TAX_FIELDS])
+            for i in range(TAX_YEARS)
+        ]
+        soup = parse.soupify_html(html)
+        soup, _ = utils.replace_parid(PARID, soup, {})
+        soup = utils.replace_name(OWNER, soup)
+        soup, _ = utils.replace_taxstatus(taxes, soup, {})
+        self.html = str(soup)
+
+    def render(self, parcel: Parcel) -> str:
+        html = self.html.replace(PARID, parcel.lot_and_block)
+        html = html.replace(OWNER, parcel.owner)
+        for i, tax in enumerate(parcel.taxes):
+            html = html.replace(_year_placeholder(i), tax.year)
+            for field in _TAX_FIELDS:
+                html = html.replace(_placeholder(i, field), getattr(tax, field) or "")
+        return html
+
+
+def _load_page(filename: str) -> str:
+    if filename.endswith(".pickle"):
+        with open(filename, "rb") as p:
+            return str(pickle.load(p))
+    with open(filename, "r") as f:
+        return f.read()
+
+
+def load_seeds(
+    directory: str = standin.MOCKS,
+    pages: List[str] = SEED_PAGES,
+    records: List[str] = SEED_RECORDS,
+) -> Tuple[List[Template], List[dict]]:
+    templates = [Template(_load_page(os.path.join(directory, p))) for p in pages]
+    seed_records = []
+    for name in records:
+        with open(os.path.join(directory, name), "r") as f:
+            seed_records.append(json.load(f))
+    return templates, seed_records
+
+
+def _dollars(cents: int) -> str:
+    return "${:,}.{:02d}".format(cents // 100, cents % 100)
+
+
+def _taxes(rng: random.Random) -> List[TaxStatus]:
+    taxes = []
+    tax = rng.randrange(5000, 1000000)
+    for i in range(TAX_YEARS):
+        year = CURRENT_TAX_YEAR - i
+        status = rng.choices(["PAID", "UNPAID", "BALANCE DUE"], [85, 10, 5])[0]
+        penalty = interest = 0
+        if status != "PAID":
+            penalty, interest = tax // 20, tax // 100
+        taxes.append(
+            TaxStatus(
+                year=str(year),
+                paidstatus=status,
+                tax=_dollars(tax),
+                penalty=_dollars(penalty),
+                interest=_dollars(interest),
+                total=_dollars(tax + penalty + interest),
+                date_paid="6/{}/{}".format(rng.randrange(1, 29), year)
+                if status == "PAID"
+                else None,
+            )
+        )
+    return taxes
+
+
+def _record(seed_record: dict, parid: str, municode: int, rng, taxes) -> dict:
+    """ A copy of a seed record, with the fields runs read or compare changed. """
+    record = dict(seed_record)
+    housenum = str(rng.randrange(1, 2000))
+    street = rng.choice(STREETS)
+    land = float(rng.randrange(10, 500) * 100)
+    building = float(rng.randrange(0, 3000) * 100)
+    record.update(
+        {
+            "PARID": parid,
+            "MUNICODE": str(municode),
+            "PROPERTYHOUSENUM": housenum,
+            "PROPERTYADDRESS": street,
+            "CHANGENOTICEADDRESS1": "{}   {}   ".format(housenum, street),
+            "SALEPRICE": float(rng.randrange(1, 400) * 1000),
+            "FINISHEDLIVINGAREA": float(rng.randrange(500, 4000)),
+            "CONDITION": str(rng.randrange(1, 9)),
+            "COUNTYLAND": land,
+            "COUNTYBUILDING": building,
+            "FAIRMARKETTOTAL": land + building,
+            "TAXYEAR": float(taxes[0].year),
+        }
+    )
+    record["USECODE"], record["CLASS"] = rng.choice(LAND_USES)
+    return record
+
+
+def parcels(
+    count: int,
+    municode: int = DEFAULT_MUNICODE,
+    seed_records: Optional[List[dict]] = None,
+    seed: int = 0,
+) -> Iterator[Parcel]:
+    """
+    Generates a municipality's parcels. The same arguments generate the same parcels.
+
+    Parcel ids are <municode>S<number>, so synthetic parcels can't collide with
+    real ones or with another synthetic municipality's.
+    """
+    if seed_records is None:
+        _, seed_records = load_seeds()
+    for i in range(count):
+        yield parcel(i, municode, seed_records, seed)
+
+
+def parcel(i: int, municode: int, seed_records: List[dict], seed: int = 0) -> Parcel:
+    """ The i-th parcel of a municipality. """
+    rng = random.Random("{}:{}:{}".format(seed, municode, i))
+    lot_and_block = "{:04d}-S-{:05d}-{:04d}-00".format(municode, i // 10000, i % 10000)
+    parid = parse.remove_hyphnes(lot_and_block)
+    owner = "{} {} {}".format(
+        rng.choice(LAST_NAMES), rng.choice(FIRST_NAMES), rng.choice("ABCDEJKLMR")
+    )
+    taxes = _taxes(rng)
+    record = _record(seed_records[i % len(seed_records)], parid, municode, rng, taxes)
+    return Parcel(parid, lot_and_block, owner, taxes, record)
+
+
+def _index(parid: str, municode: int) -> Optional[int]:
+    """ The number of a municipality's synthetic parcel id, or None if it isn't one. """
+    prefix = "{:04d}S".format(municode)
+    if len(parid) != 16 or not parid.startswith(prefix) or not parid[5:].isdigit():
+        return None
+    return int(parid[5:10]) * 10000 + int(parid[10:14])
+
+
+class Corpus(standin.Corpus):
+    """
+    A synthetic municipality, for the stand-ins.
+    Records are generated up front; pages are rendered when they're requested.
+    """
+
+    def __init__(
+        self,
+        count: int,
+        municode: int = DEFAULT_MUNICODE,
+        seed: int = 0,
+        seeds: Optional[Tuple[List[Template], List[dict]]] = None,
+    ):
+        self.templates, seed_records = seeds or load_seeds()
+        self.municode = municode
+        self.count = count
+        self.seed = seed
+        self._seed_records = seed_records
+        super().__init__(
+            p.record for p in parcels(count, municode, seed_records, seed)
+        )
+
+    def page(self, parid: str) -> Optional[str]:
+        i = _index(parid, self.municode)
+        if i is None or i >= self.count:
+            return None
+        return self.templates[i % len(self.templates)].render(
+            parcel(i, self.municode, self._seed_records, self.seed)
+        )
+
+
+def write(
+    directory: str,
+    count: int,
+    municode: int = DEFAULT_MUNICODE,
+    seed: int = 0,
+    seeds: Optional[Tuple[List[Template], List[dict]]] = None,
+) -> str:
+    """
+    Writes a municipality to directory as a corpus for standin.Corpus.from_directory:
+    a page per parcel, named after its parcel id, and the records as a WPRDC response.
+
+    Returns:
+        directory
+    """
+    templates, seed_records = seeds or load_seeds()
+    os.makedirs(directory, exist_ok=True)
+    records = []
+    for i, p in enumerate(parcels(count, municode, seed_records, seed)):
+        # Keeps the seed pages' line endings
+        with open(os.path.join(directory, p.parid + ".html"), "w", newline="") as f:
+            f.write(templates[i % len(templates)].render(p))
+        records.append(p.record)
+    with open(os.path.join(directory, "records.json"), "w") as f:
+        json.dump({"success": True, "result": {"records": records}}, f)
+    return directory
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generates a synthetic municipality.")
+    parser.add_argument("--parcels", type=int, default=10000)
+    parser.add_argument("--municode", type=int, default=DEFAULT_MUNICODE)
+    parser.add_argument("--seed", type=int, default=0)
+    output = parser.add_mutually_exclusive_group(required=True)
+    output.add_argument("--out", help="Writes the municipality to this directory")
+    output.add_argument(
+        "--serve", action="store_true", help="Serves the municipality on stand-ins"
+    )
+    args = parser.parse_args()
+
+    log.configure()
+    start = time.time()
+    if args.out:
+        write(args.out, args.parcels, args.municode, args.seed)
+        logger.info(
+            "Wrote {} parcels to {}".format(args.parcels, args.out),
+            extra={"seconds": round(time.time() - start, 1)},
+        )
+        return
+    corpus = Corpus(args.parcels, args.municode, args.seed)
+    with standin.serve(corpus) as stand_ins:
+        logger.info(
+            "Serving {} parcels".format(args.parcels),
+            extra={
+                "municode": args.municode,
+                "PYPARCEL_COUNTY_URL": stand_ins.county_url,
+                "PYPARCEL_WPRDC_URL": stand_ins.wprdc_url,
+            },
+        )
+        log.flush()
+        try:
+            while True:
+                time.sleep(60)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
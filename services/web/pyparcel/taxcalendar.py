@@ -0,0 +1,107 @@
+"""
+Decides whether a parcel's Tax page is worth scraping today.
+
+A parcel's tax status only changes at known points: when the year's bills are
+issued, at the discount and face deadlines (after which the amount due goes up),
+and when a payment posts. So the last TaxStatus parsed from a parcel's page,
+and when it was seen, say whether the page can have changed since:
+    - A parcel without a bill for the current tax year is due, since one has been
+      issued since.
+    - A parcel that has paid for the current tax year isn't due until the next
+      year's bills are issued. One without a paid status on record is always due.
+    - An unpaid parcel is due once a deadline passes, since its total changed,
+      or every UNPAID_RECHECK_DAYS, since a payment may have posted.
+The page's date paid isn't consulted: a paid parcel waits for the next bills
+whenever it paid, and an unpaid parcel's next payment only shows up by scraping.
+The Tax page is also where owners are scraped from, so a parcel the WPRDC
+records a new sale for is due regardless.
+
+A parcel that isn't due is only skipped if its WPRDC record is also the same as at
+its last update (see update.record_unchanged), so changes to the WPRDC's data are
+still written.
+
+Opt in with PYPARCEL_TAX_CALENDAR=1. Otherwise every parcel is scraped.
+"""
+import os
+from datetime import date
+from typing import NamedTuple, Optional, Tuple
+
+from pyparcel.common import LastTaxStatus
+
+ENABLED = os.environ.get("PYPARCEL_TAX_CALENDAR", "0") == "1"
+
+PAID = "PAID"
+UNPAID_RECHECK_DAYS = 7
+
+
+class TaxCalendar(NamedTuple):
+    """ The (month, day)s of a tax year on which a bill's status changes. """
+
+    bills: Tuple[int, int]  # Bills are issued, starting the tax year
+    discount: Tuple[int, int]  # The last day to pay the discounted (net) amount
+    face: Tuple[int, int]  # The last day to pay the face amount; penalties follow
+
+    def tax_year(self, today: date) -> int:
+        """ The tax year of the most recent bills. """
+        if today >= date(today.year, *self.bills):
+            return today.year
+        return today.year - 1
+
+    def changes(self, tax_year: int):
+        """ The days on which an unpaid bill's total changes. """
+        yield date(tax_year, *self.bills)
+        for month, day in (self.discount, self.face):
+            # The day after the deadline, since the deadline is still the old amount
+            yield date.fromordinal(date(tax_year, month, day).toordinal() + 1)
+
+
+# Allegheny County's real estate taxes
+COUNTY = TaxCalendar(bills=(1, 1), discount=(1, 31), face=(4, 30))
+
+
+def _sold_since(record, last: LastTaxStatus) -> bool:
+    """ Whether the WPRDC records a sale that wasn't on record at the last update. """
+    sale_date = record.get("SALEDATE")
+    sale_year = sale_date[-4:] if sale_date else None
+    if str(sale_year) != str(last.saleyear):
+        return True
+    try:
+        return float(record.get("SALEPRICE")) != float(last.saleprice)
+    except (TypeError, ValueError):  # No sale price on one side or the other
+        return record.get("SALEPRICE") != last.saleprice
+
+
+def due(
+    last: Optional[LastTaxStatus],
+    today: Optional[date] = None,
+    record: Optional[dict] = None,
+    calendar: TaxCalendar = COUNTY,
+) -> bool:
+    """
+    Whether a parcel's Tax page needs scraping today.
+
+    Args:
+        last: From fetch.last_tax_statuses. None if the parcel was never updated.
+        record: The parcel's WPRDC record, if it's in hand
+    """
+    if last is None or last.seen is None:
+        return True
+    if record is not None and _sold_since(record, last):
+        return True
+    today = today or date.today()
+    tax_year = calendar.tax_year(today)
+    try:
+        year = int(last.tax_status.year)
+    except (TypeError, ValueError):  # No tax status on record
+        return True
+    if year < tax_year:
+        return True
+    paidstatus = last.tax_status.paidstatus
+    if paidstatus is None:  # Can't tell whether it has paid
+        return True
+    if paidstatus == PAID:
+        return False
+    seen = last.seen
+    if any(seen < change <= today for change in calendar.changes(tax_year)):
+        return True
+    return (today - seen).days >= UNPAID_RECHECK_DAYS
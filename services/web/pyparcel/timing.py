@@ -0,0 +1,311 @@
+"""
+Per-stage timings of parcel updates, for finding out where a slow run spent its time.
+
+The stages of updating a parcel are wrapped in timing.stage (or timing.timed):
+fetching, parsing and writing it, and within those, fetching its WPRDC record,
+scraping the portal, soupifying, parsing the owner and tax status, each write.* call,
+change detection, each event, and the commit.
+Timings go to every Recorder active in the current context (see contextvars),
+so runs going at once in the same process each get their own. Run.pyparcel starts
+one per run and saves its report next to the run's summary. Threads started on
+a run's behalf are started in a copy of its context. With no recorder active,
+stages aren't timed. A trace.Tracer is a recorder too.
+
+Timings are attributed to the parcel the current thread is working on
+(see start_parcel). Work done on another thread or process on behalf of a parcel
+is captured there and recorded by whoever knows the parcel (see pipeline._parse).
+"""
+import contextvars
+import functools
+import heapq
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+# Stage names
+FETCH = "fetch"
+PARSE = "parse"
+WRITE = "write"
+WPRDC = "wprdc"
+SCRAPE = "scrape"
+SOUPIFY = "soupify"
+OWNER = "owner"
+TAX = "tax"
+CHANGES = "changes"
+EVENT = "event"
+COMMIT = "commit"
+# The stages that the others are nested in. A parcel's time is the sum of these.
+OUTER = (FETCH, PARSE, WRITE)
+
+# The number of timings per stage kept for percentiles
+SAMPLES = 10000
+# The number of parcels listed in a report as the slowest
+SLOWEST = 20
+
+_recorders = contextvars.ContextVar("pyparcel_timing_recorders", default=())
+_local = threading.local()
+
+
+def start_parcel(parid: Optional[str]):
+    """ Attributes the current thread's timings to parid until told otherwise. """
+    _local.parid = parid
+
+
+def add_recorder(recorder):
+    _recorders.set(_recorders.get() + (recorder,))
+
+
+def remove_recorder(recorder):
+    _recorders.set(tuple(r for r in _recorders.get() if r is not recorder))
+
+
+def record(
+    name: str,
+    seconds: float,
+    parid: Optional[str] = None,
+    start: Optional[float] = None,
+    pid: Optional[int] = None,
+    thread: Optional[int] = None,
+):
+    """
+    Args:
+        name: The stage
+        seconds: How long the stage took
+        parid: The parcel. Defaults to the parcel the current thread is working on.
+        start: When the stage started, as a time.time()
+        pid, thread: Where the stage ran. Default to the current process and thread.
+    """
+    pid = pid or os.getpid()
+    thread = thread or threading.get_ident()
+    captured = getattr(_local, "captured", None)
+    if captured is not None:
+        captured.append((name, seconds, start, pid, thread))
+        return
+    if parid is None:
+        parid = getattr(_local, "parid", None)
+    for recorder in _recorders.get():
+        recorder.add(name, seconds, parid, start, pid, thread)
+
+
+def _timing() -> bool:
+    return bool(_recorders.get()) or getattr(_local, "captured", None) is not None
+
+
+@contextmanager
+def stage(name: str):
+    """ Times the body of the with statement as the stage `name`. """
+    if not _timing():
+        yield
+        return
+    start = time.time()
+    counter = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - counter, start=start)
+
+
+def timed(name: str):
+    """ Decorator version of stage. """
+
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return f(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def capture():
+    """
+    Collects the current thread's timings into a list of the arguments to record,
+    less the parcel, instead of recording them,
+    so they can be sent to another thread or process.
+    """
+    captured = []
+    previous = getattr(_local, "captured", None)
+    _local.captured = captured
+    try:
+        yield captured
+    finally:
+        _local.captured = previous
+
+
+def reset():
+    """ Forgets every recorder. A forked process inherits its parent's. """
+    _recorders.set(())
+
+
+def merge(state: dict):
+    """ Adds the state of another process's recorder to every active recorder. """
+    for recorder in _recorders.get():
+        recorder.merge(state)
+
+
+class _Stage:
+    """ Running totals for a stage, plus a uniform sample of its timings. """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples: List[float] = []
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        # Reservoir sampling
+        if len(self.samples) < SAMPLES:
+            self.samples.append(seconds)
+        else:
+            i = random.randrange(self.count)
+            if i < SAMPLES:
+                self.samples[i] = seconds
+
+    def merge(self, other: dict):
+        self.samples = _merge_samples(
+            self.samples, self.count, other["samples"], other["count"]
+        )
+        self.count += other["count"]
+        self.total += other["total"]
+        self.max = max(self.max, other["max"])
+
+    def summary(self) -> dict:
+        samples = sorted(self.samples)
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": _percentile(samples, 50),
+            "p90": _percentile(samples, 90),
+            "p99": _percentile(samples, 99),
+            "max": self.max,
+        }
+
+
+def _merge_samples(
+    a: List[float], a_count: int, b: List[float], b_count: int
+) -> List[float]:
+    """
+    A uniform sample of two stages' timings, given a uniform sample of each.
+    Each sample stands for its stage's count of timings, so every pick comes from
+    one side or the other in proportion to the timings it has left.
+    """
+    if len(a) + len(b) <= SAMPLES:
+        # Neither sample has been thinned, so together they're every timing
+        return a + b
+    a = random.sample(a, len(a))
+    b = random.sample(b, len(b))
+    merged = []
+    while len(merged) < SAMPLES and (a or b):
+        if a and (not b or random.random() * (a_count + b_count) < a_count):
+            merged.append(a.pop())
+            a_count -= 1
+        else:
+            merged.append(b.pop())
+            b_count -= 1
+    return merged
+
+
+def _percentile(ordered: List[float], percent: float) -> float:
+    if not ordered:
+        return 0.0
+    i = min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))
+    return ordered[i]
+
+
+class Recorder:
+    """
+    Collects timings while active:
+
+        with timing.Recorder() as recorder:
+            ...
+        recorder.report()
+    """
+
+    def __init__(self):
+        self.stages: Dict[str, _Stage] = {}
+        # The stages of parcels still being worked on
+        self._parcels: Dict[str, Dict[str, float]] = {}
+        # (total seconds, parid, stages) of the slowest parcels, smallest first
+        self._slowest: List[Tuple[float, str, Dict[str, float]]] = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        add_recorder(self)
+
+    def stop(self):
+        remove_recorder(self)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def add(self, name, seconds, parid=None, start=None, pid=None, thread=None):
+        """ Called by record. Where and when the stage ran is only used by tracers. """
+        with self._lock:
+            self.stages.setdefault(name, _Stage()).add(seconds)
+            if parid is not None:
+                stages = self._parcels.setdefault(parid, {})
+                stages[name] = stages.get(name, 0.0) + seconds
+                if name == WRITE:
+                    # The parcel is done, so its total can be compared with the slowest
+                    self._keep_if_slow(parid, self._parcels.pop(parid))
+
+    def _keep_if_slow(self, parid, stages):
+        entry = (sum(stages.get(name, 0.0) for name in OUTER), parid, stages)
+        if len(self._slowest) < SLOWEST:
+            heapq.heappush(self._slowest, entry)
+        elif entry > self._slowest[0]:
+            heapq.heapreplace(self._slowest, entry)
+
+    def state(self) -> dict:
+        """ Everything recorded, as plain data that can be sent between processes. """
+        with self._lock:
+            for parid in list(self._parcels):
+                self._keep_if_slow(parid, self._parcels.pop(parid))
+            return {
+                "stages": {
+                    name: {**vars(s), "samples": list(s.samples)}
+                    for name, s in self.stages.items()
+                },
+                "slowest": list(self._slowest),
+            }
+
+    def merge(self, state: dict):
+        """ Adds the state of another process's recorder. """
+        with self._lock:
+            for name, other in state["stages"].items():
+                self.stages.setdefault(name, _Stage()).merge(other)
+            for seconds, parid, stages in state["slowest"]:
+                self._keep_if_slow(parid, stages)
+
+    def report(self) -> dict:
+        """
+        Returns:
+            Keys:
+                "stages": {stage: {"count", "total", "mean", "p50", "p90", "p99",
+                                   "max"}}
+                "slowest": [{"parid", "seconds", "stages": {stage: seconds}}]
+        """
+        state = self.state()
+        with self._lock:
+            stages = {
+                name: self.stages[name].summary() for name in sorted(self.stages)
+            }
+        slowest = [
+            {"parid": parid, "seconds": seconds, "stages": parcel_stages}
+            for seconds, parid, parcel_stages in sorted(state["slowest"], reverse=True)
+        ]
+        return {"stages": stages, "slowest": slowest}
@@ -0,0 +1,162 @@
+"""
+Records every stage of every parcel as a span on a timeline, in the Chrome trace
+event format. Open the trace with chrome://tracing or https://ui.perfetto.dev.
+
+Each thread (and parse process) gets its own row, so stalls and backpressure between
+the pipeline's stages show up as gaps. The time a parcel spends waiting in the
+pipeline's queues is drawn as its own "waiting for parse" / "waiting for write" spans.
+Every span's args name its parcel.
+
+A Tracer is a timing recorder (see timing.py): it draws the same stages the run's
+timing report totals. Each process traces into a file of its own, one event per line,
+and the files are merged into a single trace when the run finishes (see merge).
+"""
+import json
+import os
+import shutil
+import threading
+from typing import Optional
+
+import pyparcel.timing as timing
+
+QUEUE = "queue"
+
+# The tracer of this process, if any
+_active = None
+
+
+class Tracer:
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock()
+        self._named = set()
+
+    def start(self):
+        global _active
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Line buffered, so nothing is left in the buffer for a forked process to
+        # write a second time
+        self._file = open(self.path, "a", buffering=1)
+        self._write(
+            {
+                "name": "process_name",
+                "ph": "M",
+                "pid": os.getpid(),
+                "args": {"name": "pyparcel {}".format(os.getpid())},
+            }
+        )
+        _active = self
+        timing.add_recorder(self)
+
+    def stop(self):
+        global _active
+        timing.remove_recorder(self)
+        if _active is self:
+            _active = None
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _write(self, event: dict):
+        with self._lock:
+            if self._file is not None:
+                self._file.write(json.dumps(event) + "\n")
+
+    def _row(self, pid: int, thread: int) -> int:
+        """ Names the row a thread's spans are drawn on, the first time it's seen. """
+        # Parse processes are drawn as rows of this process,
+        # so the whole pipeline can be seen at once
+        row = thread if pid == os.getpid() else pid
+        if row in self._named:
+            return row
+        self._named.add(row)
+        if pid == os.getpid():
+            names = {t.ident: t.name for t in threading.enumerate()}
+            name = names.get(thread, str(thread))
+        else:
+            name = "parse process {}".format(pid)
+        self._write(
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": os.getpid(),
+                "tid": row,
+                "args": {"name": name},
+            }
+        )
+        return row
+
+    def add(self, name, seconds, parid=None, start=None, pid=None, thread=None):
+        """ Draws a stage. Called by timing.record. """
+        if start is None:
+            return
+        row = self._row(pid, thread)
+        self._write(
+            {
+                "name": name,
+                "cat": "parcel",
+                "ph": "X",
+                "ts": _microseconds(start),
+                "dur": _microseconds(seconds),
+                "pid": os.getpid(),
+                "tid": row,
+                "args": {"parid": parid},
+            }
+        )
+
+    def waited(self, name: str, start: float, end: float, parid: str):
+        """ Draws time a parcel spent waiting, on a row of its own. """
+        if end <= start:
+            return
+        event = {"name": name, "cat": QUEUE, "id": parid, "pid": os.getpid()}
+        self._write({**event, "ph": "b", "ts": _microseconds(start)})
+        self._write({**event, "ph": "e", "ts": _microseconds(end)})
+
+
+def _microseconds(seconds: float) -> int:
+    return int(seconds * 1000000)
+
+
+def waited(name: str, start: Optional[float], end: float, parid: str):
+    """ Records the time a parcel spent waiting, if this process is being traced. """
+    if _active is not None and start is not None:
+        _active.waited(name, start, end, parid)
+
+
+def reset():
+    """ Forgets the tracer a forked process inherited from its parent. """
+    global _active
+    _active = None
+
+
+def merge(directory: str, path: str) -> str:
+    """
+    Merges the per-process files in directory into a single trace at path,
+    then removes the directory.
+
+    Returns:
+        path
+    """
+    with open(path, "w") as trace:
+        trace.write("[\n")
+        first = True
+        for name in sorted(os.listdir(directory)):
+            with open(os.path.join(directory, name), "r") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    trace.write(line if first else ",\n" + line)
+                    first = False
+        trace.write("\n]\n")
+    shutil.rmtree(directory)
+    return path
@@ -1,14 +1,22 @@
-from typing import Optional
+import contextvars
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Iterator, Optional
 
 import pyparcel.create as create
 import pyparcel.events as events
 import pyparcel.fetch as fetch
+import pyparcel.metrics as metrics
 import pyparcel.parse as parse
+import pyparcel.profiling as profiling
 import pyparcel.scrape as scrape
+import pyparcel.timing as timing
 import pyparcel.write as write
-from pyparcel.common import DEFAULT_PROP_UNIT
-from pyparcel.common import SHORT_DASHES
-from pyparcel.common import Tally
+from pyparcel.common import DEFAULT_PROP_UNIT, DataMismatch
+
+logger = logging.getLogger(__name__)
 
 
 def _parcel_not_in_db(parid, cursor):
@@ -18,14 +26,14 @@ def _parcel_not_in_db(parid, cursor):
     cursor.execute(select_sql, [parid])
     row = cursor.fetchone()
     if row is None:
-        print("Parcel {} not in properties.".format(parid))
+        logger.info("Parcel not in properties", extra={"parid": parid, "sample": True})
         return True
     return False
 
 
 def _compare(WPRDC_data, AlleghenyCountyData):
     if WPRDC_data != AlleghenyCountyData:
-        raise ValueError(
+        raise DataMismatch(
             "The WPRDC's data does not match the data scraped from Allegheny County\n"
             f"\t WPRDC's: {WPRDC_data}\tCounty's: {AlleghenyCountyData}"
         )
@@ -40,23 +48,18 @@ def _validate_data(r, tax):
     #   The Allegheny county real estate portal labeled it something like Rail Road
 
 
-def parcel(
-    conn,
-    cursor,
-    commit: bool,
-    parid: Optional[str] = None,
-    record: Optional[dict] = None,
-):
-    """
+@profiling.profiled(profiling.FETCH)
+@timing.timed(timing.FETCH)
+def fetch_parcel(parid: Optional[str] = None, record: Optional[dict] = None):
+    """ The I/O stage of updating a parcel.
 
     Args:
-        conn: The database connection
-        cursor: The cursor of the database connection
-        commit:
-            True if data should be committed to the database,
-            false if you're running tests
         parid: The parcel id to be updated. Cannot be choosen alongside record
         record: The WPRDC record representing the parcel. Cannot be choosen alongside parcel
+
+    Returns:
+        A tuple containing the parcel's WPRDC record and the raw html of its
+        Allegheny County Real Estate Portal Tax page.
     """
     # Validate parameters
     if record and parid:
@@ -66,18 +69,187 @@ def parcel(
         )
     if record:
         parid = record["PARID"]
+        timing.start_parcel(parid)
     elif parid:
-        record = fetch.record_using_parid(parid)
+        timing.start_parcel(parid)
+        with timing.stage(timing.WPRDC):
+            record = fetch.record_using_parid(parid)
     else:
         raise ValueError(
             "Function was passed without an argument indicating "
             "the parcel's id or WPRDC record."
         )
+    with metrics.SCRAPE_SECONDS.time(), timing.stage(timing.SCRAPE):
+        html = scrape.county_property_assessment(parid)
+    return record, html
+
+
+@profiling.profiled(profiling.PARSE)
+@timing.timed(timing.PARSE)
+def parse_parcel(html: str):
+    """ The CPU stage of updating a parcel.
+
+    Kept free of database and network access so it can be run in another process:
+    both the html it takes and the OwnerName and TaxStatus it returns are picklable.
+    """
+    with metrics.PARSE_SECONDS.time():
+        with timing.stage(timing.SOUPIFY):
+            soup = parse.soupify_html(html)
+        with timing.stage(timing.OWNER):
+            owner_name = parse.OwnerName.from_soup(soup)
+        with timing.stage(timing.TAX):
+            tax_status = parse.parse_tax_from_soup(soup)
+    return owner_name, tax_status
+
+
+def live_parcel_data(parid: str) -> dict:
+    """
+    Scrapes a parcel's current owner and tax status, and fetches its WPRDC record,
+    without writing anything. Has the same shape as fetch.latest_parcel_data.
+    """
+    record, html = fetch_parcel(parid)
+    owner_name, tax_status = parse_parcel(html)
+    data = create.propertyexternaldata_imap(None, owner_name.raw, record, None)
+    return {
+        "parid": parid,
+        "owner": owner_name.raw,
+        **{field: data[field] for field in fetch.PARCEL_DATA_FIELDS},
+        "taxstatus": dict(zip(tax_status._fields[:-1], tax_status[:-1])),
+        "lastupdated": datetime.now(timezone.utc).isoformat(),
+        "age": 0.0,
+    }
+
+
+def parcel(
+    conn,
+    cursor,
+    commit: bool,
+    parid: Optional[str] = None,
+    record: Optional[dict] = None,
+):
+    """
+
+    Args:
+        conn: The database connection
+        cursor: The cursor of the database connection
+        commit:
+            True if data should be committed to the database,
+            false if you're running tests
+        parid: The parcel id to be updated. Cannot be choosen alongside record
+        record: The WPRDC record representing the parcel. Cannot be choosen alongside parcel
+    """
+    record, html = fetch_parcel(parid, record)
+    fingerprint = page_fingerprint(record, html)
+    known = fetch.page_fingerprints([record["PARID"]], cursor)
+    seen = unchanged(record, fingerprint, known)
+    if seen is not None:
+        return write_unchanged(conn, cursor, commit, record, seen)
+    owner_name, tax_status = parse_parcel(html)
+    return write_parcel(
+        conn,
+        cursor,
+        commit,
+        record,
+        owner_name,
+        tax_status,
+        page_fingerprint=fingerprint,
+    )
+
+
+def page_fingerprint(record, html: str) -> str:
+    return create.page_fingerprint(record, parse.normalize_html(html))
+
+
+def unchanged(record, fingerprint: str, known: Dict[str, tuple]) -> Optional[int]:
+    """
+    Args:
+        known: From fetch.page_fingerprints
+
+    Returns:
+        The extdataid of the parcel's latest propertyexternaldata row, if it was made
+        from the same record and page. Otherwise None, and the parcel is updated.
+    """
+    extdataid, last_fingerprint = known.get(record["PARID"], (None, None))
+    if last_fingerprint == fingerprint:
+        return extdataid
+    return None
+
+
+def record_unchanged(record, known: Dict[str, tuple]) -> Optional[int]:
+    """
+    Args:
+        known: From fetch.page_fingerprints
+
+    Returns:
+        The extdataid of the parcel's latest propertyexternaldata row, if it was made
+        from the same WPRDC record, whatever its page was. Otherwise None.
+    """
+    extdataid, last_fingerprint = known.get(record["PARID"], (None, None))
+    if last_fingerprint is None:
+        return None
+    if last_fingerprint.split(":")[0] == create.record_fingerprint(record):
+        return extdataid
+    return None
+
+
+@profiling.profiled(profiling.WRITE)
+@timing.timed(timing.WRITE)
+def write_unchanged(conn, cursor, commit: bool, record: dict, extdataid: int):
+    """
+    The database stage of a parcel whose record and page haven't changed
+    since its last update: nothing is parsed, validated, written, or compared,
+    but the time it was seen.
+
+    Returns:
+        Whether the parcel was new to the database, and whether it changed (never).
+    """
+    start = time.perf_counter()
+    parid = record["PARID"]
+    timing.start_parcel(parid)
+    write.page_seen(extdataid, cursor)
+    if commit:
+        with timing.stage(timing.COMMIT):
+            conn.commit()
+    metrics.PARCELS_UNCHANGED.inc()
+    metrics.DB_SECONDS.observe(time.perf_counter() - start)
+    metrics.PARCELS_PROCESSED.inc()
+    logger.info(
+        "Parcel unchanged",
+        extra={"parid": parid, "new": False, "changed": False, "sample": True},
+    )
+    return False, False
 
-    html = scrape.county_property_assessment(parid)
-    soup = parse.soupify_html(html)
-    owner_name = parse.OwnerName.from_soup(soup)
-    tax_status = parse.parse_tax_from_soup(soup)
+
+@profiling.profiled(profiling.WRITE)
+@timing.timed(timing.WRITE)
+def write_parcel(
+    conn,
+    cursor,
+    commit: bool,
+    record: dict,
+    owner_name,
+    tax_status,
+    page_fingerprint: Optional[str] = None,
+):
+    """ The database stage of updating a parcel.
+
+    Args:
+        conn: The database connection
+        cursor: The cursor of the database connection
+        commit:
+            True if data should be committed to the database,
+            false if you're running tests
+        record: The WPRDC record representing the parcel
+        owner_name: The parse.OwnerName scraped from the parcel's portal page
+        tax_status: The TaxStatus scraped from the parcel's portal page
+        page_fingerprint: Identifies the record and page (see update.page_fingerprint)
+
+    Returns:
+        Whether the parcel was new to the database, and whether it changed.
+    """
+    start = time.perf_counter()
+    parid = record["PARID"]
+    timing.start_parcel(parid)
 
     if _parcel_not_in_db(parid, cursor):
         new_parcel = True
@@ -99,7 +271,7 @@ def parcel(
         person_id = write.person(owner_map, cursor)
         #
         write.connect_property_to_person(prop_id, person_id, cursor)
-        Tally.inserted += 1
+        metrics.PARCELS_INSERTED.inc()
     else:  # If the parcel was already in the database
         new_parcel = False
         prop_id = fetch.prop_id(parid, cursor)
@@ -108,21 +280,42 @@ def parcel(
         cecase_id = fetch.cecase_id(prop_id, cursor)
 
     _validate_data(record, tax_status)
-    tax_status_id = write.taxstatus(tax_status, cursor)
     propextern_map = create.propertyexternaldata_imap(
-        prop_id, owner_name.raw, record, tax_status_id
+        prop_id, owner_name.raw, record, None
     )
-    # Property external data is a misnomer.
-    # It's just a log of the data from every time stuff
-    write.propertyexternaldata(propextern_map, cursor)
-
-    if events.query_propertyexternaldata_for_changes_and_write_events(
-        parid, prop_id, cecase_id, new_parcel, cursor
+    tax_status_hash = create.taxstatus_hash(tax_status)
+    propextern_map["contenthash"] = create.propertyexternaldata_hash(
+        propextern_map, tax_status_hash
+    )
+    propextern_map["pagefingerprint"] = page_fingerprint
+    if not new_parcel and write.propertyexternaldata_seen(
+        prop_id, propextern_map["contenthash"], cursor, page_fingerprint
     ):
-        Tally.updated += 1
+        # Nothing changed since the parcel's last update, so nothing is written
+        # but the time it was seen, and there's nothing to compare
+        changed = False
+        metrics.PARCELS_UNCHANGED.inc()
+    else:
+        # Identical tax statuses share a row
+        propextern_map["taxstatus_taxstatusid"] = write.taxstatus(
+            tax_status, cursor, tax_status_hash
+        )
+        # Property external data is a misnomer.
+        # It's just a log of the data from every time stuff changed
+        write.propertyexternaldata(propextern_map, cursor)
+
+        with timing.stage(timing.CHANGES):
+            changed = bool(
+                events.query_propertyexternaldata_for_changes_and_write_events(
+                    parid, prop_id, cecase_id, new_parcel, cursor
+                )
+            )
+        if changed:
+            metrics.PARCELS_UPDATED.inc()
 
     if commit:
-        conn.commit()
+        with timing.stage(timing.COMMIT):
+            conn.commit()
     else:
         # A check to make sure variables weren't forgotten to be assigned.
         # Maybe move to testing suite?
@@ -142,11 +335,146 @@ def parcel(
     # pickler(owner_map, "owner_imap", incr=False)
     # pickler(propextern_map, "propext_imap", incr=True)
 
-    Tally.total += 1
-    print("Record count:", Tally.total, sep="\t")
-    print("Inserted count:", Tally.inserted, sep="\t")
-    print("Updated count:", Tally.updated, sep="\t")
-    print(SHORT_DASHES)
+    metrics.DB_SECONDS.observe(time.perf_counter() - start)
+    metrics.PARCELS_PROCESSED.inc()
+    # The counts are logged periodically by log.Throughput instead
+    logger.info(
+        "Parcel written",
+        extra={"parid": parid, "new": new_parcel, "changed": changed, "sample": True},
+    )
+    return new_parcel, changed
+
+
+def skipped(conn, cursor, commit: bool, parid: str, extdataid: int):
+    """
+    Counts a parcel that wasn't scraped, since it wasn't due,
+    and marks its latest data seen, so the rolling schedule doesn't think it's stale.
+    """
+    write.page_seen(extdataid, cursor)
+    if commit:
+        conn.commit()
+    metrics.PARCELS_SKIPPED.inc()
+    logger.info("Parcel skipped", extra={"parid": parid, "sample": True})
+
+
+def _scrape_and_parse(record, known: Dict[str, tuple]):
+    """
+    Returns:
+        The page's fingerprint, and either the extdataid of the parcel's unchanged
+        data or its parsed OwnerName and TaxStatus
+    """
+    _, html = fetch_parcel(record=record)
+    fingerprint = page_fingerprint(record, html)
+    seen = unchanged(record, fingerprint, known)
+    if seen is not None:
+        return fingerprint, seen
+    return fingerprint, parse_parcel(html)
+
+
+def parcels(
+    conn, cursor, commit: bool, parids: Iterable[str], fetch_workers: int = 8
+) -> Dict[str, dict]:
+    """
+    Updates many parcels at once, for callers with a list of parcel ids in hand.
+
+    Duplicate parcel ids are only updated once. The records are fetched from the
+    WPRDC in bulk, and the Real Estate Portal is scraped concurrently.
+    Every parcel is written in the same transaction, which is committed once,
+    but each parcel has its own savepoint, so one bad parcel doesn't spoil the rest.
+
+    Returns:
+        A result for every parcel id, with the keys
+            "status": "updated", "not found" (by the WPRDC), or "error"
+            "new", "changed": bool (only when updated)
+            "error": str (only on error)
+    """
+    parids = list(dict.fromkeys(parids))
+    records = fetch.records_using_parids(parids)
+    results = {p: {"status": "not found"} for p in parids if p not in records}
+
+    known = fetch.page_fingerprints(list(records), cursor)
+
+    with ThreadPoolExecutor(max_workers=fetch_workers) as pool:
+        # Scrapes and parses concurrently; writes on this thread, in order
+        futures = {
+            parid: pool.submit(
+                contextvars.copy_context().run,
+                _scrape_and_parse,
+                records[parid],
+                known,
+            )
+            for parid in parids
+            if parid in records
+        }
+        kept = []
+        for parid, future in futures.items():
+            cursor.execute("SAVEPOINT parcel;")
+            try:
+                with events.hold() as held:
+                    fingerprint, parsed = future.result()
+                    if isinstance(parsed, int):
+                        new_parcel, changed = write_unchanged(
+                            conn, cursor, False, records[parid], parsed
+                        )
+                    else:
+                        new_parcel, changed = write_parcel(
+                            conn,
+                            cursor,
+                            False,
+                            records[parid],
+                            *parsed,
+                            page_fingerprint=fingerprint,
+                        )
+            except Exception as e:
+                cursor.execute("ROLLBACK TO SAVEPOINT parcel;")
+                results[parid] = {"status": "error", "error": repr(e)}
+            else:
+                cursor.execute("RELEASE SAVEPOINT parcel;")
+                kept.extend(held)
+                results[parid] = {
+                    "status": "updated",
+                    "new": new_parcel,
+                    "changed": changed,
+                }
+
+    if commit:
+        conn.commit()
+    else:
+        conn.rollback()
+    events.publish(kept)
+    return {parid: results[parid] for parid in parids}
+
+
+def _ascending(parids: Iterable[str], source: str) -> Iterator[str]:
+    previous = None
+    for parid in parids:
+        if previous is not None and parid < previous:
+            raise ValueError(
+                "{}'s parcel ids are out of order: {} after {}".format(
+                    source, parid, previous
+                )
+            )
+        previous = parid
+        yield parid
+
+
+def missing_parids(db_parids: Iterable[str], wprdc_parids: Iterable[str]):
+    """
+    Merges two streams of parcel ids, each sorted, yielding the ids that are in the
+    database's but not in the WPRDC's. Neither stream is held in memory.
+    Both have to be sorted the same way: the WPRDC sorts with its own collation,
+    so callers sort its ids themselves.
+
+    Raises:
+        ValueError: If either stream isn't sorted
+    """
+    wprdc = _ascending(wprdc_parids, "The WPRDC")
+    current = next(wprdc, None)
+    for parid in _ascending(db_parids, "The database"):
+        while current is not None and current < parid:
+            current = next(wprdc, None)
+        if current != parid:
+            yield parid
 
 
 # Todo: rename method so it doesn't start with "create"
@@ -160,9 +488,10 @@ def create_events_for_parcels_in_db_but_not_in_records(
     # TODO: The current implementation creates an event multiple times if no change is made by the next month. Fix.
     # Get parcels in the database but not in the WPRDC record
     db_parcels = fetch.all_parids_in_muni(municdode, cursor)
-    wprdc_parcels = [r["PARID"] for r in records]
-    extra_parcels = set(db_parcels) - set(wprdc_parcels)
-    for parcel_id in extra_parcels:
+    # Only the ids are held, and they're sorted here rather than trusting the
+    # WPRDC's collation to match the database's byte order
+    wprdc_parcels = sorted(r["PARID"] for r in records)
+    for parcel_id in missing_parids(db_parcels, wprdc_parcels):
         prop_id = fetch.prop_id(parcel_id, cursor)
         cecase_id = fetch.cecase_id(prop_id, cursor)
         details = events.EventDetails(parcel_id, prop_id, cecase_id, cursor)
@@ -171,7 +500,7 @@ def create_events_for_parcels_in_db_but_not_in_records(
         # If DifferentMunicode, supplies the new muni
         event = events.parcel_not_in_wprdc_data(details)
         event.write_to_db()
-        Tally.diff_count += 1
+        metrics.DIFF_PARCELS.inc()
     if commit:
         # db_conn.execute()
         db_conn.commit()
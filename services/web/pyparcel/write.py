@@ -1,3 +1,44 @@
+import pyparcel.timing as timing
+
+# propertyexternaldata and taxstatus rows are only written when their contents change.
+# contenthash identifies the contents (see create.content_hash), and lastseen is the
+# last time an unchanged parcel's data was seen. pagefingerprint identifies the
+# record and page the row was made from (see create.page_fingerprint), so a parcel
+# whose page hasn't changed isn't parsed at all.
+CONTENT_HASH_SQL = """
+    ALTER TABLE public.propertyexternaldata
+        ADD COLUMN IF NOT EXISTS contenthash text,
+        ADD COLUMN IF NOT EXISTS lastseen timestamp with time zone,
+        ADD COLUMN IF NOT EXISTS pagefingerprint text;
+    ALTER TABLE public.taxstatus ADD COLUMN IF NOT EXISTS contenthash text;
+    CREATE INDEX IF NOT EXISTS taxstatus_contenthash_idx
+        ON public.taxstatus (contenthash);
+"""
+
+# lastmissing is the last time the rolling schedule looked a parcel up
+# and the WPRDC had no record of it (see schedule.py).
+MISSING_SQL = """
+    ALTER TABLE public.property
+        ADD COLUMN IF NOT EXISTS lastmissing timestamp with time zone;
+"""
+
+
+def add_content_hash_columns(cursor):
+    """
+    Adds the columns update.py uses to skip unchanged parcels.
+    Takes locks on the tables, so it's applied once per deploy by
+        python manage.py migrate
+    rather than by runs.
+    """
+    cursor.execute(CONTENT_HASH_SQL)
+
+
+def add_missing_column(cursor):
+    """ Adds the column the rolling schedule uses to move past missing parcels. """
+    cursor.execute(MISSING_SQL)
+
+
+@timing.timed("write.property")
 def property(imap, cursor):
     # Todo: Write function in a way so that we can reuse the insert sql for the alter sql
     insert_sql = """
@@ -21,6 +62,7 @@ def property(imap, cursor):
     return cursor.fetchone()[0]  # Returns the property_id
 
 
+@timing.timed("write.unit")
 def unit(imap, cursor):
     insert_sql = """
         INSERT INTO public.propertyunit(
@@ -36,6 +78,7 @@ def unit(imap, cursor):
     return cursor.fetchone()[0]  # unit_id
 
 
+@timing.timed("write.cecase")
 def cecase(imap, cursor):
     insert_sql = """INSERT INTO public.cecase(
         caseid, cecasepubliccc, property_propertyid, propertyunit_unitid,
@@ -56,6 +99,7 @@ def cecase(imap, cursor):
     return cursor.fetchone()[0]  # caseid
 
 
+@timing.timed("write.person")
 def person(record, cursor):
     insert_sql = """
         INSERT INTO public.person(
@@ -79,6 +123,7 @@ def person(record, cursor):
     return cursor.fetchone()[0]
 
 
+@timing.timed("write.connect_property_to_person")
 def connect_property_to_person(prop_id, person_id, cursor):
     propperson = {"prop_id": prop_id, "person_id": person_id}
     insert_sql = """
@@ -92,24 +137,42 @@ def connect_property_to_person(prop_id, person_id, cursor):
     cursor.execute(insert_sql, propperson)
 
 
-def taxstatus(tax_status, cursor):
+@timing.timed("write.taxstatus")
+def taxstatus(tax_status, cursor, content_hash=None):
+    """
+    Writes a tax status, unless an identical one was already written,
+    in which case that row is reused.
+
+    Returns:
+        The tax status's id
+    """
+    if content_hash is not None:
+        select_sql = """
+            SELECT taxstatusid FROM taxstatus
+            WHERE contenthash = %s
+            LIMIT 1;"""
+        cursor.execute(select_sql, [content_hash])
+        row = cursor.fetchone()
+        if row is not None:
+            return row[0]
     insert_sql = """
         INSERT INTO taxstatus(
             year, paidstatus, tax, penalty,
-            interest, total, datepaid
+            interest, total, datepaid, contenthash
         )
         VALUES(
             %(year)s, %(paidstatus)s, %(tax)s, %(penalty)s,
-            %(interest)s, %(total)s, %(date_paid)s
+            %(interest)s, %(total)s, %(date_paid)s, %(contenthash)s
         )
         returning taxstatusid;
     """
     cursor.execute(
-        insert_sql, tax_status._asdict()
+        insert_sql, {**tax_status._asdict(), "contenthash": content_hash}
     )  # Todo: For fun, learn speed of tuple -> dict
     return cursor.fetchone()[0]  # taxstatus_id
 
 
+@timing.timed("write.propertyexternaldata")
 def propertyexternaldata(propextern_map, cursor):
     insert_sql = """
         INSERT INTO public.propertyexternaldata(
@@ -118,7 +181,8 @@ def propertyexternaldata(propextern_map, cursor):
             address_city, address_state, address_zip, saleprice,
             saleyear, assessedlandvalue, assessedbuildingvalue, assessmentyear,
             usecode, livingarea, condition, 
-            notes, lastupdated, taxstatus_taxstatusid
+            notes, lastupdated, taxstatus_taxstatusid, contenthash, lastseen,
+            pagefingerprint
         )
         VALUES(
             DEFAULT,
@@ -126,9 +190,66 @@ def propertyexternaldata(propextern_map, cursor):
             %(address_city)s, %(address_state)s, %(address_zip)s, %(saleprice)s,
             %(saleyear)s, %(assessedlandvalue)s, %(assessedbuildingvalue)s, %(assessmentyear)s,
             %(usecode)s, %(livingarea)s, %(condition)s,
-            %(notes)s, now(), %(taxstatus_taxstatusid)s
+            %(notes)s, now(), %(taxstatus_taxstatusid)s, %(contenthash)s, now(),
+            %(pagefingerprint)s
         )
         RETURNING property_propertyid;
     """
     cursor.execute(insert_sql, propextern_map)
     return cursor.fetchone()[0]  # property_id
+
+
+@timing.timed("write.propertyexternaldata_seen")
+def propertyexternaldata_seen(
+    prop_id, content_hash, cursor, page_fingerprint=None
+) -> bool:
+    """
+    Bumps the lastseen of a property's latest propertyexternaldata row,
+    if its contents are the same as content_hash.
+    The row's page fingerprint is replaced, if one is given.
+
+    Returns:
+        Whether the row was unchanged (and bumped). If not, a new row is needed.
+    """
+    update_sql = """
+        UPDATE public.propertyexternaldata
+        SET lastseen = now(),
+            pagefingerprint = COALESCE(%(pagefingerprint)s, pagefingerprint)
+        WHERE extdataid = (
+            SELECT extdataid FROM public.propertyexternaldata
+            WHERE property_propertyid = %(prop_id)s
+            ORDER BY lastupdated DESC
+            LIMIT 1
+        )
+        AND contenthash = %(contenthash)s
+        RETURNING extdataid;
+    """
+    cursor.execute(
+        update_sql,
+        {
+            "prop_id": prop_id,
+            "contenthash": content_hash,
+            "pagefingerprint": page_fingerprint,
+        },
+    )
+    return cursor.fetchone() is not None
+
+
+@timing.timed("write.wprdc_missing")
+def wprdc_missing(parids, cursor):
+    """ Records that the WPRDC had no record of these parcels when looked up. """
+    update_sql = """
+        UPDATE public.property SET lastmissing = now()
+        WHERE parid = ANY(%s);
+    """
+    cursor.execute(update_sql, [list(parids)])
+
+
+@timing.timed("write.page_seen")
+def page_seen(extdataid, cursor):
+    """ Bumps the lastseen of a propertyexternaldata row whose page was unchanged. """
+    update_sql = """
+        UPDATE public.propertyexternaldata SET lastseen = now()
+        WHERE extdataid = %s;
+    """
+    cursor.execute(update_sql, [extdataid])
@@ -4,8 +4,8 @@ from codecs import open
 from setuptools import setup, find_packages
 
 import pdb
-requires = ["requests", "psycopg2-binary", "beautifulsoup4", "colorama", "Flask"]
-extras_requires = {"dev": ["pytest", "pre-commit", "black",]}
+requires = ["requests", "psycopg2-binary", "beautifulsoup4", "Flask"]
+extras_requires = {"dev": ["pytest", "pytest-benchmark", "pre-commit", "black",]}
 
 HERE = os.path.abspath(os.path.dirname(__file__))
 
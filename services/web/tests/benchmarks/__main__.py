@@ -0,0 +1,54 @@
+"""
+Runs the benchmarks, saving their results as JSON baselines or comparing against them.
+
+    python -m tests.benchmarks save
+    python -m tests.benchmarks compare --threshold 10
+
+Baselines are saved to tests/benchmarks/baselines, under a directory per machine
+and Python version. Compare exits with a failure if any benchmark's median is more than
+--threshold percent slower than the latest baseline.
+"""
+import argparse
+import sys
+from os import path
+
+import pytest
+
+HERE = path.dirname(path.abspath(__file__))
+BASELINES = path.join(HERE, "baselines")
+DEFAULT_THRESHOLD = 10  # percent
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Runs pyparcel's benchmarks.")
+    parser.add_argument("mode", choices=["run", "save", "compare"])
+    parser.add_argument(
+        "--threshold",
+        type=int,
+        default=DEFAULT_THRESHOLD,
+        help="The slowdown, as a percent of the baseline's median, that fails compare",
+    )
+    parser.add_argument(
+        "--baseline", help="The baseline to compare against. Defaults to the latest"
+    )
+    args, pytest_args = parser.parse_known_args(argv)
+
+    options = [
+        HERE,
+        "--benchmark-only",
+        "--benchmark-storage=file://{}".format(BASELINES),
+    ]
+    if args.mode == "save":
+        options.append("--benchmark-autosave")
+    elif args.mode == "compare":
+        options.append(
+            "--benchmark-compare={}".format(args.baseline)
+            if args.baseline
+            else "--benchmark-compare"
+        )
+        options.append("--benchmark-compare-fail=median:{}%".format(args.threshold))
+    return pytest.main(options + pytest_args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,12 @@
+""" Benchmarks are skipped unless run through tests/benchmarks/__main__.py. """
+import pytest
+
+
+def pytest_collection_modifyitems(config, items):
+    """ Keeps the benchmarks out of the regular test run. """
+    if config.getoption("benchmark_only", default=False):
+        return
+    skip = pytest.mark.skip(reason="Benchmarks only run with --benchmark-only")
+    for item in items:
+        if "benchmark" in getattr(item, "fixturenames", ()):
+            item.add_marker(skip)
@@ -0,0 +1,110 @@
+"""
+Benchmarks of a parcel update's hot paths, run against the mocks in tests/mocks,
+and of the memory a municipality's records take up.
+See tests/benchmarks/__main__.py for saving baselines and comparing against them.
+"""
+import json
+import pickle
+import tracemalloc
+from os import path
+
+import pytest
+from unittest import mock
+from unittest.mock import MagicMock
+
+from pyparcel import create, events, parse, synthetic, update
+from pyparcel.common import Record
+
+pytest.importorskip("pytest_benchmark")
+
+MOCKS = path.join(path.dirname(path.dirname(path.abspath(__file__))), "mocks")
+TAX_SOUPS = ["paid", "unpaid", "balancedue", "none"]
+
+
+@pytest.fixture(scope="module")
+def html():
+    with open(path.join(MOCKS, "real_estate_portal.html"), "r") as f:
+        return f.read()
+
+
+@pytest.fixture(scope="module")
+def record():
+    with open(path.join(MOCKS, "record.json"), "r") as f:
+        return json.load(f)
+
+
+@pytest.fixture(scope="module", params=TAX_SOUPS)
+def soup(request):
+    with open(path.join(MOCKS, request.param + ".pickle"), "rb") as p:
+        return pickle.load(p)
+
+
+@pytest.fixture(scope="module")
+def wprdc_response():
+    """ A 10,000 parcel municipality, as the WPRDC would send it. """
+    _, seed_records = synthetic.load_seeds(MOCKS)
+    rows = [p.record for p in synthetic.parcels(10000, 12, seed_records)]
+    return json.dumps({"success": True, "result": {"records": rows}})
+
+
+def test_soupify_html(benchmark, html):
+    benchmark(parse.soupify_html, html)
+
+
+def test_parse_tax_from_soup(benchmark, soup):
+    benchmark(parse.parse_tax_from_soup, soup)
+
+
+def test_owner_name_from_soup(benchmark, soup):
+    benchmark(parse.OwnerName.from_soup, soup)
+
+
+def test_insert_maps(benchmark, html, record):
+    soup = parse.soupify_html(html)
+    name = parse.OwnerName.from_soup(soup)
+
+    def build():
+        create.property_insertmap(record)
+        create.owner_imap(name, record)
+        create.propertyexternaldata_imap(1, name.clean, record, 1)
+        create.cecase_imap(1, 1)
+
+    benchmark(build)
+
+
+def test_parcel_changed_events(benchmark):
+    cursor = MagicMock()
+    # Every column of propertyexternaldata changed
+    cursor.fetchall.return_value = [
+        ("NEW OWNER", "0 New St", "NEWCITY PA 00000", 2600, 1),
+        ("OLD OWNER", "0 Old St", "OLDCITY PA 12345", 1000, 8),
+    ]
+    benchmark(
+        events.query_propertyexternaldata_for_changes_and_write_events,
+        "0374R00210000000",
+        1,
+        1,
+        False,
+        cursor,
+    )
+
+
+def test_update_parcel(benchmark, html, record):
+    with mock.patch(
+        "pyparcel.update.scrape.county_property_assessment", return_value=html
+    ):
+        benchmark(update.parcel, MagicMock(), MagicMock(), False, record=record)
+
+
+@pytest.mark.parametrize("form", ["dict", "record"])
+def test_load_records(benchmark, wprdc_response, form):
+    """ Times loading a municipality's records, and saves what they take up. """
+    kwargs = {"object_hook": Record.hook()} if form == "record" else {}
+    tracemalloc.start()
+    try:
+        records = json.loads(wprdc_response, **kwargs)
+        benchmark.extra_info["bytes"] = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del records
+    benchmark(json.loads, wprdc_response, **kwargs)
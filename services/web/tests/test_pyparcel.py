@@ -13,26 +13,59 @@ A major refactoring would do these tests well. I apologize in advanced;
 Unlike the rest of the package, I cannot say I am proud of the quality of my work.
     ~ Snapper
 """
+import collections
 import contextlib
+import contextvars
+import io
 import json
+import logging
+import os
 import pickle
+import pstats
+import random
 import sys
+import threading
+import time
+import tracemalloc
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from copy import copy
 from dataclasses import dataclass
+from datetime import date, datetime, timedelta
 from os import path
 from typing import Type, Any
 
 import psycopg2
 import pytest
+import requests
 
 import pyparcel
 
+from pyparcel import audit
+from pyparcel import checkpoint
+from pyparcel import create
 from pyparcel import update
+from pyparcel import fetch
 from pyparcel import events  # Hacky way to test all events
+from pyparcel import failures
+from pyparcel import jobqueue
+from pyparcel import log
+from pyparcel import metrics
 from pyparcel import parse
+from pyparcel import pipeline
+from pyparcel import profiling
 from pyparcel import run
-from pyparcel.common import DB_URI
+from pyparcel import schedule
+from pyparcel import snapshot
+from pyparcel import scrape
+from pyparcel import standin
+from pyparcel import synthetic
+from pyparcel import taxcalendar
+from pyparcel import timing
+from pyparcel import trace
+from pyparcel import write
+from pyparcel.common import DB_URI, DataMismatch, LastTaxStatus, PARCEL_ID_LISTS, Record
 from pyparcel.parse import TaxStatus
 
 
@@ -287,6 +320,1640 @@ class TestParse:
         pass
 
 
+class TestPipeline:
+    """ The pipeline's fetch and write stages are mocked; only the parse stage is real.
+    """
+
+    def setup_mocks(self):
+        with open(path.join(MOCKS, "record.json"), "r") as f:
+            mock_record = json.load(f)
+        with open(path.join(MOCKS, "real_estate_portal.html"), "r") as f:
+            mocked_html = f.read()
+        self.records = []
+        for i in range(10):
+            record = dict(mock_record)
+            record["PARID"] = str(i)
+            self.records.append(record)
+        self.mocked_html = mocked_html
+
+    @pytest.mark.parametrize("parse_workers", [0, 2])
+    def test_every_record_is_written(self, parse_workers):
+        self.setup_mocks()
+        with mock.patch(
+            "pyparcel.pipeline.update.fetch_parcel",
+            side_effect=lambda record: (record, self.mocked_html),
+        ), mock.patch(
+            "pyparcel.pipeline.update.write_parcel"
+        ) as write_parcel, timing.Recorder() as recorder:
+            pipeline.run(
+                MagicMock(),
+                MagicMock(),
+                False,
+                self.records,
+                fetch_workers=3,
+                parse_workers=parse_workers,
+                queue_size=2,
+            )
+        written = sorted(c.args[3]["PARID"] for c in write_parcel.call_args_list)
+        assert written == sorted(r["PARID"] for r in self.records)
+        owner_name, tax_status = write_parcel.call_args.args[4:]
+        assert owner_name.clean == "NEW JEFFREY R"
+        assert tax_status.paidstatus == "UNPAID"
+        # Parse timings are attributed to their parcels, wherever they were parsed
+        report = recorder.report()
+        assert report["stages"][timing.SOUPIFY]["count"] == len(self.records)
+        assert set(report["slowest"][0]["stages"]) == {
+            timing.PARSE,
+            timing.SOUPIFY,
+            timing.OWNER,
+            timing.TAX,
+        }
+
+    def test_fatal_exceptions_reach_the_caller(self):
+        self.setup_mocks()
+        with mock.patch(
+            "pyparcel.pipeline.update.fetch_parcel",
+            side_effect=lambda record: (record, self.mocked_html),
+        ), mock.patch(
+            "pyparcel.pipeline.update.write_parcel",
+            side_effect=psycopg2.OperationalError,
+        ) as write_parcel:
+            with pytest.raises(psycopg2.OperationalError):
+                pipeline.run(
+                    MagicMock(), MagicMock(), False, self.records, parse_workers=0
+                )
+        assert write_parcel.call_count == 1
+
+    def test_a_broken_parse_pool_reaches_the_caller(self):
+        self.setup_mocks()
+        pool = MagicMock()
+        pool.submit.side_effect = BrokenProcessPool
+        with mock.patch(
+            "pyparcel.pipeline.update.fetch_parcel",
+            side_effect=lambda record: (record, self.mocked_html),
+        ), mock.patch("pyparcel.pipeline.update.write_parcel"):
+            with ThreadPoolExecutor(1) as executor:
+                future = executor.submit(
+                    pipeline.run,
+                    MagicMock(),
+                    MagicMock(),
+                    False,
+                    self.records,
+                    queue_size=2,
+                    pool=pool,
+                )
+                # Rather than the writer waiting forever on the parse stage
+                with pytest.raises(BrokenProcessPool):
+                    future.result(timeout=10)
+        # The pool is the caller's to shut down
+        pool.shutdown.assert_not_called()
+
+    def test_the_runs_pool_is_shared_by_its_batches(self):
+        self.setup_mocks()
+        with mock.patch(
+            "pyparcel.run.fetch.municipality_records_from_Wprdc",
+            return_value=self.records,
+        ), mock.patch(
+            "pyparcel.run.pipeline.run"
+        ) as pipeline_run:
+            pool = MagicMock()
+            run._update_municipality(
+                MagicMock(),
+                MagicMock(),
+                MagicMock(municode=1),
+                False,
+                each=True,
+                diff=False,
+                fetch_workers=1,
+                parse_workers=2,
+                queue_size=2,
+                checkpoint=jobqueue.Progress(),
+                batch_size=3,
+                parse_pool=pool,
+            )
+        assert pipeline_run.call_count == 4
+        assert all(c.kwargs["pool"] is pool for c in pipeline_run.call_args_list)
+
+
+class TestFailures:
+    """ One parcel failing doesn't stop the others. """
+
+    def setup_mocks(self, monkeypatch):
+        monkeypatch.setattr(failures, "BACKOFF_BASE", 0.01)
+        with open(path.join(MOCKS, "record.json"), "r") as f:
+            mock_record = json.load(f)
+        with open(path.join(MOCKS, "real_estate_portal.html"), "r") as f:
+            self.mocked_html = f.read()
+        self.records = [dict(mock_record, PARID=str(i)) for i in range(6)]
+
+    def update_parcels(self, fetch_parcel, write_parcel=None):
+        quarantine = failures.Quarantine()
+        cursor = MagicMock()
+        with mock.patch(
+            "pyparcel.pipeline.update.fetch_parcel", side_effect=fetch_parcel
+        ), mock.patch(
+            "pyparcel.pipeline.update.write_parcel", side_effect=write_parcel
+        ) as write:
+            pipeline.run(
+                MagicMock(),
+                cursor,
+                False,
+                self.records,
+                fetch_workers=2,
+                parse_workers=0,
+                quarantine=quarantine,
+            )
+        written = sorted(c.args[3]["PARID"] for c in write.call_args_list)
+        return written, quarantine.failures(), cursor
+
+    def test_categories(self):
+        response = requests.Response()
+        response.status_code = 503
+        throttled = requests.HTTPError(response=response)
+        assert failures.categorize(throttled, failures.FETCH_STAGE) == "transient"
+        response.status_code = 404
+        assert failures.categorize(throttled, failures.FETCH_STAGE) == "fetch"
+        assert failures.categorize(requests.ReadTimeout(), "fetch") == "transient"
+        with pytest.raises(ValueError) as e:
+            update._compare(2019.0, 2020)
+        assert failures.categorize(e.value, failures.WRITE_STAGE) == "validation"
+        assert failures.categorize(AttributeError(), failures.PARSE_STAGE) == "parse"
+        assert failures.categorize(psycopg2.DataError(), "write") == "database"
+        assert failures.fatal(psycopg2.InterfaceError())
+        base = failures.BACKOFF_BASE
+        assert [failures.backoff(a) for a in (1, 2, 3)] == [base, 2 * base, 4 * base]
+        assert failures.backoff(100) == failures.BACKOFF_MAX
+
+    def test_transient_failures_are_retried(self, monkeypatch):
+        self.setup_mocks(monkeypatch)
+        attempts = collections.Counter()
+
+        def fetch_parcel(record):
+            attempts[record["PARID"]] += 1
+            if record["PARID"] == "1" and attempts["1"] < 3:
+                raise requests.ConnectionError
+            if record["PARID"] == "2":
+                raise requests.Timeout
+            return record, self.mocked_html
+
+        retries = metrics.RETRIES.value(kind="parcel")
+        written, quarantined, _ = self.update_parcels(fetch_parcel)
+        assert written == ["0", "1", "3", "4", "5"]
+        assert attempts["1"] == 3
+        assert attempts["2"] == failures.MAX_ATTEMPTS
+        assert quarantined == [
+            failures.Failure(
+                "2", "transient", "fetch", "Timeout()", failures.MAX_ATTEMPTS
+            )
+        ]
+        assert metrics.RETRIES.value(kind="parcel") == retries + 2 + 3
+
+    def test_parse_and_validation_failures_are_quarantined(self, monkeypatch):
+        self.setup_mocks(monkeypatch)
+
+        def fetch_parcel(record):
+            if record["PARID"] == "3":
+                return record, "<html>Not a parcel</html>"
+            return record, self.mocked_html
+
+        def write_parcel(conn, cursor, commit, record, *args, **kwargs):
+            if record["PARID"] == "4":
+                update._compare(2019.0, 2020)
+
+        before = metrics.PARCELS_FAILED.value(category="validation")
+        written, quarantined, cursor = self.update_parcels(fetch_parcel, write_parcel)
+        assert written == ["0", "1", "2", "4", "5"]
+        assert sorted((f.parid, f.category, f.stage) for f in quarantined) == [
+            ("3", "parse", "parse"),
+            ("4", "validation", "write"),
+        ]
+        assert metrics.PARCELS_FAILED.value(category="validation") == before + 1
+        # The failed parcels' writes are undone
+        statements = [c.args[0] for c in cursor.execute.call_args_list]
+        assert statements.count("ROLLBACK TO SAVEPOINT parcel;") == 2
+        assert statements.count("RELEASE SAVEPOINT parcel;") == 4
+
+    def test_only_kept_events_are_published(self, monkeypatch):
+        self.setup_mocks(monkeypatch)
+
+        def write_parcel(conn, cursor, commit, record, *args, **kwargs):
+            event = MagicMock(parid=record["PARID"], eventdescription="Changed")
+            events.Event.write_to_db(event)
+            if record["PARID"] == "4":
+                raise psycopg2.DataError()
+
+        heard = []
+        events.add_listener(heard.append)
+        try:
+            self.update_parcels(lambda record: (record, self.mocked_html), write_parcel)
+        finally:
+            events.remove_listener(heard.append)
+        # Parcel 4's writes were rolled back, event and all
+        assert sorted(e["parid"] for e in heard) == ["0", "1", "2", "3", "5"]
+        assert events._listeners.get() == ()
+
+    def test_listeners_only_hear_their_own_context(self):
+        heard = []
+        events.add_listener(heard.append)
+        try:
+            # Such as another request, or another job
+            other = threading.Thread(target=events.publish, args=([{"parid": "1"}],))
+            other.start()
+            other.join()
+            events.publish([{"parid": "2"}])
+        finally:
+            events.remove_listener(heard.append)
+        assert heard == [{"parid": "2"}]
+
+    def test_summary(self):
+        failed = [
+            failures.Failure("1", "parse", "parse", "AttributeError()", 1),
+            failures.Failure("2", "transient", "fetch", "Timeout()", 4),
+        ]
+        summary = run._summarize(None, metrics.counts({}), failed=failed)
+        assert summary["success"]
+        assert summary["parcels failed"] == 2
+        assert summary["failed"]["transient"] == [
+            {"parid": "2", "stage": "fetch", "error": "Timeout()", "attempts": 4}
+        ]
+
+
+class TestTiming:
+    def test_report(self):
+        with timing.Recorder() as recorder:
+            for parid, seconds in [("1", 0.1), ("2", 0.3), ("3", 0.2)]:
+                timing.start_parcel(parid)
+                timing.record(timing.CHANGES, seconds)
+                # Writing a parcel finishes it
+                timing.record(timing.WRITE, seconds * 2)
+        timing.record(timing.CHANGES, 10)  # Not recorded
+        report = recorder.report()
+        changes = report["stages"][timing.CHANGES]
+        assert changes["count"] == 3
+        assert changes["p50"] == 0.2
+        assert changes["max"] == 0.3
+        assert [p["parid"] for p in report["slowest"]] == ["2", "3", "1"]
+        assert report["slowest"][0]["seconds"] == pytest.approx(0.6)
+
+    def test_capture_and_merge(self):
+        with timing.Recorder() as worker:
+            with timing.capture() as captured:
+                with timing.stage(timing.SOUPIFY):
+                    pass
+            for stage, seconds, *where in captured:
+                timing.record(stage, seconds, "1", *where)
+        with timing.Recorder() as parent:
+            timing.merge(worker.state())
+        assert parent.report()["stages"][timing.SOUPIFY]["count"] == 1
+        assert parent.report()["slowest"][0]["parid"] == "1"
+
+    def test_merged_samples_are_weighted_by_count(self, monkeypatch):
+        monkeypatch.setattr(timing, "SAMPLES", 1000)
+        random.seed(0)
+        busy, quiet = timing._Stage(), timing._Stage()
+        for _ in range(9000):
+            busy.add(1.0)
+        for _ in range(1000):
+            quiet.add(2.0)
+        quiet.merge(vars(busy))
+        assert quiet.count == 10000
+        assert len(quiet.samples) == 1000
+        # Not half and half, as their samples are the same size
+        assert quiet.samples.count(2.0) == pytest.approx(100, abs=30)
+        assert (quiet.summary()["p50"], quiet.summary()["p99"]) == (1.0, 2.0)
+
+    def test_concurrent_runs_time_their_own(self):
+        both_running = threading.Barrier(2)
+
+        def run(seconds):
+            with timing.Recorder() as recorder:
+                both_running.wait()
+                timing.record(timing.SCRAPE, seconds)
+                both_running.wait()
+            return recorder.report()["stages"][timing.SCRAPE]["total"]
+
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            assert list(pool.map(run, [1, 10])) == [1, 10]
+
+
+class TestTrace:
+    def test_pipeline_timeline(self, tmp_path):
+        with open(path.join(MOCKS, "real_estate_portal.html"), "r") as f:
+            mocked_html = f.read()
+        records = [{"PARID": str(i)} for i in range(4)]
+        trace_dir = str(tmp_path / "traces")
+        with mock.patch(
+            "pyparcel.pipeline.update.fetch_parcel",
+            side_effect=lambda record: (record, mocked_html),
+        ), mock.patch("pyparcel.pipeline.update.write_parcel"), trace.Tracer(
+            path.join(trace_dir, "1.jsonl")
+        ):
+            pipeline.run(MagicMock(), MagicMock(), False, records, parse_workers=2)
+        with open(trace.merge(trace_dir, str(tmp_path / "trace.json"))) as f:
+            events_ = json.load(f)
+
+        spans = [e for e in events_ if e["ph"] == "X"]
+        parses = [e for e in spans if e["name"] == timing.PARSE]
+        assert sorted(e["args"]["parid"] for e in parses) == ["0", "1", "2", "3"]
+        # Parse spans contain their stages, on the parse process's row
+        soupify = next(e for e in spans if e["name"] == timing.SOUPIFY)
+        parse = next(e for e in parses if e["args"] == soupify["args"])
+        assert parse["tid"] == soupify["tid"]
+        assert parse["ts"] <= soupify["ts"]
+        assert any(e["cat"] == trace.QUEUE for e in events_ if "cat" in e)
+        assert not path.exists(trace_dir)
+
+
+class TestLog:
+    def logger(self, name, sample=1.0, buffer=1):
+        stream = io.StringIO()
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(log.JsonFormatter())
+        handler.addFilter(log.SampleFilter(sample))
+        logger = logging.getLogger("pyparcel.test." + name)
+        logger.handlers = [handler]
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        return logger, stream
+
+    def lines(self, stream):
+        return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+    def test_extra_fields_are_keys(self):
+        logger, stream = self.logger("extra")
+        logger.info("Parcel written", extra={"parid": "1", "new": True, "sample": 1})
+        (line,) = self.lines(stream)
+        assert line["message"] == "Parcel written"
+        assert line["parid"] == "1"
+        assert line["new"] is True
+        assert "sample" not in line
+
+    def test_sampling(self):
+        logger, stream = self.logger("sampling", sample=0.1)
+        for i in range(100):
+            logger.info("Parcel written", extra={"parid": str(i), "sample": True})
+        logger.info("Updating muni")
+        lines = self.lines(stream)
+        assert len(lines) == 11
+        assert lines[-1]["message"] == "Updating muni"
+
+    def test_quiet_buffers_are_flushed(self):
+        stream = io.StringIO()
+        handler = log.BufferedHandler(100, logging.StreamHandler(stream), interval=0.05)
+        logger = logging.getLogger("pyparcel.test.buffered")
+        logger.handlers = [handler]
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        try:
+            logger.info("Updating muni")
+            # Nothing else is logged, so only the timer can flush it
+            for _ in range(50):
+                if stream.getvalue():
+                    break
+                time.sleep(0.02)
+            assert stream.getvalue() == "Updating muni\n"
+        finally:
+            handler.close()
+
+    def test_closing_twice_stops_the_timer(self):
+        handler = log.BufferedHandler(100, logging.StreamHandler(io.StringIO()))
+        handler.emit(logging.makeLogRecord({"msg": "Muni", "levelno": logging.INFO}))
+        timer = handler._timer
+        assert timer.is_alive()
+        handler.close()
+        # As logging.shutdown does at exit
+        handler.close()
+        assert not timer.is_alive()
+
+    def test_throughput(self):
+        logger, stream = self.logger("throughput")
+        counts = {"processed": 0}
+        throughput = log.Throughput(lambda: dict(counts), logger=logger)
+        counts["processed"] = 50
+        throughput.summarize("Run finished")
+        (line,) = self.lines(stream)
+        assert line["processed"] == 50
+        assert line["rate"] > 0
+        assert line["average rate"] > 0
+
+
+class TestProfiling:
+    def setup_mocks(self):
+        with open(path.join(MOCKS, "real_estate_portal.html"), "r") as f:
+            self.mocked_html = f.read()
+
+    def test_hot_paths_only(self, tmp_path):
+        self.setup_mocks()
+        with mock.patch(
+            "pyparcel.update.scrape.county_property_assessment",
+            return_value=self.mocked_html,
+        ), profiling.profile(profiling.CPROFILE, True, str(tmp_path / "1")):
+            _, html = update.fetch_parcel(record={"PARID": "0374R00210000000"})
+            update.parse_parcel(html)
+        stats = pstats.Stats(str(tmp_path / "1.pstats")).stats
+        functions = {name for _, _, name in stats}
+        assert "soupify_html" in functions
+        assert "county_property_assessment" not in functions
+
+    def test_parse_processes_are_profiled(self, tmp_path):
+        self.setup_mocks()
+        records = [{"PARID": str(i)} for i in range(4)]
+        with mock.patch(
+            "pyparcel.pipeline.update.fetch_parcel",
+            side_effect=lambda record: (record, self.mocked_html),
+        ), mock.patch("pyparcel.pipeline.update.write_parcel"), profiling.profile(
+            profiling.CPROFILE, True, str(tmp_path / "1")
+        ):
+            pipeline.run(MagicMock(), MagicMock(), False, records, parse_workers=2)
+        stats = pstats.Stats(str(tmp_path / "1.pstats")).stats
+        assert {"soupify_html", "parse_tax_from_soup"} <= {n for _, _, n in stats}
+
+    def test_sampling(self, tmp_path):
+        self.setup_mocks()
+        with profiling.profile(profiling.SAMPLING, True, str(tmp_path / "1")):
+            for _ in range(20):
+                update.parse_parcel(self.mocked_html)
+        with open(tmp_path / "1.collapsed") as f:
+            stack, count = f.readline().rsplit(" ", 1)
+        assert stack.startswith("parse;")
+        assert int(count) > 0
+
+
+class TestStandIn:
+    def test_pipeline_fetches_offline(self):
+        corpus = standin.Corpus.from_directory(MOCKS)
+        with standin.serve(corpus):
+            records = fetch.records_using_parids(["0374R00210000000", "MISSING"])
+            _, html = update.fetch_parcel(record=records["0374R00210000000"])
+        assert list(records) == ["0374R00210000000"]
+        owner_name, tax_status = update.parse_parcel(html)
+        assert owner_name.clean == "NEW JEFFREY R"
+        assert scrape.COUNTY_REAL_ESTATE_URL.startswith("http://www2.county")
+
+    def test_errors_and_throttling(self):
+        corpus = standin.Corpus.from_directory(MOCKS)
+        with standin.serve(
+            corpus,
+            county=standin.Behavior(error_rate=1),
+            wprdc=standin.Behavior(rate=0.1, burst=1),
+        ):
+            response = scrape.county_property_assessment("0374R00210000000", True)
+            assert response.status_code == 500
+            fetch.record_using_parid("0374R00210000000")
+            with pytest.raises(json.JSONDecodeError):
+                fetch.record_using_parid("0374R00210000000")
+
+    def test_latency(self):
+        rng = random.Random(0)
+        assert standin.parse_latency("fixed:0.5")(rng) == 0.5
+        assert 1 <= standin.parse_latency("uniform:1,2")(rng) <= 2
+        assert standin.parse_latency("lognormal:0.2,0.5")(rng) > 0
+        with pytest.raises(ValueError):
+            standin.parse_latency("pareto:1")
+
+
+class TestSynthetic:
+    def test_parcels_are_unique_and_parse(self):
+        templates, seed_records = synthetic.load_seeds(MOCKS)
+        parcels = list(synthetic.parcels(30, 12, seed_records))
+        assert len({p.parid for p in parcels}) == 30
+        assert all(p.record["PARID"] == p.parid for p in parcels)
+        assert list(synthetic.parcels(30, 12, seed_records)) == parcels
+        for i, p in enumerate(parcels[: len(templates)]):
+            owner_name, tax_status = update.parse_parcel(templates[i].render(p))
+            assert owner_name.clean == p.owner
+            assert tax_status.year == p.taxes[0].year
+            assert tax_status.paidstatus == p.taxes[0].paidstatus
+            assert tax_status.total == parse.clean_text(p.taxes[0].total)
+
+    def test_served(self, tmp_path):
+        seeds = synthetic.load_seeds(MOCKS)
+        corpus = synthetic.Corpus(20, 12, seeds=seeds)
+        parid = corpus.records[7]["PARID"]
+        with standin.serve(corpus):
+            records = fetch.municipality_records_from_Wprdc(
+                parse.Municipality(12, "Synthetic")
+            )
+            record, html = update.fetch_parcel(parid=parid)
+            assert len(records) == 20
+        os.remove(
+            path.join(
+                path.dirname(fetch.__file__), PARCEL_ID_LISTS, "Synthetic_parcelids.json"
+            )
+        )
+        assert update.parse_parcel(html)[0].clean == synthetic.parcel(
+            7, 12, seeds[1]
+        ).owner
+        # Written corpora are served the same
+        written = standin.Corpus.from_directory(
+            synthetic.write(str(tmp_path), 20, 12, seeds=seeds)
+        )
+        assert written.page(parid) == corpus.page(parid)
+        assert written.select('"MUNICODE" = \'12\'') == corpus.records
+
+
+class TestRecord:
+    def test_reads_like_a_dict(self):
+        with open(path.join(MOCKS, "record.json"), "r") as f:
+            row = json.load(f)
+        with open(path.join(MOCKS, "record.json"), "r") as f:
+            record = json.load(f, object_hook=Record.hook())
+        assert isinstance(record, Record)
+        assert record == row
+        assert record["PARID"] == record.get("PARID") == "0374R00210000000"
+        assert create.property_insertmap(record) == create.property_insertmap(row)
+        assert create.propertyexternaldata_imap(
+            1, "OWNER", record, 1
+        ) == create.propertyexternaldata_imap(1, "OWNER", row, 1)
+        with pytest.raises(KeyError):
+            record["FAIRMARKETTOTAL"]
+        assert pickle.loads(pickle.dumps(record)) == record
+
+    def test_smaller_than_dicts(self):
+        _, seed_records = synthetic.load_seeds(MOCKS)
+        rows = [p.record for p in synthetic.parcels(1000, 12, seed_records)]
+        response = json.dumps({"success": True, "result": {"records": rows}})
+
+        def loaded_size(**kwargs):
+            tracemalloc.start()
+            try:
+                records = json.loads(response, **kwargs)
+                return tracemalloc.get_traced_memory()[0], records
+            finally:
+                tracemalloc.stop()
+
+        dict_size, _ = loaded_size()
+        record_size, records = loaded_size(object_hook=Record.hook())
+        assert isinstance(records["result"]["records"][0], Record)
+        assert record_size < dict_size / 3
+
+
+class TestSnapshot:
+    def test_lookups(self, tmp_path):
+        _, seed_records = synthetic.load_seeds(MOCKS)
+        records = [
+            p.record for m in (13, 12) for p in synthetic.parcels(40, m, seed_records)
+        ]
+        path_ = snapshot.write(str(tmp_path / "wprdc.snapshot"), records)
+        with snapshot.Snapshot(path_) as snap:
+            assert len(snap) == 80
+            assert all(snap.get(r["PARID"]) == r for r in records)
+            assert snap.get("0012S99999000000") is None
+            assert list(snap.municipality(13)) == records[:40]
+            assert set(snap.parids(12)) == {r["PARID"] for r in records[40:]}
+            assert isinstance(snap.get(records[0]["PARID"])["TAXYEAR"], float)
+
+    def test_fetch_reads_the_snapshot(self, tmp_path):
+        with open(path.join(MOCKS, "record.json"), "r") as f:
+            row = json.load(f)
+        path_ = snapshot.write(str(tmp_path / "wprdc.snapshot"), [row])
+        with mock.patch("pyparcel.fetch.SNAPSHOT", path_), mock.patch.dict(
+            "pyparcel.fetch._snapshots", clear=True
+        ), mock.patch("pyparcel.fetch.requests.get") as get:
+            assert fetch.record_using_parid(row["PARID"]) == row
+            assert list(fetch.records_using_parids([row["PARID"], "MISSING"])) == [
+                row["PARID"]
+            ]
+            municipality = parse.Municipality(int(row["MUNICODE"]), "COGLand")
+            assert list(fetch.municipality_records_from_Wprdc(municipality)) == [row]
+            fetch._snapshots[path_].close()
+        get.assert_not_called()
+
+
+class TestStreaming:
+    @staticmethod
+    def _response(directory, count, seed_records) -> str:
+        filename = path.join(str(directory), "Streaming_{}.json".format(count))
+        records = [p.record for p in synthetic.parcels(count, 12, seed_records)]
+        with open(filename, "w") as f:
+            json.dump({"success": True, "result": {"records": records}}, f, indent=1)
+        return filename
+
+    def test_records_in_file(self, tmp_path):
+        _, seed_records = synthetic.load_seeds(MOCKS)
+        filename = self._response(tmp_path, 40, seed_records)
+        with open(filename, "r") as f:
+            expected = json.load(f)["result"]["records"]
+        # Records split across reads are put back together
+        with mock.patch("pyparcel.fetch.CHUNK_SIZE", 7):
+            records = fetch.Records(lambda: fetch.records_in_file(filename))
+            assert list(records) == expected
+            assert len(records) == 40
+        with open(filename, "r+") as f:
+            f.truncate(os.path.getsize(filename) // 2)
+        with pytest.raises(ValueError):
+            list(fetch.records_in_file(filename))
+
+    def test_emptiness_only_reads_the_first_record(self):
+        read = []
+
+        def stream():
+            for i in range(100):
+                read.append(i)
+                yield {"PARID": str(i)}
+
+        records = fetch.Records(stream)
+        assert records
+        assert read == [0]
+        assert not fetch.Records(lambda: iter(()))
+
+    def test_munis_are_read_up_front(self):
+        cursor = MagicMock()
+        cursor.fetchall.return_value = [(111,), (814,)]
+        assert fetch.munis(cursor) == [111, 814]
+        # Nothing is committed on the run's behalf
+        cursor.connection.commit.assert_not_called()
+
+    def test_missing_parids(self):
+        db, wprdc = ["A", "B", "D", "E", "F"], ["B", "C", "E"]
+        assert list(update.missing_parids(iter(db), iter(wprdc))) == ["A", "D", "F"]
+        with pytest.raises(ValueError):
+            list(update.missing_parids(["B", "A"], []))
+
+    def test_diff_does_not_trust_the_wprdcs_order(self):
+        # A case insensitive collation puts "0374r..." before "0374S..."
+        records = [{"PARID": "0374r0001"}, {"PARID": "0374S0001"}]
+        with mock.patch(
+            "pyparcel.update.fetch.all_parids_in_muni",
+            return_value=iter(["0374S0001", "0374r0001", "0374r0002"]),
+        ), mock.patch("pyparcel.update.fetch.prop_id"), mock.patch(
+            "pyparcel.update.fetch.cecase_id"
+        ), mock.patch(
+            "pyparcel.update.events.parcel_not_in_wprdc_data"
+        ) as not_in_wprdc, mock.patch(
+            "pyparcel.update.events.EventDetails",
+            side_effect=lambda parid, *args: MagicMock(parid=parid),
+        ):
+            update.create_events_for_parcels_in_db_but_not_in_records(
+                records, 374, MagicMock(), MagicMock(), False
+            )
+        assert [c.args[0].parid for c in not_in_wprdc.call_args_list] == ["0374r0002"]
+
+    def test_memory_does_not_grow_with_the_municipality(self, tmp_path):
+        _, seed_records = synthetic.load_seeds(MOCKS)
+        muni = parse.Municipality(12, "Streaming")
+        peaks = {}
+        for count in (500, 2000):
+            filename = self._response(tmp_path, count, seed_records)
+            parids = (p.parid for p in synthetic.parcels(count, 12, seed_records))
+            batches = []
+            tracemalloc.start()
+            # Not a MagicMock, which would keep every batch it's called with
+            with mock.patch(
+                "pyparcel.fetch._fetch_muni_data_and_write_to_file",
+                return_value=filename,
+            ), mock.patch(
+                "pyparcel.run.pipeline.run",
+                lambda conn, cursor, commit, records, **kw: batches.append(
+                    len(records)
+                ),
+            ), mock.patch(
+                "pyparcel.fetch.all_parids_in_muni", return_value=parids
+            ):
+                run._update_municipality(
+                    MagicMock(),
+                    MagicMock(),
+                    muni,
+                    commit=False,
+                    each=True,
+                    diff=True,
+                    fetch_workers=1,
+                    parse_workers=0,
+                    queue_size=1,
+                    checkpoint=checkpoint.Checkpoint(
+                        str(count), directory=str(tmp_path)
+                    ),
+                    batch_size=50,
+                )
+            peaks[count] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            assert sum(batches) == count
+        assert peaks[2000] < peaks[500] * 1.5, peaks
+
+
+class TestWriteIfChanged:
+    @pytest.fixture
+    def parcel(self):
+        with open(path.join(MOCKS, "record.json"), "r") as f:
+            record = json.load(f)
+        with open(path.join(MOCKS, "real_estate_portal.html"), "r") as f:
+            owner_name, tax_status = update.parse_parcel(f.read())
+        return record, owner_name, tax_status
+
+    def test_content_hashes(self, parcel, taxstatus_unpaid):
+        record, owner_name, tax_status = parcel
+        imap = create.propertyexternaldata_imap(1, owner_name.raw, record, None)
+        tax_hash = create.taxstatus_hash(tax_status)
+        # The property and tax status's ids aren't part of the contents
+        assert create.propertyexternaldata_hash(
+            create.propertyexternaldata_imap(2, owner_name.raw, record, 3), tax_hash
+        ) == create.propertyexternaldata_hash(imap, tax_hash)
+        assert create.propertyexternaldata_hash(
+            imap, tax_hash
+        ) != create.propertyexternaldata_hash(
+            create.propertyexternaldata_imap(1, "JONES MARY", record, None), tax_hash
+        )
+        assert tax_hash != create.taxstatus_hash(taxstatus_unpaid)
+
+    def _write(self, parcel, seen):
+        record, owner_name, tax_status = parcel
+        with mock.patch(
+            "pyparcel.update._parcel_not_in_db", return_value=False
+        ), mock.patch("pyparcel.update.fetch") as fetch_, mock.patch(
+            "pyparcel.update.write.propertyexternaldata_seen", return_value=seen
+        ), mock.patch(
+            "pyparcel.update.write.taxstatus", return_value=7
+        ) as taxstatus, mock.patch(
+            "pyparcel.update.write.propertyexternaldata"
+        ) as propertyexternaldata, mock.patch.object(
+            events,
+            "query_propertyexternaldata_for_changes_and_write_events",
+            return_value=True,
+        ) as changes:
+            fetch_.prop_id.return_value = 1
+            result = update.write_parcel(
+                MagicMock(), MagicMock(), False, record, owner_name, tax_status
+            )
+        return result, taxstatus, propertyexternaldata, changes
+
+    def test_unchanged_parcels_are_only_seen(self, parcel):
+        before = metrics.PARCELS_UNCHANGED.value()
+        result, taxstatus, propertyexternaldata, changes = self._write(parcel, True)
+        assert result == (False, False)
+        taxstatus.assert_not_called()
+        propertyexternaldata.assert_not_called()
+        changes.assert_not_called()
+        assert metrics.PARCELS_UNCHANGED.value() == before + 1
+
+    def test_changed_parcels_are_written(self, parcel):
+        result, taxstatus, propertyexternaldata, changes = self._write(parcel, False)
+        assert result == (False, True)
+        imap = propertyexternaldata.call_args.args[0]
+        assert imap["taxstatus_taxstatusid"] == 7
+        assert imap["contenthash"] == create.propertyexternaldata_hash(
+            imap, create.taxstatus_hash(parcel[2])
+        )
+
+    def test_identical_tax_statuses_are_reused(self, parcel):
+        cursor = MagicMock()
+        cursor.fetchone.return_value = (5,)
+        assert write.taxstatus(parcel[2], cursor, "hash") == 5
+        assert cursor.execute.call_count == 1
+
+
+class TestPageFingerprint:
+    def setup_mocks(self):
+        with open(path.join(MOCKS, "record.json"), "r") as f:
+            self.record = json.load(f)
+        with open(path.join(MOCKS, "real_estate_portal.html"), "r") as f:
+            self.html = f.read()
+
+    def test_volatile_parts_are_ignored(self):
+        self.setup_mocks()
+        fingerprint = update.page_fingerprint(self.record, self.html)
+        # A later request: a new viewstate, split over fewer fields, and a new time
+        later = self.html.replace('value="0C533B8B"', 'value="1D644C9C"')
+        later = later.replace("9/21/2020 10:29:30 PM", "10/19/2020 8:01:02 AM")
+        later = later.replace(
+            '<input type="hidden" name="__VIEWSTATE79" id="__VIEWSTATE79" '
+            'value="oI3FPI+k88X04XsQw1Jj2l8EPY=" />',
+            "",
+        )
+        assert later != self.html
+        assert update.page_fingerprint(self.record, later) == fingerprint
+        assert (
+            update.page_fingerprint(self.record, self.html.replace("UNPAID", "PAID"))
+            != fingerprint
+        )
+        assert (
+            update.page_fingerprint(dict(self.record, CONDITION="1"), self.html)
+            != fingerprint
+        )
+
+    def test_unchanged_parcels_are_not_parsed(self):
+        self.setup_mocks()
+        with mock.patch(
+            "pyparcel.update.fetch_parcel", return_value=(self.record, self.html)
+        ), mock.patch(
+            "pyparcel.update.fetch.page_fingerprints",
+            return_value={
+                self.record["PARID"]: (
+                    12,
+                    update.page_fingerprint(self.record, self.html),
+                )
+            },
+        ), mock.patch("pyparcel.update.parse_parcel") as parse_parcel, mock.patch(
+            "pyparcel.update.write.page_seen"
+        ) as page_seen:
+            assert update.parcel(
+                MagicMock(), MagicMock(), False, record=self.record
+            ) == (False, False)
+        parse_parcel.assert_not_called()
+        assert page_seen.call_args.args[0] == 12
+
+    def test_pipeline_skips_unchanged_parcels(self):
+        self.setup_mocks()
+        records = [dict(self.record, PARID=str(i)) for i in range(6)]
+        known = {
+            r["PARID"]: (i, update.page_fingerprint(r, self.html))
+            for i, r in enumerate(records[:4])
+        }
+        with mock.patch(
+            "pyparcel.pipeline.update.fetch_parcel",
+            side_effect=lambda record: (record, self.html),
+        ), mock.patch(
+            "pyparcel.pipeline.fetch.page_fingerprints", return_value=known
+        ), mock.patch(
+            "pyparcel.pipeline.update.write_parcel"
+        ) as write_parcel, mock.patch(
+            "pyparcel.pipeline.update.write_unchanged"
+        ) as write_unchanged, timing.Recorder() as recorder:
+            pipeline.run(MagicMock(), MagicMock(), False, records, parse_workers=0)
+        assert sorted(c.args[4] for c in write_unchanged.call_args_list) == [0, 1, 2, 3]
+        written = {c.args[3]["PARID"]: c.kwargs for c in write_parcel.call_args_list}
+        assert sorted(written) == ["4", "5"]
+        assert written["5"]["page_fingerprint"] == update.page_fingerprint(
+            records[5], self.html
+        )
+        assert recorder.report()["stages"][timing.SOUPIFY]["count"] == 2
+
+
+class TestUpdateParcels:
+    def test_results(self):
+        with open(path.join(MOCKS, "record.json"), "r") as f:
+            mock_record = json.load(f)
+        with open(path.join(MOCKS, "real_estate_portal.html"), "r") as f:
+            mocked_html = f.read()
+        bad_record = dict(mock_record, PARID="BAD")
+
+        def write_parcel(
+            conn, cursor, commit, record, owner_name, tax_status, page_fingerprint
+        ):
+            if record["PARID"] == "BAD":
+                raise ValueError("The WPRDC's data does not match")
+            return False, True
+
+        cursor = MagicMock()
+        with mock.patch(
+            "pyparcel.update.fetch.records_using_parids",
+            return_value={"0374R00210000000": mock_record, "BAD": bad_record},
+        ), mock.patch(
+            "pyparcel.update.scrape.county_property_assessment",
+            return_value=mocked_html,
+        ), mock.patch(
+            "pyparcel.update.write_parcel", side_effect=write_parcel
+        ):
+            results = update.parcels(
+                MagicMock(),
+                cursor,
+                False,
+                ["0374R00210000000", "BAD", "MISSING", "0374R00210000000"],
+            )
+        assert list(results) == ["0374R00210000000", "BAD", "MISSING"]
+        assert results["0374R00210000000"] == {
+            "status": "updated",
+            "new": False,
+            "changed": True,
+        }
+        assert results["BAD"]["status"] == "error"
+        assert results["MISSING"] == {"status": "not found"}
+        cursor.execute.assert_any_call("ROLLBACK TO SAVEPOINT parcel;")
+
+
+class TestRun:
+    class TestFanOut:
+        @staticmethod
+        def _update_municipality(conn, cursor, muni, commit, **options):
+            # Pretends every municipality has municode * 10 parcels
+            metrics.PARCELS_PROCESSED.inc(muni.municode * 10)
+            metrics.MUNICIPALITIES.inc()
+            events.publish([{"parid": str(muni.municode)}])
+
+        def test_counts_are_merged_across_workers(self):
+            cursor = MagicMock()
+            before = metrics.REGISTRY.snapshot()
+            with mock.patch("pyparcel.run.psycopg2.connect"), mock.patch(
+                "pyparcel.run.fetch.muni_sizes", return_value={1: 10, 2: 30, 3: 20}
+            ), mock.patch(
+                "pyparcel.run.fetch.muniname_given_municode",
+                side_effect=lambda m, c: parse.Municipality(m, str(m)),
+            ), mock.patch(
+                "pyparcel.run._update_municipality", self._update_municipality
+            ):
+                run._fan_out([1, 2, 3, 4], 2, False, {"parse_workers": None}, cursor)
+            counts = metrics.counts(metrics.REGISTRY.difference(before))
+            assert counts["processed"] == 100
+            assert counts["municipalities"] == 4
+
+        def test_worker_events_reach_the_parents_listeners(self):
+            heard = []
+            events.add_listener(heard.append)
+            try:
+                with mock.patch("pyparcel.run.psycopg2.connect"), mock.patch(
+                    "pyparcel.run.fetch.muni_sizes", return_value={}
+                ), mock.patch(
+                    "pyparcel.run.fetch.muniname_given_municode",
+                    side_effect=lambda m, c: parse.Municipality(m, str(m)),
+                ), mock.patch(
+                    "pyparcel.run._update_municipality", self._update_municipality
+                ):
+                    run._fan_out([1, 2, 3], 2, False, {"parse_workers": 0}, MagicMock())
+            finally:
+                events.remove_listener(heard.append)
+            assert sorted(e["parid"] for e in heard) == ["1", "2", "3"]
+
+    class TestCheckpoint:
+        def test_resume_skips_finished_batches(self, tmp_path):
+            muni = parse.Municipality(1, "COGLand")
+            records = [{"PARID": str(i)} for i in range(5)]
+            run_checkpoint = checkpoint.Checkpoint("test", directory=str(tmp_path))
+            run_checkpoint.mark_batch(muni.municode, 1, 2)
+            with mock.patch(
+                "pyparcel.run.fetch.municipality_records_from_Wprdc",
+                return_value=records,
+            ), mock.patch("pyparcel.run.pipeline.run") as pipeline_run:
+                run._update_municipality(
+                    MagicMock(),
+                    MagicMock(),
+                    muni,
+                    commit=False,
+                    each=True,
+                    diff=False,
+                    fetch_workers=1,
+                    parse_workers=0,
+                    queue_size=1,
+                    checkpoint=run_checkpoint,
+                    batch_size=2,
+                )
+            batches = [c.args[3] for c in pipeline_run.call_args_list]
+            assert batches == [records[0:2], records[4:5]]
+            assert run_checkpoint.batches_done(muni.municode, 2) == {0, 1, 2}
+            assert run_checkpoint.municipality_done(muni.municode)
+
+        def test_resume_refuses_a_different_batch_size(self, tmp_path):
+            run_checkpoint = checkpoint.Checkpoint("test", directory=str(tmp_path))
+            assert run_checkpoint.batches_done(1, 2) == set()
+            run_checkpoint.mark_batch(1, 0, 2)
+            with pytest.raises(ValueError):
+                run_checkpoint.batches_done(1, 3)
+
+        def test_runs_with_and_without_audit_are_kept_apart(self, tmp_path):
+            keys = {
+                checkpoint.Checkpoint.for_run(
+                    814, True, False, False, audit, directory=str(tmp_path)
+                ).path
+                for audit in (False, True)
+            }
+            assert len(keys) == 2
+
+        def test_clear(self, tmp_path):
+            run_checkpoint = checkpoint.Checkpoint("test", directory=str(tmp_path))
+            run_checkpoint.mark_municipality(1)
+            run_checkpoint.clear()
+            assert not run_checkpoint.municipality_done(1)
+
+
+class TestJobQueue:
+    def test_backoff(self):
+        delays = [jobqueue.backoff(attempts) for attempts in range(1, 5)]
+        assert delays == [30, 60, 120, 240]
+        assert jobqueue.backoff(100) == jobqueue.BACKOFF_MAX
+
+    def test_finishing_a_job_another_worker_owns_does_nothing(self):
+        job = jobqueue.Job(1, jobqueue.PARCEL, "1", {}, 1, 3)
+        cursor = MagicMock(rowcount=0)
+        retries = metrics.RETRIES.value(kind=jobqueue.PARCEL)
+        assert not jobqueue.complete(cursor, job, "late")
+        assert not jobqueue.fail(cursor, job, "late", "error")
+        for call in cursor.execute.call_args_list:
+            sql, args = call.args
+            assert "worker = %(worker)s AND status = 'running'" in sql
+            assert args["worker"] == "late"
+        assert metrics.RETRIES.value(kind=jobqueue.PARCEL) == retries
+
+    def test_permanent_failures_are_not_retried(self):
+        job = jobqueue.Job(1, jobqueue.PARCEL, "1", {}, 1, 3)
+        cursor = MagicMock(rowcount=1)
+        assert jobqueue.fail(cursor, job, "test", "error", permanent=True)
+        assert cursor.execute.call_args.args[1]["status"] == jobqueue.DEAD
+        assert failures.permanent(DataMismatch("1"))
+        assert not failures.permanent(requests.Timeout())
+
+    def test_progress_is_saved_in_the_job(self):
+        progress = jobqueue.Progress()
+        progress.mark_batch(1, 0, 2)
+        progress.mark_pass(1, "each")
+        cursor = MagicMock(rowcount=1)
+        job = jobqueue.Job(1, jobqueue.MUNICIPALITY, "1", {}, 1, 3)
+        assert jobqueue.heartbeat(cursor, job, "test", progress=progress.state())
+        saved = cursor.execute.call_args.args[1]["progress"].adapted
+        # What a retry on another machine resumes from
+        resumed = jobqueue.Progress(json.loads(json.dumps(saved)))
+        assert resumed.batches_done(1, 2) == {0}
+        assert resumed.pass_done(1, "each")
+        assert not resumed.pass_done(1, "diff")
+        assert resumed.batches_done(2, 2) == set()
+        # Marks made since aren't shared with the saved copy
+        resumed.mark_batch(1, 1, 2)
+        assert progress.batches_done(1, 2) == {0}
+
+
+class TestMetrics:
+    def test_difference_and_merge(self):
+        registry = metrics.Registry()
+        parcels = registry.counter("parcels_total", "Parcels.")
+        seconds = registry.histogram("seconds", "Seconds.", buckets=(0.1, 1))
+        parcels.inc()
+        before = registry.snapshot()
+        parcels.inc(2)
+        seconds.observe(0.5)
+        added = registry.difference(before)
+        assert added["parcels_total"] == {(): [2.0]}
+
+        registry.merge(added)
+        assert parcels.value() == 5
+        assert seconds.count() == 2
+
+    def test_concurrent_runs_count_their_own(self):
+        parcels = metrics.Registry().counter("parcels_total", "Parcels.")
+        both_running = threading.Barrier(2)
+
+        def run(amount):
+            with metrics.Scope() as scope:
+                both_running.wait()
+                parcels.inc(amount)
+                # As pipeline.run starts its stages
+                thread = threading.Thread(
+                    target=contextvars.copy_context().run, args=(parcels.inc, amount)
+                )
+                thread.start()
+                thread.join()
+                both_running.wait()
+            return scope.snapshot()["parcels_total"][()]
+
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            assert list(pool.map(run, [1, 10])) == [[2.0], [20.0]]
+        assert parcels.value() == 22
+
+    def test_render(self):
+        registry = metrics.Registry()
+        events_ = registry.counter("events_total", "Events.", ["category"])
+        seconds = registry.histogram("seconds", "Seconds.", buckets=(0.1, 1))
+        events_.inc(category="DifferentOwner")
+        seconds.observe(0.05)
+        seconds.observe(5)
+        assert registry.render().splitlines() == [
+            "# HELP events_total Events.",
+            "# TYPE events_total counter",
+            'events_total{category="DifferentOwner"} 1',
+            "# HELP seconds Seconds.",
+            "# TYPE seconds histogram",
+            'seconds_bucket{le="0.1"} 1',
+            'seconds_bucket{le="1"} 1',
+            'seconds_bucket{le="+Inf"} 2',
+            "seconds_sum 5.05",
+            "seconds_count 2",
+        ]
+        with pytest.raises(ValueError):
+            events_.inc()
+
+
+class TestTaxCalendar:
+    record = {"SALEDATE": "06-28-2016", "SALEPRICE": 7000.0}
+
+    def last(self, paidstatus, year="2020", seen=date(2020, 3, 1)):
+        return LastTaxStatus(
+            TaxStatus(year=year, paidstatus=paidstatus), seen, 7000.0, "2016"
+        )
+
+    def test_last_tax_statuses_read_what_the_calendar_needs(self):
+        cursor = MagicMock()
+        seen = datetime(2020, 3, 1, 12)
+        cursor.fetchall.return_value = [("1", 2020, "PAID", seen, 7000, "2016")]
+        last = fetch.last_tax_statuses(["1"], cursor)["1"]
+        assert last == self.last("PAID")
+        assert "datepaid" not in cursor.execute.call_args.args[0]
+
+    def test_paid_parcels_wait_for_the_next_bills(self):
+        paid = self.last("PAID")
+        assert not taxcalendar.due(paid, date(2020, 12, 31), self.record)
+        assert taxcalendar.due(paid, date(2021, 1, 1), self.record)
+        # Without a paid status, there's no telling
+        assert taxcalendar.due(self.last(None), date(2020, 6, 1), self.record)
+
+    def test_unpaid_parcels_are_due_after_deadlines_and_payments(self):
+        unpaid = self.last("UNPAID", seen=date(2020, 4, 28))
+        assert not taxcalendar.due(unpaid, date(2020, 4, 30), self.record)
+        # Penalties were added after the face deadline
+        assert taxcalendar.due(unpaid, date(2020, 5, 1), self.record)
+        # A payment may have posted
+        assert taxcalendar.due(
+            unpaid, date(2020, 4, 28) + timedelta(days=7), self.record
+        )
+
+    def test_new_parcels_and_sales_are_due(self):
+        assert taxcalendar.due(None, date(2020, 6, 1))
+        assert taxcalendar.due(self.last("PAID", year="2019"), date(2020, 6, 1))
+        sold = {"SALEDATE": "05-01-2020", "SALEPRICE": 150000.0}
+        assert taxcalendar.due(self.last("PAID"), date(2020, 6, 1), sold)
+
+    def paid_parcels(self, count):
+        """ Records, and the tax statuses and fingerprints of their last updates. """
+        with open(path.join(MOCKS, "record.json"), "r") as f:
+            mock_record = json.load(f)
+        records = [dict(mock_record, PARID=str(i)) for i in range(count)]
+        last = self.last("PAID", year=str(date.today().year))
+        last = last._replace(saleprice=mock_record["SALEPRICE"])
+        known = {
+            r["PARID"]: (i, create.page_fingerprint(r, "last page"))
+            for i, r in enumerate(records)
+        }
+        return records, {r["PARID"]: last for r in records}, known
+
+    def test_pipeline_skips_parcels_that_are_not_due(self, monkeypatch):
+        monkeypatch.setattr(taxcalendar, "ENABLED", True)
+        records, last, known = self.paid_parcels(4)
+        # The WPRDC's record changed, so it's written even though it's paid
+        records[1] = dict(records[1], CONDITION="1")
+        del last["3"]
+        before = metrics.PARCELS_SKIPPED.value()
+        with mock.patch(
+            "pyparcel.pipeline.fetch.last_tax_statuses", return_value=last
+        ), mock.patch(
+            "pyparcel.pipeline.fetch.page_fingerprints", return_value=known
+        ), mock.patch(
+            "pyparcel.pipeline.update.fetch_parcel"
+        ) as fetch_parcel, mock.patch(
+            "pyparcel.pipeline.update.parse_parcel", return_value=(None, None)
+        ), mock.patch(
+            "pyparcel.pipeline.update.write_parcel"
+        ), mock.patch(
+            "pyparcel.update.write.page_seen"
+        ) as page_seen:
+            fetch_parcel.side_effect = lambda record: (record, "")
+            pipeline.run(MagicMock(), MagicMock(), False, records, parse_workers=0)
+        fetched = [c.kwargs["record"]["PARID"] for c in fetch_parcel.call_args_list]
+        assert sorted(fetched) == ["1", "3"]
+        assert metrics.PARCELS_SKIPPED.value() == before + 2
+        # Skipped parcels are still marked seen
+        assert sorted(c.args[0] for c in page_seen.call_args_list) == [0, 2]
+
+    def test_skipped_parcels_that_fail_are_quarantined(self, monkeypatch):
+        monkeypatch.setattr(taxcalendar, "ENABLED", True)
+        records, last, known = self.paid_parcels(3)
+        quarantine = failures.Quarantine()
+        cursor = MagicMock()
+
+        def page_seen(extdataid, cursor):
+            if extdataid == 1:
+                raise psycopg2.DataError()
+
+        with mock.patch(
+            "pyparcel.pipeline.fetch.last_tax_statuses", return_value=last
+        ), mock.patch(
+            "pyparcel.pipeline.fetch.page_fingerprints", return_value=known
+        ), mock.patch(
+            "pyparcel.update.write.page_seen", side_effect=page_seen
+        ) as seen:
+            pipeline.run(
+                MagicMock(),
+                cursor,
+                False,
+                records,
+                parse_workers=0,
+                quarantine=quarantine,
+            )
+        # The other parcels are still marked seen, in the same transaction
+        assert seen.call_count == 3
+        assert [(f.parid, f.stage) for f in quarantine.failures()] == [("1", "write")]
+        statements = [c.args[0] for c in cursor.execute.call_args_list]
+        assert statements.count("ROLLBACK TO SAVEPOINT parcel;") == 1
+        assert statements.count("RELEASE SAVEPOINT parcel;") == 2
+
+    def test_disabled_by_default(self):
+        records, last, known = self.paid_parcels(2)
+        with mock.patch(
+            "pyparcel.pipeline.fetch.last_tax_statuses", return_value=last
+        ) as last_tax_statuses, mock.patch(
+            "pyparcel.pipeline.fetch.page_fingerprints", return_value=known
+        ), mock.patch(
+            "pyparcel.pipeline.update.fetch_parcel",
+            side_effect=lambda record: (record, ""),
+        ) as fetch_parcel, mock.patch(
+            "pyparcel.pipeline.update.parse_parcel", return_value=(None, None)
+        ), mock.patch(
+            "pyparcel.pipeline.update.write_parcel"
+        ):
+            pipeline.run(MagicMock(), MagicMock(), False, records, parse_workers=0)
+        assert not taxcalendar.ENABLED
+        last_tax_statuses.assert_not_called()
+        assert fetch_parcel.call_count == 2
+
+    def test_rolling_schedule_moves_past_skipped_parcels(self, monkeypatch):
+        monkeypatch.setattr(taxcalendar, "ENABLED", True)
+        records, last, known = self.paid_parcels(4)
+        by_parid = {r["PARID"]: r for r in records}
+        # Every parcel is paid and unchanged; two are overdue
+        ages = {"0": 40, "1": 35, "2": 20, "3": 10}
+
+        def histories(cursor, municode=None):
+            for parid, age in ages.items():
+                yield schedule.ParcelHistory(parid, age, 0, "PAID", "2010")
+
+        def page_seen(extdataid, cursor):
+            ages[str(extdataid)] = 0
+
+        def records_using_parids(parids):
+            slices.append(sorted(parids))
+            return {parid: by_parid[parid] for parid in parids}
+
+        slices = []
+        with mock.patch(
+            "pyparcel.schedule.histories", histories
+        ), mock.patch(
+            "pyparcel.run.fetch.records_using_parids", records_using_parids
+        ), mock.patch(
+            "pyparcel.pipeline.fetch.last_tax_statuses", return_value=last
+        ), mock.patch(
+            "pyparcel.pipeline.fetch.page_fingerprints", return_value=known
+        ), mock.patch(
+            "pyparcel.pipeline.update.fetch_parcel"
+        ) as fetch_parcel, mock.patch(
+            "pyparcel.update.write.page_seen", page_seen
+        ):
+            for day in range(2):
+                cursor = MagicMock()
+                records = run._rolling_records(cursor, None, 30, slice_size=2)
+                pipeline.run(MagicMock(), cursor, False, records, parse_workers=0)
+        fetch_parcel.assert_not_called()
+        # The skipped parcels count as seen, so the next day moves on
+        assert slices == [["0", "1"], ["2", "3"]]
+        assert max(ages.values()) == 0
+
+
+class TestAudit:
+    @staticmethod
+    def records(count=2000):
+        return [p.record for p in synthetic.parcels(count, seed_records=[{}])]
+
+    def test_sample_size(self):
+        # The textbook 385 for +/- 5% at 95%, and fewer for a small population
+        assert audit.sample_size(10 ** 9, expected=0.5) == 385
+        assert audit.sample_size(500, expected=0.5) < 385
+        assert audit.sample_size(10) == 10
+        assert audit.sample_size(0) == 0
+
+    def test_wilson(self):
+        low, high = audit.wilson(0, 100)
+        assert low == 0 and 0.03 < high < 0.04
+        low, high = audit.wilson(50, 100)
+        assert low < 0.5 < high and high - low < 0.2
+
+    def test_clean_municipalities_are_sampled_once(self):
+        records = self.records()
+        checked = []
+        report = audit.municipality(
+            records, 999, seed=0, check=lambda r: checked.append(r["PARID"])
+        )
+        assert report["rounds"] == 1
+        assert report["mismatches"] == 0
+        assert len(set(checked)) == len(checked) == report["sampled"]
+        assert report["sampled"] < len(records) / 5
+        # Every land use is represented
+        assert set(report["strata"]) == {"/".join(u) for u in synthetic.LAND_USES}
+        assert all(s["sampled"] >= 2 for s in report["strata"].values())
+
+    def test_mismatches_widen_their_stratum(self):
+        records = self.records()
+        before = metrics.AUDIT_MISMATCHES.value()
+        report = audit.municipality(
+            records,
+            999,
+            seed=0,
+            check=lambda r: "mismatch" if r["CLASS"] == "I" else None,
+        )
+        industrial = report["strata"]["300/I"]
+        assert report["rounds"] > 1
+        assert industrial["sampled"] > audit.allocate(
+            {("300", "I"): industrial["population"]}, 0
+        )[("300", "I")]
+        assert industrial["mismatches"] == industrial["sampled"]
+        assert report["strata"]["010/R"]["mismatches"] == 0
+        assert industrial["interval"][0] > report["strata"]["010/R"]["interval"][1]
+        assert metrics.AUDIT_MISMATCHES.value() == before + report["mismatches"]
+        assert report["rate"] > report["estimate"]
+
+    def test_failed_scrapes_are_not_mismatches(self):
+        def check(record):
+            raise ConnectionError
+
+        report = audit.municipality(self.records(100), seed=0, check=check)
+        assert report["sampled"] == report["mismatches"] == 0
+        assert report["errors"] > 0
+
+    def test_stratified_interval(self):
+        # A small stratum sampled in full, with mismatches, and a large one
+        # sampled at 1% and clean. The pooled rate, 50 / 150, overweights the first.
+        strata = [(100, 100, 50), (10000, 100, 0)]
+        estimate, (low, high) = audit.stratified_interval(strata)
+        assert estimate == pytest.approx(50 / 10100)
+        assert low <= estimate < high < 50 / 150
+        # The large stratum's uncertainty dominates, as it's barely sampled
+        _, (_, better) = audit.stratified_interval([(100, 100, 50), (10000, 2000, 0)])
+        assert better < high
+        # A single unstratified sample is a plain Wilson interval
+        interval = audit.stratified_interval([(10 ** 9, 100, 0)])[1]
+        assert interval == pytest.approx(audit.wilson(0, 100), rel=0.02)
+
+    def test_summary(self):
+        counts = metrics.counts({})
+        assert "audit" not in run._summarize(None, counts)
+
+        def report(municode, *strata):
+            keys = ("population", "sampled", "mismatches")
+            return {
+                "municode": municode,
+                "population": sum(s[0] for s in strata),
+                "sampled": sum(s[1] for s in strata),
+                "mismatches": sum(s[2] for s in strata),
+                "estimate": None,
+                "interval": None,
+                "strata": {str(i): dict(zip(keys, s)) for i, s in enumerate(strata)},
+            }
+
+        audits = [report(1, (800, 80, 0), (100, 20, 1)), report(2, (100, 100, 30))]
+        counts = {**counts, "audited": 200, "mismatches": 31}
+        summary = run._summarize(None, counts, audits=audits)["audit"]
+        assert summary["mismatches"] == 31
+        # Not the pooled 31 / 200, which overweights the smaller municipality
+        assert summary["estimate"] == pytest.approx(0.1 * 1 / 20 + 0.1 * 0.3)
+        low, high = summary["interval"]
+        assert low < summary["estimate"] < high < 31 / 200
+        assert set(summary["municipalities"]) == {"1", "2"}
+
+
+class TestSchedule:
+    today = date(2020, 10, 1)
+
+    def history(self, age_days, recent_events=0, paidstatus="PAID", saleyear="2010"):
+        return schedule.ParcelHistory(
+            "0374R00210000000", age_days, recent_events, paidstatus, saleyear
+        )
+
+    def test_never_updated_parcels_come_first(self):
+        assert schedule.priority(self.history(None)) == float("inf")
+
+    def test_overdue_parcels_outrank_hot_parcels(self):
+        overdue = schedule.priority(self.history(31), today=self.today)
+        hot = schedule.priority(
+            self.history(29, recent_events=10, paidstatus="UNPAID", saleyear="2020"),
+            today=self.today,
+        )
+        assert overdue > hot
+
+    @pytest.mark.parametrize(
+        "hot",
+        [
+            {"recent_events": 2},
+            {"paidstatus": "UNPAID"},
+            {"paidstatus": "BALANCE DUE"},
+            {"saleyear": "2020"},
+        ],
+    )
+    def test_hot_parcels_outrank_quiet_parcels_of_the_same_age(self, hot):
+        quiet = schedule.priority(self.history(10), today=self.today)
+        assert schedule.priority(self.history(10, **hot), today=self.today) > quiet
+
+    def test_slice(self):
+        histories = [self.history(age) for age in range(40)]
+        with mock.patch("pyparcel.schedule.histories", return_value=histories):
+            parids = schedule.rolling_slice(MagicMock(), slice_size=5)
+        assert len(parids) == 5
+        assert schedule.default_slice_size(3000, 30) == 125
+
+    def test_slice_records_are_fetched_in_bulk(self):
+        with mock.patch(
+            "pyparcel.run.schedule_.rolling_slice", return_value=["3", "1", "2"]
+        ), mock.patch(
+            "pyparcel.run.fetch.records_using_parids",
+            return_value={"1": {"PARID": "1"}, "3": {"PARID": "3"}},
+        ) as records_using_parids, mock.patch(
+            "pyparcel.run.write.wprdc_missing"
+        ) as wprdc_missing:
+            records = run._rolling_records(MagicMock(), None, 30, 3)
+        records_using_parids.assert_called_once_with(["3", "1", "2"])
+        # In the slice's order, less the parcel the WPRDC doesn't have
+        assert [r["PARID"] for r in records] == ["3", "1"]
+        # Which is recorded, so it doesn't top tomorrow's slice too
+        assert wprdc_missing.call_args.args[0] == ["2"]
+
+    def test_histories_are_read_a_few_at_a_time(self):
+        cursor = MagicMock()
+        server_cursor = cursor.connection.cursor.return_value.__enter__.return_value
+        server_cursor.__iter__.return_value = [tuple(self.history(3.0))]
+        assert list(schedule.histories(cursor)) == [self.history(3.0)]
+        # A named cursor, so the county isn't read into memory at once
+        assert cursor.connection.cursor.call_args.args == ("pyparcel_histories",)
+        assert server_cursor.itersize == schedule.ITERSIZE
+        cursor.execute.assert_not_called()
+
+
+class TestApi:
+    class TestJobs:
+        @staticmethod
+        def pyparcel(progress, cancel, **kwargs):
+            """ Stands in for run.pyparcel. Runs until cancelled. """
+            progress({"type": "parcel", "parid": "1", "counts": {"processed": 1}})
+            cancel.wait(5)
+            return {"success": False, "cancelled": cancel.is_set()}
+
+        def wait_for(self, client, url, status):
+            for _ in range(50):
+                job = client.get(url).get_json()
+                if job["status"] == status:
+                    return job
+                time.sleep(0.1)
+            raise AssertionError(f"Job never became {status}: {job}")
+
+        def test_submit_status_cancel(self):
+            client = pyparcel._create_app().test_client()
+            with mock.patch("pyparcel.jobs.run.pyparcel", self.pyparcel):
+                response = client.post(
+                    "/api/v1/pyparcel", json={"municode": "814", "each": "true"}
+                )
+                assert response.status_code == 202
+                url = response.get_json()["status"]
+                job = self.wait_for(client, url, "running")
+                assert job["params"] == {"municode": "814", "each": True}
+                assert job["counters"] == {"processed": 1}
+
+                assert client.delete(url).status_code == 202
+                self.wait_for(client, url, "cancelled")
+            assert client.get("/api/v1/jobs/nonsense").status_code == 404
+
+        @pytest.mark.parametrize("body", [["each"], "each", 1, {"workers": [2]}])
+        def test_submit_needs_an_object_of_arguments(self, body):
+            client = pyparcel._create_app().test_client()
+            with mock.patch("pyparcel.jobs.run.pyparcel") as run_pyparcel:
+                response = client.post("/api/v1/pyparcel", json=body)
+            assert response.status_code == 400
+            run_pyparcel.assert_not_called()
+
+        def test_stream(self):
+            client = pyparcel._create_app().test_client()
+            with mock.patch("pyparcel.jobs.run.pyparcel", self.pyparcel):
+                url = client.post("/api/v1/pyparcel", json={"each": True}).get_json()[
+                    "status"
+                ]
+                self.wait_for(client, url, "running")
+                client.delete(url)
+                self.wait_for(client, url, "cancelled")
+                # The job is finished, so the stream ends after replaying its updates
+                response = client.get(url + "/stream?format=ndjson")
+            updates = [json.loads(line) for line in response.data.splitlines()]
+            assert [u["type"] for u in updates] == ["parcel", "finished"]
+            assert updates[0]["throughput"] > 0
+            assert updates[1]["status"] == "cancelled"
+
+            response = client.get(url + "/stream", headers={"Last-Event-ID": "abc"})
+            assert response.status_code == 400
+
+    @pytest.mark.parametrize(
+        "query",
+        [
+            "",
+            "?municode=abc",
+            "?municode=814&each=true",
+            "?schedule=rolling",
+            "?parcel=0374R00210000000&diff=1",
+            "?parcel=0374R00210000000&fetch_workers=abc",
+        ],
+    )
+    def test_get_only_runs_single_parcels(self, query):
+        client = pyparcel._create_app().test_client()
+        with mock.patch("pyparcel.pyparcel") as run:
+            response = client.get("/api/v1/pyparcel" + query)
+        assert response.status_code == 400
+        assert "error" in response.get_json()
+        run.assert_not_called()
+
+    def test_get_runs_a_parcel(self):
+        client = pyparcel._create_app().test_client()
+        with mock.patch("pyparcel.pyparcel", return_value={"success": True}) as run:
+            response = client.get("/api/v1/pyparcel?parcel=0374R00210000000")
+        assert response.get_json() == {"success": True}
+        run.assert_called_once_with(parcel="0374R00210000000")
+
+    @pytest.mark.parametrize(
+        "body", [{"parcels": [123]}, {"parcels": [["x"]]}, ["x"], {"parcels": []}]
+    )
+    def test_batches_must_be_lists_of_parcel_ids(self, body):
+        client = pyparcel._create_app().test_client()
+        with mock.patch("pyparcel.update.parcels") as parcels:
+            response = client.post("/api/v1/parcels", json=body)
+        assert response.status_code == 400
+        parcels.assert_not_called()
+
+    def test_batches_use_the_apps_connections(self):
+        client = pyparcel._create_app().test_client()
+        results = {"0374R00210000000": {"status": "not found"}}
+        with mock.patch(
+            "psycopg2.pool.ThreadedConnectionPool"
+        ) as pool, mock.patch("psycopg2.connect") as connect, mock.patch(
+            "pyparcel.update.parcels", return_value=results
+        ):
+            for _ in range(2):
+                response = client.post(
+                    "/api/v1/parcels", json={"parcels": ["0374R00210000000"]}
+                )
+                assert response.get_json() == {"results": results}
+        connect.assert_not_called()
+        pool.assert_called_once()
+        assert pool.return_value.putconn.call_count == 2
+
+    def test_metrics(self):
+        client = pyparcel._create_app().test_client()
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        assert b"# TYPE pyparcel_parcels_processed_total counter" in response.data
+
+    class TestReadParcel:
+        url = "/api/v1/parcels/0374R00210000000"
+        data = {
+            "parid": "0374R00210000000",
+            "owner": "NEW JEFFREY R",
+            "taxstatus": {"year": "2020", "paidstatus": "UNPAID"},
+            "lastupdated": "2020-09-21T00:00:00+00:00",
+            "age": 3600.0,
+        }
+
+        def test_cached_and_conditional(self):
+            client = pyparcel._create_app().test_client()
+            with mock.patch("psycopg2.pool.ThreadedConnectionPool"), mock.patch(
+                "pyparcel.fetch.latest_parcel_data", return_value=self.data
+            ) as latest_parcel_data:
+                response = client.get(self.url)
+                assert response.status_code == 200
+                assert response.get_json()["owner"] == "NEW JEFFREY R"
+                assert "age" not in response.get_json()
+                etag = response.headers["ETag"]
+
+                response = client.get(self.url, headers={"If-None-Match": etag})
+                assert response.status_code == 304
+                # The second request was served from the cache
+                latest_parcel_data.assert_called_once()
+
+        def test_stale_data_is_scraped(self):
+            client = pyparcel._create_app().test_client()
+            with open(path.join(MOCKS, "real_estate_portal.html"), "r") as f:
+                mocked_html = f.read()
+            with open(path.join(MOCKS, "record.json"), "r") as f:
+                mock_record = json.load(f)
+            with mock.patch("psycopg2.pool.ThreadedConnectionPool"), mock.patch(
+                "pyparcel.fetch.latest_parcel_data", return_value=self.data
+            ), mock.patch(
+                "pyparcel.update.fetch.record_using_parid", return_value=mock_record
+            ), mock.patch(
+                "pyparcel.update.scrape.county_property_assessment",
+                return_value=mocked_html,
+            ) as scrape:
+                response = client.get(self.url + "?max_age=7200")
+                assert response.status_code == 200
+                scrape.assert_not_called()
+                # When the data last changed, not when it was last seen
+                assert response.last_modified.isoformat() == self.data["lastupdated"]
+                response = client.get(self.url + "?max_age=60")
+                scrape.assert_called_once()
+            assert response.get_json()["taxstatus"]["total"] == "767"
+            # The same shape as fetch.latest_parcel_data
+            fields = {"parid", "owner", "taxstatus", "lastupdated"}
+            assert set(response.get_json()) == fields | set(fetch.PARCEL_DATA_FIELDS)
+
+        def test_failed_scrapes(self):
+            client = pyparcel._create_app().test_client()
+            with mock.patch("psycopg2.pool.ThreadedConnectionPool"), mock.patch(
+                "pyparcel.fetch.latest_parcel_data", return_value=self.data
+            ) as latest_parcel_data, mock.patch(
+                "pyparcel.update.fetch_parcel", side_effect=requests.Timeout
+            ):
+                response = client.get(self.url + "?max_age=60")
+                assert response.status_code == 200
+                assert "Stale" in response.headers["Warning"]
+                assert response.get_json()["owner"] == "NEW JEFFREY R"
+
+                latest_parcel_data.return_value = None
+                other = "/api/v1/parcels/0374R00210000001?max_age=60"
+                assert client.get(other).status_code == 502
+
+        def test_not_found(self):
+            client = pyparcel._create_app().test_client()
+            with mock.patch("psycopg2.pool.ThreadedConnectionPool"), mock.patch(
+                "pyparcel.fetch.latest_parcel_data", return_value=None
+            ):
+                assert client.get(self.url).status_code == 404
+                assert client.get("/api/v1/parcels/not-a-parid").status_code == 400
+
+
 try:
     conn = psycopg2.connect(DB_URI)
 except psycopg2.OperationalError:
@@ -347,6 +2014,9 @@ with conn:
                     mocked_html = f.read()
                 self.mock_record = mock_record
                 self.mocked_html = mocked_html
+                with conn.cursor() as cursor:
+                    write.add_content_hash_columns(cursor)
+                conn.commit()
 
             def test_update_parcel_given_record(self):
                 self.setup_mocks()
@@ -378,6 +2048,37 @@ with conn:
                             record=self.mock_record,
                         )
 
+        class TestJobQueue:
+            def test_failed_jobs_are_retried_then_dead_lettered(self):
+                try:
+                    with conn.cursor() as cursor:
+                        jobqueue.create_table(cursor)
+                        jobqueue.enqueue(
+                            cursor, jobqueue.PARCEL, ["TESTPARCEL"], max_attempts=2
+                        )
+                        job = jobqueue.claim(cursor, "test")
+                        assert job.target == "TESTPARCEL"
+                        # A claimed job can't be claimed again
+                        assert jobqueue.claim(cursor, "other") is None
+                        # Only the worker holding the lease can finish it
+                        assert not jobqueue.complete(cursor, job, "other")
+                        assert not jobqueue.fail(cursor, job, "other", "first")
+                        assert jobqueue.fail(cursor, job, "test", "first")
+                        # Nor can it once it's been put back on the queue
+                        assert not jobqueue.complete(cursor, job, "test")
+                        cursor.execute(
+                            "UPDATE pyparcel_job SET availableat = now() "
+                            "WHERE jobid = %s",
+                            [job.jobid],
+                        )
+                        job = jobqueue.claim(cursor, "test")
+                        assert job.attempts == 2
+                        assert jobqueue.fail(cursor, job, "test", "second")
+                        dead = [row[0] for row in jobqueue.dead_letters(cursor)]
+                        assert job.jobid in dead
+                finally:
+                    conn.rollback()
+
         class TestEventCategories:
             """ Ensures events in events.py share the same attributes of their counterpart in the database.
             """